@@ -1,11 +1,32 @@
 import json
+import time
+import uuid
+from typing import Optional
 import streamlit as st
 
 from pydantic import ValidationError
 
 from db import create_database_connection, UserOperations, MovieOperations, UserBase
 from tmdb_api import MovieDB, MovieResponse
-from openai_api import AsyncManager, OpenAIBot, MessageItem
+from movie_frame import MovieFrame
+from recommender import get_recommender
+from warmup import get_warmup
+from images import get_poster_store
+from metrics import configure_metrics
+from view_models import ResultStore, WatchlistState, query_hash
+from movie_grid import render_grid, render_movie_card
+from openai_api import (
+    AsyncManager,
+    OpenAIBot,
+    MessageItem,
+    RunFailedError,
+    RunTimeoutError,
+    get_params_cache,
+)
+
+# Time every rerun and its phases when metrics are enabled in the secrets
+metrics = configure_metrics()
+rerun_started = time.perf_counter()
 
 database_engine = create_database_connection()
 user_operations = UserOperations(database_engine)
@@ -17,9 +38,40 @@ if "username" not in st.session_state:
 if "user" not in st.session_state:
     st.session_state["user"] = None
 
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+
 async_manager = AsyncManager()
 movie_database = MovieDB()
-openai_bot = OpenAIBot()
+# Genres and discover pages are prefetched in the background and shared by every session
+warmup = get_warmup()
+
+# Each session keeps its own bot (and pooled assistant thread) across reruns
+if "openai_bot" not in st.session_state:
+    st.session_state["openai_bot"] = OpenAIBot(
+        session_id=st.session_state["session_id"], async_manager=async_manager
+    )
+openai_bot = st.session_state["openai_bot"]
+params_cache = get_params_cache()
+poster_store = get_poster_store()
+
+# Fetched result sets and the watch-list membership of movies survive reruns in the session state
+result_store = ResultStore(st.session_state)
+watchlist = WatchlistState(st.session_state)
+if st.session_state["user"] is not None:
+    watchlist.load(st.session_state["user"].id, movie_operations)
+
+
+def render_card(movie, grid_key):
+    render_movie_card(
+        movie,
+        grid_key,
+        st.session_state["user"],
+        movie_operations,
+        poster_store,
+        watchlist,
+    )
+
 
 st.title("Cinematch: Your Movie Mood Matcher :popcorn:")
 st.markdown("---")
@@ -33,23 +85,68 @@ It leverages the power of AI to provide personalized movie recommendations based
 sidebar = st.sidebar
 
 # Sidebar for user login
-with sidebar:
+with sidebar, metrics.span("home.sidebar"):
     if st.session_state["username"] != "":
         st.subheader(f"Welcome, {st.session_state['username']}! :wave:")
         if st.button("Logout"):
             st.session_state["username"] = ""
+            st.session_state["user"] = None
+            st.session_state["watchlist_cursors"] = [None]
+            watchlist.reset()
+            # The next user of this browser session starts on a fresh assistant thread
+            openai_bot.close()
+            del st.session_state["openai_bot"]
+            # Render the page logged out, without the user's watch-list and recommendations
+            st.rerun()
 
         st.header("Your Watch-list 🎬")
-        wishlist = movie_operations.get_movies_for_user(st.session_state["user"].id)
+        # Cursors of the watch-list pages visited so far, the last one is shown
+        if "watchlist_cursors" not in st.session_state:
+            st.session_state["watchlist_cursors"] = [None]
+        watchlist_cursors = st.session_state["watchlist_cursors"]
+        # The pages of the watch-list are memoized in the session until it changes
+        wishlist, next_cursor = watchlist.page(
+            st.session_state["user"].id,
+            movie_operations,
+            after_id=watchlist_cursors[-1],
+        )
+        # The details of the whole page come from the local catalogue in one lookup
+        details = movie_database.lookup_movies([movie.tmdb_id for movie in wishlist])
+        async_manager.prefetch_posters([movie.image for movie in wishlist])
         for movie in wishlist:
             st.markdown("---")
-            st.image(f"https://image.tmdb.org/t/p/w500{movie.image}", width=80)
+            st.image(poster_store.poster(movie.image, 80), width=80)
             st.markdown(f"**{movie.title}**")
+            if movie.tmdb_id in details:
+                detail = details[movie.tmdb_id]
+                facts = [
+                    f"⭐ {detail.vote_average}",
+                    (detail.release_date or "")[:4],
+                    ", ".join(movie_database.genre_names(detail.genre_ids)),
+                ]
+                st.caption(" · ".join(fact for fact in facts if fact))
             if st.button("Remove ❌", key=f"delete_{movie.id}"):
                 movie_operations.delete_movie_by_id(
                     st.session_state["user"].id, movie.id
                 )
+                watchlist.discard([movie.tmdb_id])
                 st.success(f"**{movie.title}** has been removed from your watch-list.")
+
+        previous_column, next_column = st.columns(2)
+        if len(watchlist_cursors) > 1 and previous_column.button("◀ Previous"):
+            watchlist_cursors.pop()
+            st.rerun()
+        if next_cursor is not None and next_column.button("Next ▶"):
+            watchlist_cursors.append(next_cursor)
+            st.rerun()
+
+        if wishlist and st.button("Clear my watch-list 🗑️"):
+            removed = movie_operations.clear_movies_for_user(
+                st.session_state["user"].id
+            )
+            st.session_state["watchlist_cursors"] = [None]
+            watchlist.reset()
+            st.success(f"{removed} movies have been removed from your watch-list.")
     else:
         if "show_form" not in st.session_state:
             st.session_state["show_form"] = "login"
@@ -106,8 +203,9 @@ with sidebar:
 # User input for movie preferences
 st.header("Help us help you find your next movie :tv:")
 
-available_movie_genres = movie_database.get_movie_genres()
-list_of_genres = [genre.name for genre in available_movie_genres.genres]
+with metrics.span("home.genres"):
+    available_movie_genres = warmup.genres().value
+    list_of_genres = [genre.name for genre in available_movie_genres.genres]
 
 with st.form(key="movie_preferences_form"):
     selected_movie_genres = st.multiselect(
@@ -125,122 +223,142 @@ with st.form(key="movie_preferences_form"):
 
     submit_button = st.form_submit_button("Find my movie match! :heart:")
 
-    # Button to start the recommendation process
-if submit_button:
-    # get keywords and query from the openai bot
-    message = f"{[selected_movie_genres]} + {[user_movie_preference]} + {[str(movie_rating_range[0]), str(movie_rating_range[1])]}"
-    query = openai_bot.send_message(message)
-    # print("query: ", query)
-
-    if openai_bot.isCompleted():
-        # print("completed: ")
-        _response: MessageItem = openai_bot.get_lastest_response()
-        # print("response: ", _response.content)
-        content = _response.content.strip("`").replace("json", "").strip()
-
-        params = json.loads(content)
-        # st.markdown(params)
-
-        movies = movie_database.discover_movies_with_params(params)
-        # print("movies: ", movies)
-
-        # Store the search results in the session state
-        st.session_state["search_results"] = movies.results
-
-        if "search_results" in st.session_state:
-            for movie in st.session_state["search_results"]:
-                st.markdown(f"<div >", unsafe_allow_html=True)
-
-                # Display movie poster
-                st.image(
-                    f"https://image.tmdb.org/t/p/w500{movie.poster_path}", width=340
-                )  # Adjust the width as needed
-
-                # Display movie title
-                st.markdown(
-                    f"<div style='font-size: 20px; font-weight: bold; overflow: hidden; text-overflow: ellipsis'>{movie.title}</div>",
-                    unsafe_allow_html=True,
-                )
+# The same preferences give the same results, which are kept in the session state
+search_key = query_hash(
+    {
+        "genres": sorted(selected_movie_genres),
+        "preference": " ".join(user_movie_preference.lower().split()),
+        "rating_range": list(movie_rating_range),
+    }
+)
 
-                # Display movie details
-                st.markdown(
-                    f"<div style='color: #f4a261; font-size: 16px; margin-top: 8px; margin-bottom: 4px'>Rating: <b>{movie.vote_average}</b></div>",
-                    unsafe_allow_html=True,
+# Button to start the recommendation process
+if submit_button and result_store.get(search_key) is not None:
+    result_store.activate("search", search_key)
+elif submit_button:
+    # Reuse the params of an equivalent earlier request before asking the openai bot
+    with metrics.span("home.params_cache"):
+        params = params_cache.get(
+            selected_movie_genres, user_movie_preference, movie_rating_range
+        )
+
+    if params is None:
+        # get keywords and query from the openai bot
+        message = f"{[selected_movie_genres]} + {[user_movie_preference]} + {[str(movie_rating_range[0]), str(movie_rating_range[1])]}"
+        # Sessions sending the same message at the same time share one assistant run
+        with metrics.span("home.assistant"):
+            try:
+                _response: Optional[MessageItem] = openai_bot.ask(message)
+            except (RunFailedError, RunTimeoutError) as e:
+                _response = None
+                st.error(f"Sorry, we couldn't find your movie match right now: {e}")
+
+        if _response is not None:
+            # print("response: ", _response.content)
+            content = _response.content.strip("`").replace("json", "").strip()
+
+            with metrics.span("home.parse_params"):
+                params = json.loads(content)
+            # st.markdown(params)
+
+    if params is not None:
+        # Stream the search results page by page and keep them in the session state
+        # The rating range and genres are only given to the assistant as text, so they are
+        # also applied locally to each streamed page of results
+        selected_genre_ids = [
+            genre.id
+            for genre in available_movie_genres.genres
+            if genre.name in selected_movie_genres
+        ]
+        result_frames = []
+        with metrics.span("home.search_results"):
+            progress = st.empty()
+            found = 0
+            for frame in MovieFrame.batches(async_manager.iter_discover_movies(params)):
+                frame = frame.filter(
+                    min_rating=movie_rating_range[0],
+                    max_rating=movie_rating_range[1],
+                    genre_ids=selected_genre_ids,
                 )
-                st.write(movie.release_date)
-
-                if st.button(
-                    "Add to my Watch-list! :popcorn:",
-                    key=f"watchlist_button_{movie.title}",
-                ):
-                    if (
-                        "user" in st.session_state
-                        and st.session_state["user"] is not None
-                    ):
-                        movie_operations.add_movie_for_user(
-                            st.session_state["user"].id, movie.title, movie.poster_path
-                        )
-                        st.success(
-                            f"**{movie.title}** is on your watch-list! :partying_face:"
-                        )
-                        st.balloons()
-                    else:
-                        st.error(
-                            "You must be logged in to add movies to your watchlist."
-                        )
+                result_frames.append(frame)
+                found += len(frame)
+                progress.caption(f"Found {found} movies so far...")
+            progress.empty()
+
+        # Keep the search results in the session state, best rated first
+        search_results = MovieFrame.concat(result_frames).dedupe().rank().to_movies()
+
+        # Only params that produced results are remembered
+        if search_results:
+            params_cache.set(
+                selected_movie_genres, user_movie_preference, movie_rating_range, params
+            )
+            result_store.put(search_key, search_results)
+            result_store.activate("search", search_key)
+        else:
+            st.info("No movies match your preferences, try a wider rating range.")
+
+# Only the visible page of the results is rendered, clicks on a card rerun only that card
+search_results = result_store.active("search")
+if search_results is not None:
+    st.subheader(f"Your movie matches ({len(search_results)}) :dart:")
+    render_grid(
+        search_results,
+        "search",
+        render_card,
+        prefetch=async_manager.prefetch_posters,
+    )
 
 
 st.markdown("---")
 
-# Get the movies from the API
-movies = movie_database.discover_movies()
+# Recommend movies like the user's watch-list from local data, without the assistant or TMDB
+if st.session_state["user"] is not None:
+    with metrics.span("home.recommender"):
+        recommender = get_recommender()
+        # Only the records stored since the last rerun are indexed
+        recommender.update_from_catalogue(movie_database.catalogue)
+        recommended = recommender.recommend_for_movies(
+            sorted(watchlist.load(st.session_state["user"].id, movie_operations)), k=6
+        )
+        movies = movie_database.catalogue.get_many(
+            [tmdb_id for tmdb_id, _ in recommended]
+        )
+        if movies:
+            async_manager.prefetch_posters(
+                [movie["poster_path"] for movie in movies.values()]
+            )
+            st.header("More like your watch-list :sparkles:")
+            cols = st.columns(3)
+            for position, movie in enumerate(movies.values()):
+                with cols[position % 3]:
+                    st.image(poster_store.poster(movie["poster_path"], 200), width=200)
+                    st.markdown(f"**{movie['title']}**")
+                    st.write(f"Rating: {movie['vote_average']}")
+            st.markdown("---")
 
-st.header("Here are some movies you might fancy :film_projector:")
+# Get the prefetched discover movies, ranked once per snapshot, best rated first
+discover_snapshot = warmup.discover()
+discover_key = query_hash({"discover": discover_snapshot.fetched_at})
+discover_results = result_store.get(discover_key)
+if discover_results is None:
+    discover_results = result_store.put(
+        discover_key,
+        MovieFrame.from_response(discover_snapshot.value).rank().to_movies(),
+    )
+result_store.activate("discover", discover_key)
 
-# Display each movie in a grid
-for i in range(
-    0, len(movies.results), 2
-):  # Adjust the step size to change the number of columns
-    cols = st.columns(2)  # Adjust the number of columns as needed
-
-    for j in range(2):  # Adjust the range to match the number of columns
-        if i + j < len(movies.results):
-            movie = movies.results[i + j]
-            with cols[j]:
-                st.markdown(f"<div >", unsafe_allow_html=True)
-
-                # Display movie poster
-                st.image(
-                    f"https://image.tmdb.org/t/p/w500{movie.poster_path}", width=340
-                )  # Adjust the width as needed
-
-                # Display movie title
-                st.markdown(
-                    f"<div style='font-size: 20px; font-weight: bold; overflow: hidden; text-overflow: ellipsis'>{movie.title}</div>",
-                    unsafe_allow_html=True,
-                )
+st.header("Here are some movies you might fancy :film_projector:")
+st.caption(f"Updated {int(discover_snapshot.age() // 60)} minutes ago")
+
+# Display the visible page of the movies in a grid
+with metrics.span("home.discover_grid"):
+    render_grid(
+        discover_results,
+        "discover",
+        render_card,
+        prefetch=async_manager.prefetch_posters,
+    )
 
-                # Display movie details
-                st.markdown(
-                    f"<div style='color: #f4a261; font-size: 16px; margin-top: 8px; margin-bottom: 4px'>Rating: <b>{movie.vote_average}</b></div>",
-                    unsafe_allow_html=True,
-                )
-                st.write(movie.release_date)
-                # st.markdown(f"<div style='color: #808080; font-size: 16px;'>{movie.overview}</div>", unsafe_allow_html=True)
-
-                if st.button(
-                    "Add to my Watch-list! :popcorn:",
-                    key=f"watchlist_button_{movie.id}",
-                ):
-                    if st.session_state["user"] is not None:
-                        movie_operations.add_movie_for_user(
-                            st.session_state["user"].id, movie.title, movie.poster_path
-                        )
-                        st.success(
-                            f"**{movie.title}** is on your watch-list! :partying_face:"
-                        )
-                        st.balloons()
-                    else:
-                        st.error(
-                            "You must be logged in to add movies to your watchlist."
-                        )
+if metrics.enabled:
+    metrics.record("home.rerun", time.perf_counter() - rerun_started)
@@ -0,0 +1,386 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+
+import streamlit as st
+from sqlalchemy import delete, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from db import (
+    Base,
+    MovieEntity,
+    PasswordHasher,
+    UserBase,
+    UserEntity,
+    UserRecord,
+    WATCHLIST_COLUMNS,
+    WatchlistMovie,
+    database_url,
+    get_password_hasher,
+    migrate_connection,
+    movie_insert_statement,
+    pool_metrics,
+    watchlist_rows,
+)
+from metrics import trace_methods
+
+# Async driver of each database backend
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+# Async engines are bound to the event loop their connections were opened on. The engines of a
+# loop and their schema tasks and session factories are released once the loop is closed.
+_engines: Dict[asyncio.AbstractEventLoop, Dict[str, AsyncEngine]] = {}
+_schema_tasks: Dict[AsyncEngine, "asyncio.Task[None]"] = {}
+_session_factories: Dict[AsyncEngine, async_sessionmaker] = {}
+
+
+def async_database_url(url: Optional[str] = None) -> str:
+    """
+    This function turns the database url of the secrets into the url of its async driver, e.g.
+    postgresql:// into postgresql+asyncpg://.
+    """
+    url = make_url(url or database_url())
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()]).render_as_string(
+        hide_password=False
+    )
+
+
+async def create_async_database_connection(
+    pool_size: Optional[int] = None,
+    max_overflow: Optional[int] = None,
+    pool_pre_ping: Optional[bool] = None,
+    pool_recycle: Optional[int] = None,
+) -> AsyncEngine:
+    """
+    This function returns the async engine of the running event loop for the database configured
+    in the secrets. Like `create_database_connection`, the engine and the schema are created once,
+    on the first call, with the same pool settings.
+    """
+    url = async_database_url()
+    release_closed_loops()
+    engines = _engines.setdefault(asyncio.get_running_loop(), {})
+    engine = engines.get(url)
+    if engine is None:
+        engine = create_async_engine(
+            url,
+            pool_size=(
+                pool_size
+                if pool_size is not None
+                else int(st.secrets.get("DATABASE_POOL_SIZE", 5))
+            ),
+            max_overflow=(
+                max_overflow
+                if max_overflow is not None
+                else int(st.secrets.get("DATABASE_MAX_OVERFLOW", 10))
+            ),
+            pool_pre_ping=(
+                pool_pre_ping
+                if pool_pre_ping is not None
+                else bool(st.secrets.get("DATABASE_POOL_PRE_PING", True))
+            ),
+            pool_recycle=(
+                pool_recycle
+                if pool_recycle is not None
+                else int(st.secrets.get("DATABASE_POOL_RECYCLE", 1800))
+            ),
+        )
+        engines[url] = engine
+    await init_schema_async(engine)
+    return engine
+
+
+def release_closed_loops() -> int:
+    """
+    This function drops the engines of the event loops that have been closed, with their schema
+    tasks and session factories, so their pools can be garbage collected. Their connections died
+    with their loop. It returns the number of engines released.
+    """
+    released = 0
+    for loop in [loop for loop in _engines if loop.is_closed()]:
+        for engine in _engines.pop(loop).values():
+            _schema_tasks.pop(engine, None)
+            _session_factories.pop(engine, None)
+            released += 1
+    return released
+
+
+async def init_schema_async(engine: AsyncEngine) -> None:
+    """
+    This function creates the missing tables and migrates an older schema, once per engine.
+    Concurrent callers wait for the same run.
+    """
+    task = _schema_tasks.get(engine)
+    if task is None:
+
+        async def init() -> None:
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+                await connection.run_sync(migrate_connection)
+
+        task = _schema_tasks[engine] = asyncio.ensure_future(init())
+    try:
+        await asyncio.shield(task)
+    except Exception:
+        # Let the next caller try again
+        _schema_tasks.pop(engine, None)
+        raise
+
+
+def get_async_session_factory(engine: AsyncEngine) -> async_sessionmaker:
+    """
+    This function returns the session factory shared by every async operations class of an engine.
+    """
+    if engine not in _session_factories:
+        _session_factories[engine] = async_sessionmaker(engine, expire_on_commit=False)
+    return _session_factories[engine]
+
+
+@asynccontextmanager
+async def async_session_scope(
+    session_factory: async_sessionmaker,
+) -> AsyncIterator[AsyncSession]:
+    """
+    This context manager yields a new session, commits it on success, rolls it back on error and
+    always releases its connection back to the pool.
+    """
+    async with session_factory() as session:
+        try:
+            start = time.perf_counter()
+            await session.connection()
+            pool_metrics.record(time.perf_counter() - start, session.bind.pool)
+            yield session
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+
+
+@trace_methods
+class AsyncUserOperations:
+    """
+    This class is the async variant of UserOperations, for code running on an event loop.
+    The passwords are still hashed in the PasswordHasher process pool, awaited without blocking.
+    """
+
+    def __init__(self, engine: AsyncEngine, hasher: Optional[PasswordHasher] = None):
+        self.engine = engine
+        self.Session = get_async_session_factory(engine)
+        self.hasher = hasher or get_password_hasher()
+
+    async def register_new_user(self, user: UserBase) -> Dict[str, Any]:
+        """
+        This method registers a new user in the database.
+        """
+        async with async_session_scope(self.Session) as session:
+            existing_user = (
+                await session.execute(
+                    select(UserEntity.id).filter_by(username=user.username)
+                )
+            ).first()
+
+        # Check if the user already exists
+        if existing_user:
+            return {"status": "error", "message": "Username already exists"}
+
+        # Create a new user, the password is hashed before a session is opened
+        new_user = UserEntity(
+            username=user.username,
+            password=await self.hasher.hash_async(user.password),
+        )
+        try:
+            async with async_session_scope(self.Session) as session:
+                session.add(new_user)
+        except IntegrityError:
+            return {"status": "error", "message": "Username already exists"}
+        return {
+            "status": "success",
+            "message": "User created successfully. Please login to continue.",
+            "user": UserRecord(new_user.id, new_user.username),
+        }
+
+    async def authenticate_user(self, username: str, password: str) -> Dict[str, Any]:
+        """
+        This method authenticates a user by checking the username and password, and upgrades the
+        hash when the configured hashing method or cost has changed since it was made.
+        """
+        async with async_session_scope(self.Session) as session:
+            row = (
+                await session.execute(
+                    select(
+                        UserEntity.id, UserEntity.username, UserEntity.password
+                    ).filter_by(username=username)
+                )
+            ).first()
+
+        if row and await self.hasher.verify_async(row.password, password):
+            if self.hasher.needs_rehash(row.password):
+                new_hash = await self.hasher.hash_async(password)
+                async with async_session_scope(self.Session) as session:
+                    # Only replace the hash this login verified
+                    await session.execute(
+                        update(UserEntity)
+                        .where(
+                            UserEntity.id == row.id, UserEntity.password == row.password
+                        )
+                        .values(password=new_hash)
+                    )
+            return {
+                "status": "success",
+                "message": "Login successful",
+                "user": UserRecord(row.id, row.username),
+            }
+        return {"status": "error", "message": "Invalid username or password"}
+
+
+@trace_methods
+class AsyncMovieOperations:
+    """
+    This class is the async variant of MovieOperations, for code running on an event loop, e.g.
+    to fetch a watch-list concurrently with TMDB requests.
+    """
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+        self.Session = get_async_session_factory(engine)
+
+    async def add_movie_for_user(
+        self, user_id, title, image=None, tmdb_id=None
+    ) -> bool:
+        """
+        This method adds a movie to a user's watch-list, unless it is already on it.
+        It returns whether the movie was added.
+        """
+        async with async_session_scope(self.Session) as session:
+            if tmdb_id is None:
+                # Without a TMDB id the title is the only identity of a movie
+                existing = (
+                    await session.execute(
+                        select(MovieEntity.id).filter_by(
+                            user_id=user_id, tmdb_id=None, title=title
+                        )
+                    )
+                ).first()
+                if existing:
+                    return False
+                session.add(MovieEntity(user_id=user_id, title=title, image=image))
+                return True
+
+            statement = (
+                movie_insert_statement(self.engine.dialect.name)
+                .values(user_id=user_id, title=title, image=image, tmdb_id=tmdb_id)
+                .on_conflict_do_nothing(index_elements=["user_id", "tmdb_id"])
+            )
+            return (await session.execute(statement)).rowcount > 0
+
+    async def get_movies_for_user(
+        self, user_id, after_id=None, limit=None
+    ) -> List[WatchlistMovie]:
+        """
+        This method retrieves the movies of a user from the database, ordered by id. Pass `limit` to
+        get one page and the id of the last movie of a page as `after_id` to get the next one.
+        """
+        query = select(
+            *(getattr(MovieEntity, column) for column in WATCHLIST_COLUMNS)
+        ).filter_by(user_id=user_id)
+        if after_id is not None:
+            query = query.filter(MovieEntity.id > after_id)
+        query = query.order_by(MovieEntity.id)
+        if limit is not None:
+            query = query.limit(limit)
+        async with async_session_scope(self.Session) as session:
+            return [WatchlistMovie(*row) for row in await session.execute(query)]
+
+    async def get_tmdb_ids_for_user(self, user_id) -> Set[int]:
+        """
+        This method retrieves the TMDB ids of the movies on a user's watch-list, without loading
+        the rows.
+        """
+        query = select(MovieEntity.tmdb_id).where(
+            MovieEntity.user_id == user_id, MovieEntity.tmdb_id.isnot(None)
+        )
+        async with async_session_scope(self.Session) as session:
+            return set((await session.scalars(query)).all())
+
+    async def get_watchlist_page(
+        self, user_id, limit: int = 20, after_id=None
+    ) -> Tuple[List[WatchlistMovie], Optional[int]]:
+        """
+        This method retrieves one page of a user's watch-list and the cursor of the next page,
+        which is None on the last page.
+        """
+        movies = await self.get_movies_for_user(
+            user_id, after_id=after_id, limit=limit + 1
+        )
+        if len(movies) > limit:
+            return movies[:limit], movies[limit - 1].id
+        return movies, None
+
+    async def add_movies_for_user(
+        self, user_id, movies: Iterable[Dict[str, Any]]
+    ) -> int:
+        """
+        This method adds many movies to a user's watch-list in a single INSERT ... ON CONFLICT
+        statement. Movies without a TMDB id are skipped by title when already listed.
+        It returns the number of movies added.
+        """
+        rows, untracked = watchlist_rows(user_id, movies)
+        insert = movie_insert_statement(self.engine.dialect.name)
+        added = 0
+        async with async_session_scope(self.Session) as session:
+            if rows:
+                statement = insert.values(rows).on_conflict_do_nothing(
+                    index_elements=["user_id", "tmdb_id"]
+                )
+                added += (await session.execute(statement)).rowcount
+            if untracked:
+                # NULL ids never conflict, the titles already listed are skipped instead
+                listed = await session.execute(
+                    select(MovieEntity.title).where(
+                        MovieEntity.user_id == user_id,
+                        MovieEntity.tmdb_id.is_(None),
+                        MovieEntity.title.in_(list(untracked)),
+                    )
+                )
+                for (title,) in listed:
+                    untracked.pop(title, None)
+            if untracked:
+                statement = insert.values(list(untracked.values()))
+                added += (await session.execute(statement)).rowcount
+        return added
+
+    async def delete_movies_by_ids(self, user_id, movie_ids: Iterable[int]) -> int:
+        """
+        This method deletes many movies of a user's watch-list in a single statement. Only the
+        user's own movies are deleted. It returns the number of movies deleted.
+        """
+        movie_ids = list(set(movie_ids))
+        if not movie_ids:
+            return 0
+        statement = delete(MovieEntity).where(
+            MovieEntity.user_id == user_id, MovieEntity.id.in_(movie_ids)
+        )
+        async with async_session_scope(self.Session) as session:
+            return (await session.execute(statement)).rowcount
+
+    async def clear_movies_for_user(self, user_id) -> int:
+        """
+        This method empties a user's watch-list. It returns the number of movies deleted.
+        """
+        statement = delete(MovieEntity).where(MovieEntity.user_id == user_id)
+        async with async_session_scope(self.Session) as session:
+            return (await session.execute(statement)).rowcount
+
+    async def delete_movie_by_id(self, user_id, movie_id) -> bool:
+        """
+        This method deletes a movie of a user's watch-list by its id from the database.
+        It returns whether the movie was deleted.
+        """
+        return await self.delete_movies_by_ids(user_id, [movie_id]) > 0
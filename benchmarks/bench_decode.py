@@ -0,0 +1,88 @@
+"""
+Benchmark of decoding TMDB movie list payloads: throughput (movies/sec) and memory per movie of
+the MovieRecord fast path against the pydantic `Movie(**movie)` path.
+
+    python benchmarks/bench_decode.py --pages 500
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from tmdb_api import Movie, decode_movie_page
+
+
+def make_payload(page: int, rng: random.Random) -> bytes:
+    results = [
+        {
+            "adult": False,
+            "backdrop_path": f"/backdrop{page}_{i}.jpg",
+            "genre_ids": rng.sample([12, 14, 16, 18, 27, 28, 35, 80, 878], 2),
+            "id": page * 20 + i,
+            "original_language": "en",
+            "original_title": f"Movie {page}-{i}",
+            "overview": "A movie about things happening to people. " * 5,
+            "popularity": rng.uniform(0, 500),
+            "poster_path": f"/poster{page}_{i}.jpg",
+            "release_date": "2023-05-01",
+            "title": f"Movie {page}-{i}",
+            "video": False,
+            "vote_average": round(rng.uniform(0, 10), 1),
+            "vote_count": rng.randint(0, 20000),
+        }
+        for i in range(20)
+    ]
+    payload = {
+        "page": page,
+        "results": results,
+        "total_pages": 500,
+        "total_results": 10000,
+    }
+    return json.dumps(payload).encode("utf-8")
+
+
+def pydantic_path(raw: bytes):
+    return [Movie(**movie) for movie in json.loads(raw)["results"]]
+
+
+def record_path(raw: bytes):
+    return decode_movie_page(raw).records
+
+
+def throughput(decode, payloads) -> float:
+    start = time.perf_counter()
+    count = sum(len(decode(raw)) for raw in payloads)
+    return count / (time.perf_counter() - start)
+
+
+def memory_per_movie(decode, payloads) -> float:
+    tracemalloc.start()
+    kept = [decode(raw) for raw in payloads]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / sum(len(movies) for movies in kept)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=500)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    payloads = [make_payload(page, rng) for page in range(1, args.pages + 1)]
+
+    print(f"{'path':<12}{'movies/sec':>14}{'bytes/movie':>14}")
+    for name, decode in (("pydantic", pydantic_path), ("records", record_path)):
+        rate = throughput(decode, payloads)
+        memory = memory_per_movie(decode, payloads)
+        print(f"{name:<12}{rate:>14,.0f}{memory:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""
+Offline end-to-end benchmark. TMDB and the Assistants API are replaced by the local fake servers
+of `fake_servers.py` (with configurable latency and error injection) and the database by a SQLite
+file, then the recommendation, search, login and watch-list workloads are driven through the app's
+own classes at the given concurrency. Throughput and p50/p95/p99 latencies are reported for each
+workload, and the per-span breakdown with --spans.
+
+    python benchmarks/bench_end_to_end.py --concurrency 16 --requests 200 --latency-ms 80
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from streamlit import config as streamlit_config
+
+from fake_servers import FakeAssistants, FakeTMDB, load_recordings
+
+WORKLOADS = ("recommendation", "search", "login", "watchlist")
+
+SEARCH_KEYWORDS = [
+    "space",
+    "love",
+    "heist",
+    "dragon",
+    "detective",
+    "robot",
+    "ghost",
+    "storm",
+    "kingdom",
+    "island",
+]
+
+GENRE_CHOICES = [
+    ["Action"],
+    ["Comedy", "Romance"],
+    ["Science Fiction"],
+    ["Horror"],
+    ["Animation", "Family"],
+    ["Drama"],
+    ["Thriller", "Crime"],
+    ["Adventure", "Fantasy"],
+]
+
+PREFERENCES = [
+    "something like Interstellar",
+    "a feel-good movie for a rainy day",
+    "mind-bending plot twists",
+    "old-school kung fu",
+    "a movie to watch with my kids",
+    "dark and slow-burning",
+]
+
+
+def write_secrets(path: str, args: argparse.Namespace, tmdb_url: str, openai_url: str):
+    database_path = args.database or os.path.join(
+        os.path.dirname(path), "bench.sqlite3"
+    )
+    secrets = {
+        "tmdb_apikey": "offline",
+        "tmdb_accesstoken": "offline",
+        "tmdb_base_url": f"{tmdb_url}/3/",
+        "tmdb_max_retries": args.retries,
+        "tmdb_pool_size": args.concurrency,
+        "tmdb_pool_limit_per_host": args.concurrency,
+        "tmdb_rate_limit": args.tmdb_rate,
+        "tmdb_burst": args.tmdb_burst,
+        "OPENAI_API_KEY": "offline",
+        "openai_base_url": f"{openai_url}/v1",
+        "openai_thread_pool_size": args.concurrency * 2,
+        "DATABASE_URL": f"sqlite:///{database_path}",
+        "DATABASE_POOL_SIZE": args.concurrency,
+        "PASSWORD_HASH_METHOD": args.hash_method,
+        "metrics_enabled": args.spans,
+        "warmup_interval": 3600,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        for key, value in secrets.items():
+            f.write(f"{key} = {json.dumps(value)}\n")
+
+
+def quiet(verbose: bool):
+    # The app's debug prints would drown the report
+    if verbose:
+        return contextlib.nullcontext()
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def percentile(durations: List[float], q: float) -> float:
+    if not durations:
+        return 0.0
+    return durations[min(int(len(durations) * q), len(durations) - 1)]
+
+
+def drive(
+    operation: Callable[[random.Random], None], requests: int, concurrency: int
+) -> Tuple[List[float], List[str], float]:
+    """
+    This function runs `operation` `requests` times from `concurrency` threads and returns the
+    latency of each successful call, the errors of the failed calls and the wall time.
+    """
+    durations: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+    seeds = iter(range(requests))
+
+    def worker() -> None:
+        while True:
+            with lock:
+                seed = next(seeds, None)
+            if seed is None:
+                return
+            rng = random.Random(seed)
+            start = time.perf_counter()
+            try:
+                operation(rng)
+            except Exception as e:
+                with lock:
+                    errors.append(f"{type(e).__name__}: {e}")
+            else:
+                duration = time.perf_counter() - start
+                with lock:
+                    durations.append(duration)
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return sorted(durations), errors, time.perf_counter() - started
+
+
+def make_workloads(
+    args: argparse.Namespace,
+) -> Dict[str, Callable[[random.Random], None]]:
+    # The app modules read the secrets when they are first used, so they are imported late
+    from db import MovieOperations, UserBase, UserOperations, create_database_connection
+    from movie_frame import MovieFrame
+    from openai_api import AsyncManager, OpenAIBot, get_params_cache
+
+    engine = create_database_connection()
+    user_operations = UserOperations(engine)
+    movie_operations = MovieOperations(engine)
+    async_manager = AsyncManager()
+    params_cache = get_params_cache()
+    sessions = threading.local()
+
+    usernames = [f"bench{i:04d}" for i in range(args.users)]
+    passwords = {username: f"{username}-secret" for username in usernames}
+    user_ids = []
+    for username in usernames:
+        user_operations.register_new_user(
+            UserBase(username=username, password=passwords[username])
+        )
+        user_ids.append(
+            user_operations.authenticate_user(username, passwords[username])["user"].id
+        )
+
+    def recommendation(rng: random.Random) -> None:
+        # The same steps as a submit of the preferences form in Home.py
+        genres = rng.choice(GENRE_CHOICES)
+        preference = rng.choice(PREFERENCES)
+        rating_range = (rng.choice([0.0, 5.0, 6.5]), 10.0)
+        params = params_cache.get(genres, preference, rating_range)
+        if params is None:
+            if not hasattr(sessions, "bot"):
+                sessions.bot = OpenAIBot()
+            message = f"{[genres]} + {[preference]} + {[str(rating_range[0]), str(rating_range[1])]}"
+            response = sessions.bot.ask(message)
+            params = json.loads(response.content.strip("`").replace("json", "").strip())
+        frames = [
+            frame.filter(min_rating=rating_range[0], max_rating=rating_range[1])
+            for frame in MovieFrame.batches(
+                async_manager.iter_discover_movies(params, max_pages=args.pages)
+            )
+        ]
+        if MovieFrame.concat(frames).dedupe().rank().to_movies():
+            params_cache.set(genres, preference, rating_range, params)
+
+    def search(rng: random.Random) -> None:
+        keywords = rng.sample(SEARCH_KEYWORDS, 3)
+        async_manager.search_movies_by_keywords(keywords)
+
+    def login(rng: random.Random) -> None:
+        username = rng.choice(usernames)
+        response = user_operations.authenticate_user(username, passwords[username])
+        if response["status"] != "success":
+            raise RuntimeError(response["message"])
+
+    def watchlist(rng: random.Random) -> None:
+        user_id = rng.choice(user_ids)
+        tmdb_id = rng.randint(1, 20000)
+        movie_operations.add_movie_for_user(
+            user_id, f"Movie {tmdb_id}", f"/poster{tmdb_id}.jpg", tmdb_id=tmdb_id
+        )
+        movies, _ = movie_operations.get_watchlist_page(user_id)
+        if rng.random() < 0.3 and movies:
+            movie_operations.delete_movie_by_id(user_id, rng.choice(movies).id)
+
+    return {
+        "recommendation": recommendation,
+        "search": search,
+        "login": login,
+        "watchlist": watchlist,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workloads", default=",".join(WORKLOADS))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--run-seconds", type=float, default=1.0)
+    parser.add_argument("--run-failure-rate", type=float, default=0.0)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--tmdb-rate", type=float, default=40.0)
+    parser.add_argument("--tmdb-burst", type=float, default=20.0)
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--hash-method", default="pbkdf2:sha256:100000")
+    parser.add_argument("--database", help="SQLite file (a temporary one by default)")
+    parser.add_argument("--recordings", help="recordings file of the fake servers")
+    parser.add_argument("--spans", action="store_true", help="print the span breakdown")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's output")
+    args = parser.parse_args()
+
+    workloads = [name for name in args.workloads.split(",") if name]
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+
+    recordings = load_recordings(args.recordings) if args.recordings else None
+    upstream = dict(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+    )
+    tmdb = FakeTMDB(recordings, **upstream).start()
+    assistants = FakeAssistants(
+        recordings,
+        run_duration=args.run_seconds,
+        run_failure_rate=args.run_failure_rate,
+        **upstream,
+    ).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        secrets_path = os.path.join(directory, "secrets.toml")
+        write_secrets(secrets_path, args, tmdb.url, assistants.url)
+        streamlit_config.set_option("secrets.files", [secrets_path])
+
+        from metrics import configure_metrics
+
+        metrics = configure_metrics()
+        with quiet(args.verbose):
+            operations = make_workloads(args)
+
+        print(
+            f"{'workload':<16}{'ops':>6}{'errors':>8}{'ops/sec':>10}"
+            f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        )
+        for name in workloads:
+            with quiet(args.verbose):
+                durations, errors, elapsed = drive(
+                    operations[name], args.requests, args.concurrency
+                )
+            print(
+                f"{name:<16}{len(durations):>6}{len(errors):>8}"
+                f"{len(durations) / elapsed:>10,.1f}"
+                f"{percentile(durations, 0.5) * 1000:>10,.1f}"
+                f"{percentile(durations, 0.95) * 1000:>10,.1f}"
+                f"{percentile(durations, 0.99) * 1000:>10,.1f}"
+            )
+            for error in sorted(set(errors))[:3]:
+                print(f"  {error}")
+
+        print(
+            f"\nupstream requests: tmdb {tmdb.requests} ({tmdb.errors} injected errors), "
+            f"assistants {assistants.requests} ({assistants.errors} injected errors)"
+        )
+        from tmdb_api import get_scheduler
+
+        for priority, stats in get_scheduler().stats().items():
+            print(
+                f"tmdb {priority} requests: {stats['granted']} sent, {stats['shed']} shed, "
+                f"p95 queue wait {stats['p95_wait'] * 1000:,.1f} ms"
+            )
+        if args.spans:
+            print(
+                f"\n{'span':<44}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}"
+            )
+            for span, summary in metrics.summary().items():
+                print(
+                    f"{span:<44}{summary['count']:>8}{summary['errors']:>8}"
+                    f"{summary['p50'] * 1000:>10,.1f}{summary['p99'] * 1000:>10,.1f}"
+                )
+
+    tmdb.stop()
+    assistants.stop()
+
+
+if __name__ == "__main__":
+    main()
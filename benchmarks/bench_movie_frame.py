@@ -0,0 +1,108 @@
+"""
+Benchmark of filtering, de-duplicating and ranking a large result set: a MovieFrame against the
+same operations written as per-object Python loops over pydantic Movie objects.
+
+    python benchmarks/bench_movie_frame.py --movies 50000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from movie_frame import MovieFrame
+from tmdb_api import Movie
+
+GENRE_IDS = [28, 12, 16, 35, 80, 99, 18, 10751, 14, 36, 27, 10402, 9648, 10749, 878]
+
+
+def make_movies(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [
+        Movie(
+            adult=False,
+            genre_ids=rng.sample(GENRE_IDS, rng.randint(1, 3)),
+            # Some ids repeat, like overlapping discover pages
+            id=rng.randint(1, int(count * 0.9)),
+            original_language="en",
+            original_title="",
+            overview="",
+            popularity=rng.uniform(0, 500),
+            poster_path="/poster.jpg",
+            release_date=f"{rng.randint(1950, 2024)}-01-01",
+            title="",
+            video=False,
+            vote_average=round(rng.uniform(0, 10), 1),
+            vote_count=rng.randint(0, 20000),
+        )
+        for _ in range(count)
+    ]
+
+
+def python_loops(movies, min_rating, max_rating, genre_ids, prior_votes):
+    seen = set()
+    kept = []
+    for movie in movies:
+        if movie.id in seen:
+            continue
+        seen.add(movie.id)
+        if not min_rating <= movie.vote_average <= max_rating:
+            continue
+        if not set(movie.genre_ids) & genre_ids:
+            continue
+        kept.append(movie)
+    if not kept:
+        return []
+    mean_rating = sum(m.vote_average * (m.vote_count + 1) for m in kept) / sum(
+        m.vote_count + 1 for m in kept
+    )
+    return sorted(
+        kept,
+        key=lambda m: -(m.vote_count * m.vote_average + prior_votes * mean_rating)
+        / (m.vote_count + prior_votes),
+    )
+
+
+def movie_frame(frame, min_rating, max_rating, genre_ids, prior_votes):
+    return (
+        frame.dedupe()
+        .filter(min_rating=min_rating, max_rating=max_rating, genre_ids=genre_ids)
+        .rank(popularity_weight=0.0, prior_votes=prior_votes)
+    )
+
+
+def timed(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--movies", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    movies = make_movies(args.movies)
+    query = dict(min_rating=5.0, max_rating=9.0, genre_ids={28, 878}, prior_votes=500)
+
+    build = timed(lambda: MovieFrame.from_movies(movies), args.repeat)
+    frame = MovieFrame.from_movies(movies)
+    loops = timed(lambda: python_loops(movies, **query), args.repeat)
+    vectorized = timed(lambda: movie_frame(frame, **query), args.repeat)
+
+    print(f"movies:                  {args.movies}")
+    print(f"python loops:            {loops * 1000:9.2f} ms")
+    print(f"MovieFrame build:        {build * 1000:9.2f} ms")
+    print(f"MovieFrame filter+rank:  {vectorized * 1000:9.2f} ms")
+    print(f"speed-up (excl. build):  {loops / vectorized:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
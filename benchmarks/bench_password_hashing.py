@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of the login path: reports how many password verifications per second the
+PasswordHasher process pool sustains at each hashing cost.
+
+    python benchmarks/bench_password_hashing.py --workers 2 --logins 64
+"""
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from db import PasswordHasher
+
+COST_SETTINGS = [
+    "pbkdf2:sha256:100000",
+    "pbkdf2:sha256:300000",
+    "pbkdf2:sha256:600000",
+    "scrypt:16384:8:1",
+    "scrypt:32768:8:1",
+    "scrypt:65536:8:1",
+]
+
+
+def bench(method: str, workers: int, logins: int, concurrency: int) -> float:
+    hasher = PasswordHasher(method=method, max_workers=workers)
+    password_hash = hasher.hash("correct horse battery staple")
+    try:
+        # The threads stand in for concurrent Streamlit sessions logging in
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as sessions:
+            start = time.perf_counter()
+            results = list(
+                sessions.map(
+                    lambda _: hasher.verify(
+                        password_hash, "correct horse battery staple"
+                    ),
+                    range(logins),
+                )
+            )
+            elapsed = time.perf_counter() - start
+    finally:
+        hasher.shutdown()
+    assert all(results)
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--logins", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--methods", nargs="*", default=COST_SETTINGS)
+    args = parser.parse_args()
+
+    print(f"{'method':<24}{'logins/sec':>12}")
+    for method in args.methods:
+        rate = bench(method, args.workers, args.logins, args.concurrency)
+        print(f"{method:<24}{rate:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+"""
+Local stand-ins for TMDB and the OpenAI Assistants API, used by the offline benchmarks. Both
+replay the responses in `recordings.json` (and synthesise deterministic ones for requests that
+were not recorded), after an injected latency, and fail a configurable share of the requests.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+RECORDINGS_PATH = os.path.join(os.path.dirname(__file__), "recordings.json")
+
+
+def load_recordings(path: str = RECORDINGS_PATH) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def stable_seed(*parts: Any) -> int:
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8"))
+    return int.from_bytes(digest.digest()[:8], "big")
+
+
+class FakeServer:
+    """
+    FakeServer runs an aiohttp application on its own event-loop thread, on a free local port.
+    Every request waits `latency` seconds (plus up to `jitter` seconds) and `error_rate` of them
+    are answered with `error_status`.
+    """
+
+    error_status = 503
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.latency: float = latency
+        self.jitter: float = jitter
+        self.error_rate: float = error_rate
+        self.requests: int = 0
+        self.errors: int = 0
+        self.rng = random.Random(seed)
+        self.url: Optional[str] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def routes(self) -> List[web.RouteDef]:
+        raise NotImplementedError
+
+    @web.middleware
+    async def inject(self, request: web.Request, handler) -> web.StreamResponse:
+        self.requests += 1
+        await asyncio.sleep(self.latency + self.rng.uniform(0, self.jitter))
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": "injected failure"}, status=self.error_status
+            )
+        return await handler(request)
+
+    def start(self) -> "FakeServer":
+        started = threading.Event()
+
+        def run() -> None:
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            app = web.Application(middlewares=[self.inject])
+            app.add_routes(self.routes())
+            self._runner = web.AppRunner(app, access_log=None)
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, "127.0.0.1", 0)
+            self._loop.run_until_complete(site.start())
+            port = self._runner.addresses[0][1]
+            self.url = f"http://127.0.0.1:{port}"
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(
+            target=run, name=type(self).__name__, daemon=True
+        )
+        self._thread.start()
+        started.wait(10)
+        return self
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop)
+        future.result(10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(10)
+
+
+class FakeTMDB(FakeServer):
+    """
+    FakeTMDB serves the TMDB v3 endpoints the app uses under `/3/`. Discover and search pages that
+    are not recorded are generated from the query, so the same query always gets the same page.
+    """
+
+    def __init__(
+        self,
+        recordings: Optional[Dict[str, Any]] = None,
+        total_pages: int = 50,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(**kwargs)
+        self.recordings: Dict[str, Any] = (recordings or load_recordings())["tmdb"]
+        self.total_pages: int = total_pages
+        self.genre_ids: List[int] = [
+            genre["id"] for genre in self.recordings["genre/movie/list"]["genres"]
+        ]
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.get("/3/genre/movie/list", self.genres),
+            web.get("/3/discover/movie", self.discover),
+            web.get("/3/search/movie", self.search),
+            web.get("/3/movie/changes", self.changes),
+            web.get(r"/3/movie/{movie_id:\d+}", self.details),
+        ]
+
+    def recorded(self, endpoint: str, request: web.Request) -> Optional[Any]:
+        query = sorted((k, v) for k, v in request.query.items() if k != "api_key")
+        key = endpoint + ("?" + "&".join(f"{k}={v}" for k, v in query) if query else "")
+        return self.recordings.get(key)
+
+    def make_movie(
+        self, rng: random.Random, movie_id: int, title: str
+    ) -> Dict[str, Any]:
+        return {
+            "adult": False,
+            "backdrop_path": f"/backdrop{movie_id}.jpg",
+            "genre_ids": rng.sample(self.genre_ids, 2),
+            "id": movie_id,
+            "original_language": rng.choice(["en", "en", "en", "fr", "ja", "ko"]),
+            "original_title": title,
+            "overview": f"{title} is a story about "
+            + " ".join(rng.sample(OVERVIEW_WORDS, 12)),
+            "popularity": round(rng.uniform(1, 500), 3),
+            "poster_path": f"/poster{movie_id}.jpg",
+            "release_date": f"{rng.randint(1970, 2024)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}",
+            "title": title,
+            "video": False,
+            "vote_average": round(rng.uniform(3, 9), 1),
+            "vote_count": rng.randint(0, 20000),
+        }
+
+    def make_page(self, query: Dict[str, str], title: str, total_pages: int) -> Dict:
+        page = int(query.get("page", 1))
+        rng = random.Random(stable_seed(sorted(query.items())))
+        results = []
+        for i in range(20):
+            # Ids repeat across queries, as popular movies do on TMDB
+            movie_id = rng.randint(1, 20000)
+            results.append(self.make_movie(rng, movie_id, f"{title} {movie_id}"))
+        return {
+            "page": page,
+            "results": results if page <= total_pages else [],
+            "total_pages": total_pages,
+            "total_results": total_pages * 20,
+        }
+
+    async def genres(self, request: web.Request) -> web.Response:
+        return web.json_response(self.recordings["genre/movie/list"])
+
+    async def discover(self, request: web.Request) -> web.Response:
+        data = self.recorded("discover/movie", request)
+        if data is None:
+            query = {k: v for k, v in request.query.items() if k != "api_key"}
+            data = self.make_page(query, "Movie", self.total_pages)
+        return web.json_response(data)
+
+    async def search(self, request: web.Request) -> web.Response:
+        data = self.recorded("search/movie", request)
+        if data is None:
+            query = {k: v for k, v in request.query.items() if k != "api_key"}
+            data = self.make_page(query, query.get("query", "").title(), 1)
+        return web.json_response(data)
+
+    async def changes(self, request: web.Request) -> web.Response:
+        # About one movie in a hundred changes over the requested dates
+        query = {k: v for k, v in request.query.items() if k != "api_key"}
+        page = int(query.pop("page", 1))
+        rng = random.Random(stable_seed(sorted(query.items())))
+        changed = sorted(rng.sample(range(1, 20001), 200))
+        return web.json_response(
+            {
+                "page": page,
+                "results": [
+                    {"id": movie_id, "adult": False}
+                    for movie_id in changed[(page - 1) * 100 : page * 100]
+                ],
+                "total_pages": 2,
+                "total_results": len(changed),
+            }
+        )
+
+    async def details(self, request: web.Request) -> web.Response:
+        movie_id = int(request.match_info["movie_id"])
+        rng = random.Random(stable_seed("details", movie_id))
+        movie = self.make_movie(rng, movie_id, f"Movie {movie_id}")
+        genre_ids = movie.pop("genre_ids")
+        names = {
+            genre["id"]: genre["name"]
+            for genre in self.recordings["genre/movie/list"]["genres"]
+        }
+        movie["genres"] = [{"id": i, "name": names[i]} for i in genre_ids]
+        return web.json_response(movie)
+
+
+class FakeAssistants(FakeServer):
+    """
+    FakeAssistants serves the Assistants API endpoints the app uses under `/v1/`. A run stays
+    queued, then in progress, and completes `run_duration` seconds after it was created with one
+    of the recorded assistant answers; `run_failure_rate` of the runs fail instead.
+    """
+
+    error_status = 500
+
+    def __init__(
+        self,
+        recordings: Optional[Dict[str, Any]] = None,
+        run_duration: float = 1.0,
+        run_failure_rate: float = 0.0,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(**kwargs)
+        self.answers: List[str] = (recordings or load_recordings())["assistant"]
+        self.run_duration: float = run_duration
+        self.run_failure_rate: float = run_failure_rate
+        self.threads: Dict[str, List[Dict[str, Any]]] = {}
+        self.runs: Dict[str, Dict[str, Any]] = {}
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.get("/v1/assistants/{assistant_id}", self.assistant),
+            web.post("/v1/threads", self.create_thread),
+            web.delete("/v1/threads/{thread_id}", self.delete_thread),
+            web.post("/v1/threads/{thread_id}/messages", self.create_message),
+            web.get("/v1/threads/{thread_id}/messages", self.list_messages),
+            web.post("/v1/threads/{thread_id}/runs", self.create_run),
+            web.get("/v1/threads/{thread_id}/runs/{run_id}", self.retrieve_run),
+        ]
+
+    @staticmethod
+    def message(thread_id: str, role: str, text: str) -> Dict[str, Any]:
+        return {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "role": role,
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+            "file_ids": [],
+            "attachments": [],
+            "assistant_id": None,
+            "run_id": None,
+            "metadata": {},
+        }
+
+    async def assistant(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "id": request.match_info["assistant_id"],
+                "object": "assistant",
+                "created_at": 0,
+                "name": "Cinematch",
+                "description": None,
+                "model": "gpt-3.5-turbo-1106",
+                "instructions": "",
+                "tools": [],
+                "file_ids": [],
+                "metadata": {},
+            }
+        )
+
+    async def create_thread(self, request: web.Request) -> web.Response:
+        thread_id = f"thread_{uuid.uuid4().hex}"
+        self.threads[thread_id] = []
+        return web.json_response(
+            {
+                "id": thread_id,
+                "object": "thread",
+                "created_at": int(time.time()),
+                "metadata": {},
+            }
+        )
+
+    async def delete_thread(self, request: web.Request) -> web.Response:
+        thread_id = request.match_info["thread_id"]
+        self.threads.pop(thread_id, None)
+        return web.json_response(
+            {"id": thread_id, "object": "thread.deleted", "deleted": True}
+        )
+
+    async def create_message(self, request: web.Request) -> web.Response:
+        thread_id = request.match_info["thread_id"]
+        body = await request.json()
+        message = self.message(thread_id, "user", body["content"])
+        self.threads.setdefault(thread_id, []).append(message)
+        return web.json_response(message)
+
+    async def list_messages(self, request: web.Request) -> web.Response:
+        messages = list(reversed(self.threads.get(request.match_info["thread_id"], [])))
+        return web.json_response(
+            {
+                "object": "list",
+                "data": messages,
+                "first_id": messages[0]["id"] if messages else None,
+                "last_id": messages[-1]["id"] if messages else None,
+                "has_more": False,
+            }
+        )
+
+    def run_object(self, run: Dict[str, Any]) -> Dict[str, Any]:
+        elapsed = time.time() - run["created_at"]
+        if run["status"] in ("queued", "in_progress"):
+            if elapsed >= self.run_duration:
+                run["status"] = "failed" if run["fails"] else "completed"
+                if not run["fails"]:
+                    # The answer depends on the question only, like a deterministic assistant
+                    messages = self.threads.setdefault(run["thread_id"], [])
+                    question = (
+                        messages[-1]["content"][0]["text"]
+                        if messages
+                        else {"value": ""}
+                    )
+                    answer = self.answers[
+                        stable_seed(question["value"]) % len(self.answers)
+                    ]
+                    messages.append(self.message(run["thread_id"], "assistant", answer))
+            elif elapsed >= self.run_duration / 3:
+                run["status"] = "in_progress"
+        return {
+            "id": run["id"],
+            "object": "thread.run",
+            "created_at": int(run["created_at"]),
+            "thread_id": run["thread_id"],
+            "assistant_id": run["assistant_id"],
+            "status": run["status"],
+            "model": "gpt-3.5-turbo-1106",
+            "instructions": "",
+            "tools": [],
+            "file_ids": [],
+            "metadata": {},
+            "last_error": (
+                {"code": "server_error", "message": "injected run failure"}
+                if run["status"] == "failed"
+                else None
+            ),
+            "expires_at": None,
+            "started_at": None,
+            "cancelled_at": None,
+            "failed_at": None,
+            "completed_at": None,
+            "required_action": None,
+        }
+
+    async def create_run(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        run = {
+            "id": f"run_{uuid.uuid4().hex}",
+            "thread_id": request.match_info["thread_id"],
+            "assistant_id": body["assistant_id"],
+            "created_at": time.time(),
+            "status": "queued",
+            "fails": self.rng.random() < self.run_failure_rate,
+        }
+        self.runs[run["id"]] = run
+        return web.json_response(self.run_object(run))
+
+    async def retrieve_run(self, request: web.Request) -> web.Response:
+        run = self.runs.get(request.match_info["run_id"])
+        if run is None:
+            return web.json_response({"error": "no such run"}, status=404)
+        return web.json_response(self.run_object(run))
+
+
+OVERVIEW_WORDS = [
+    "love",
+    "war",
+    "space",
+    "family",
+    "revenge",
+    "friendship",
+    "detective",
+    "robot",
+    "ghost",
+    "heist",
+    "journey",
+    "kingdom",
+    "island",
+    "secret",
+    "music",
+    "storm",
+    "city",
+    "dream",
+    "dragon",
+    "time",
+]
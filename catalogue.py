@@ -0,0 +1,265 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from movie_index import MOVIE_FIELDS
+
+# TMDB's changes feed only covers the last 14 days
+CHANGES_WINDOW = 14 * 24 * 60 * 60
+
+
+def movie_from_details(details: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    This function turns a TMDB movie details object into the shape of the movie objects of the list
+    endpoints: the genres are only given as `genre_ids`.
+    """
+    movie = {field: details.get(field) for field in MOVIE_FIELDS}
+    if movie["genre_ids"] is None:
+        movie["genre_ids"] = [genre["id"] for genre in details.get("genres") or ()]
+    return movie
+
+
+class Catalogue:
+    """
+    Catalogue is the local store of the TMDB movie records and genre list the app has seen. Every
+    record has a freshness timestamp: the last time it was known to match TMDB, either because it
+    was fetched then or because a sync of TMDB's changes feed found it unchanged.
+
+    The records are kept in SQLite (a file at `path`, otherwise in memory) and mirrored in a dict,
+    so lookups never touch the database. The ids of the records are also logged each time they are
+    stored, so consumers can follow the catalogue with `changes_since` instead of reading it all.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_age: float = CHANGES_WINDOW):
+        self.path: Optional[str] = path
+        self.max_age: float = max_age
+        self._movies: Dict[int, Dict[str, Any]] = {}
+        self._verified_at: Dict[int, float] = {}
+        self._genres: Dict[int, str] = {}
+        self._changes: List[int] = []
+        self._lock = threading.RLock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(
+            path or ":memory:", check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS movies ("
+            "id INTEGER PRIMARY KEY, data TEXT NOT NULL, verified_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS genres ("
+            "id INTEGER PRIMARY KEY, name TEXT NOT NULL, verified_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sync (name TEXT PRIMARY KEY, value REAL NOT NULL)"
+        )
+        self.load()
+
+    def load(self) -> None:
+        with self._lock:
+            for movie_id, data, verified_at in self._conn.execute(
+                "SELECT id, data, verified_at FROM movies"
+            ):
+                self._movies[movie_id] = json.loads(data)
+                self._verified_at[movie_id] = verified_at
+                self._changes.append(movie_id)
+            self._genres.update(self._conn.execute("SELECT id, name FROM genres"))
+
+    def add_movies(
+        self, movies: Iterable[Dict[str, Any]], verified_at: Optional[float] = None
+    ) -> int:
+        """
+        This method stores raw TMDB movie objects, replacing the older records of the same movies.
+        It returns the number of movies stored.
+        """
+        verified_at = time.time() if verified_at is None else verified_at
+        rows = {}
+        for movie in movies:
+            record = {field: movie.get(field) for field in MOVIE_FIELDS}
+            rows[record["id"]] = record
+        if not rows:
+            return 0
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO movies (id, data, verified_at) VALUES (?, ?, ?)",
+                [
+                    (movie_id, json.dumps(record, separators=(",", ":")), verified_at)
+                    for movie_id, record in rows.items()
+                ],
+            )
+            self._movies.update(rows)
+            self._verified_at.update(dict.fromkeys(rows, verified_at))
+            self._changes.extend(rows)
+        return len(rows)
+
+    def set_genres(
+        self, genres: Iterable[Dict[str, Any]], verified_at: Optional[float] = None
+    ) -> None:
+        verified_at = time.time() if verified_at is None else verified_at
+        names = {genre["id"]: genre["name"] for genre in genres}
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO genres (id, name, verified_at) VALUES (?, ?, ?)",
+                [(genre_id, name, verified_at) for genre_id, name in names.items()],
+            )
+            self._genres.update(names)
+
+    def get(self, movie_id: int) -> Optional[Dict[str, Any]]:
+        return self.get_many([movie_id]).get(movie_id)
+
+    def get_many(
+        self, movie_ids: Iterable[Optional[int]], max_age: Optional[float] = None
+    ) -> Dict[int, Dict[str, Any]]:
+        """
+        This method looks many movies up at once and returns the records found by id. Records older
+        than `max_age` seconds (the catalogue's `max_age` by default) are left out.
+        """
+        oldest = time.time() - (self.max_age if max_age is None else max_age)
+        with self._lock:
+            return {
+                movie_id: self._movies[movie_id]
+                for movie_id in movie_ids
+                if movie_id in self._movies and self._verified_at[movie_id] >= oldest
+            }
+
+    def verified_at(self, movie_id: int) -> Optional[float]:
+        return self._verified_at.get(movie_id)
+
+    def movies(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._movies.values())
+
+    def changes_since(self, version: int) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        This method returns the records stored since `version` (a version it returned before, 0
+        for all of them) and the current version of the catalogue.
+        """
+        with self._lock:
+            changed = dict.fromkeys(self._changes[version:])
+            return [
+                self._movies[movie_id]
+                for movie_id in changed
+                if movie_id in self._movies
+            ], len(self._changes)
+
+    def genres(self) -> Dict[int, str]:
+        with self._lock:
+            return dict(self._genres)
+
+    def genre_names(self, genre_ids: Iterable[int]) -> List[str]:
+        genres = self._genres
+        return [genres[genre_id] for genre_id in genre_ids if genre_id in genres]
+
+    @property
+    def synced_at(self) -> Optional[float]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM sync WHERE name = 'changes'"
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def sync(
+        self,
+        changed_ids: Callable[[str, str], Iterable[int]],
+        fetch_movie: Callable[[int], Optional[Dict[str, Any]]],
+        max_refresh: int = 500,
+        now: Optional[float] = None,
+    ) -> Tuple[int, int]:
+        """
+        This method brings the catalogue up to date with TMDB's changes feed. `changed_ids` returns
+        the ids of the movies changed between two dates (YYYY-MM-DD) and `fetch_movie` a fresh
+        movie object, or None when the movie is gone.
+
+        The feed is read from the day of the last sync, or from the oldest record when the catalogue
+        was never synced (at most 14 days back). The stored movies it lists are fetched again, at
+        most `max_refresh` of them; the other records known to be current at the start of the
+        window are marked as verified now. The feed has a day granularity, so records verified
+        today are not fetched again for today's changes: they keep their timestamp and are checked
+        by the next sync, which reads today again. Records that could not be checked keep their
+        timestamp and age out. It returns the numbers of refreshed and verified records.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            oldest = min(self._verified_at.values(), default=None)
+        if oldest is None:
+            # Nothing stored can be out of date
+            self._set_synced_at(now)
+            return 0, 0
+        synced_at = self.synced_at
+        start = max(oldest if synced_at is None else synced_at, now - CHANGES_WINDOW)
+        # The window starts at the beginning of that day
+        start_day = self._day_start(start)
+        today = self._day_start(now)
+        changed: Set[int] = set(
+            changed_ids(
+                datetime.fromtimestamp(start_day, timezone.utc).strftime("%Y-%m-%d"),
+                datetime.fromtimestamp(now, timezone.utc).strftime("%Y-%m-%d"),
+            )
+        )
+
+        with self._lock:
+            listed = [movie_id for movie_id in changed if movie_id in self._movies]
+            deferred = {
+                movie_id for movie_id in listed if self._verified_at[movie_id] >= today
+            }
+        stale = [movie_id for movie_id in listed if movie_id not in deferred]
+        refreshed, unchecked, gone = [], set(stale[max_refresh:]) | deferred, []
+        for movie_id in stale[:max_refresh]:
+            try:
+                movie = fetch_movie(movie_id)
+            except Exception:
+                unchecked.add(movie_id)
+                continue
+            if movie is None:
+                gone.append(movie_id)
+            else:
+                refreshed.append(movie)
+        self.add_movies(refreshed, verified_at=now)
+
+        window_start = start_day
+        with self._lock:
+            for movie_id in gone:
+                self._movies.pop(movie_id, None)
+                self._verified_at.pop(movie_id, None)
+            self._conn.executemany(
+                "DELETE FROM movies WHERE id = ?", [(movie_id,) for movie_id in gone]
+            )
+            verified = [
+                movie_id
+                for movie_id, verified_at in self._verified_at.items()
+                if window_start <= verified_at < now and movie_id not in unchecked
+            ]
+            self._conn.executemany(
+                "UPDATE movies SET verified_at = ? WHERE id = ?",
+                [(now, movie_id) for movie_id in verified],
+            )
+            self._verified_at.update(dict.fromkeys(verified, now))
+            self._set_synced_at(now)
+        return len(refreshed), len(verified)
+
+    @staticmethod
+    def _day_start(timestamp: float) -> float:
+        return (
+            datetime.fromtimestamp(timestamp, timezone.utc)
+            .replace(hour=0, minute=0, second=0, microsecond=0)
+            .timestamp()
+        )
+
+    def _set_synced_at(self, synced_at: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync (name, value) VALUES ('changes', ?)",
+                (synced_at,),
+            )
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __len__(self) -> int:
+        return len(self._movies)
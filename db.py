@@ -1,37 +1,295 @@
 import streamlit as st
+import asyncio
+import concurrent.futures
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 from sqlalchemy import create_engine, Column, Integer, String
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 from werkzeug.security import generate_password_hash, check_password_hash
-from typing import Dict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import inspect
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index, delete, inspect, select, text
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import relationship
 from pydantic import BaseModel, Field
 
+from metrics import metrics, trace_methods
+
 # Define the base class using declarative_base
 Base = declarative_base()
 
 
-def create_database_connection():
+class PoolMetrics:
+    """
+    This class records how long sessions waited to check out a connection from the pool. When the
+    app's metrics are enabled, every wait is also exported as the `db.pool.checkout_wait` span and
+    the occupancy of the pool as `db.pool.*` gauges.
+    """
+
+    def __init__(self, window: int = 1024):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits = deque(maxlen=window)
+
+    def record(self, wait: float, pool: Optional[Pool] = None):
+        with self.lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.recent_waits.append(wait)
+        if metrics.enabled:
+            metrics.record("db.pool.checkout_wait", wait)
+            if pool is not None:
+                for name, value in pool_occupancy(pool).items():
+                    metrics.set_gauge(f"db.pool.{name}", value)
+
+    def as_dict(self) -> Dict[str, float]:
+        with self.lock:
+            waits = sorted(self.recent_waits)
+            return {
+                "checkouts": self.checkouts,
+                "avg_wait": self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "p95_wait": waits[int(len(waits) * 0.95) - 1] if waits else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+
+pool_metrics = PoolMetrics()
+
+_engines: Dict[str, Engine] = {}
+_session_factories: Dict[Engine, scoped_session] = {}
+_initialized_engines = set()
+_registry_lock = threading.Lock()
+
+
+def database_url() -> str:
     """
-    This function creates a connection to the database using the credentials stored in the secrets.
+    This function builds the database url from the credentials stored in the secrets, unless a
+    complete `DATABASE_URL` (e.g. a SQLite file for the offline benchmarks) is set there.
     """
+    url = st.secrets.get("DATABASE_URL")
+    if url:
+        return url
     username = st.secrets["DATABASE_USERNAME"]
     password = st.secrets["DATABASE_PASSWORD"]
     dbname = st.secrets["DATABASE_NAME"]
     port = st.secrets["DATABASE_PORT"]
     host = st.secrets["DATABASE_HOST"]
+    return f"postgresql://{username}:{password}@{host}:{port}/{dbname}"
 
-    # Create database engine
-    engine = create_engine(
-        f"postgresql://{username}:{password}@{host}:{port}/{dbname}",
-        # echo=True,
-    )
+
+def create_database_connection(
+    pool_size: Optional[int] = None,
+    max_overflow: Optional[int] = None,
+    pool_pre_ping: Optional[bool] = None,
+    pool_recycle: Optional[int] = None,
+):
+    """
+    This function returns the process-wide engine for the database configured in the secrets.
+    The engine, its connection pool and the schema are created once, on the first call.
+    """
+    url = database_url()
+    with _registry_lock:
+        engine = _engines.get(url)
+        if engine is None:
+            engine = create_engine(
+                url,
+                pool_size=(
+                    pool_size
+                    if pool_size is not None
+                    else int(st.secrets.get("DATABASE_POOL_SIZE", 5))
+                ),
+                max_overflow=(
+                    max_overflow
+                    if max_overflow is not None
+                    else int(st.secrets.get("DATABASE_MAX_OVERFLOW", 10))
+                ),
+                pool_pre_ping=(
+                    pool_pre_ping
+                    if pool_pre_ping is not None
+                    else bool(st.secrets.get("DATABASE_POOL_PRE_PING", True))
+                ),
+                pool_recycle=(
+                    pool_recycle
+                    if pool_recycle is not None
+                    else int(st.secrets.get("DATABASE_POOL_RECYCLE", 1800))
+                ),
+                # echo=True,
+            )
+            _engines[url] = engine
+    init_schema(engine)
     return engine
 
 
+def init_schema(engine):
+    """
+    This function creates the missing tables, once per engine.
+    """
+    with _registry_lock:
+        if engine not in _initialized_engines:
+            Base.metadata.create_all(engine)
+            migrate_schema(engine)
+            _initialized_engines.add(engine)
+
+
+def migrate_schema(engine):
+    """
+    This function brings a database created by an older version of the app up to date: it adds the
+    `tmdb_id` column to `movies` and creates the missing indexes. Every step is skipped when it has
+    already been applied.
+    """
+    with engine.begin() as connection:
+        migrate_connection(connection)
+
+
+def migrate_connection(connection):
+    """
+    This function applies the steps of `migrate_schema` on an open connection, so the async engine
+    can run them through `run_sync`.
+    """
+    columns = {column["name"] for column in inspect(connection).get_columns("movies")}
+    if "tmdb_id" not in columns:
+        # The older rows get their ids from `MovieOperations.backfill_tmdb_ids`
+        connection.execute(text("ALTER TABLE movies ADD COLUMN tmdb_id INTEGER"))
+    for index in MovieEntity.__table__.indexes:
+        index.create(bind=connection, checkfirst=True)
+
+
+def get_session_factory(engine) -> scoped_session:
+    """
+    This function returns the scoped session factory shared by every operations class of an engine.
+    """
+    init_schema(engine)
+    with _registry_lock:
+        if engine not in _session_factories:
+            _session_factories[engine] = scoped_session(
+                sessionmaker(bind=engine, expire_on_commit=False)
+            )
+        return _session_factories[engine]
+
+
+@contextmanager
+def session_scope(session_factory: scoped_session) -> Iterator[Session]:
+    """
+    This context manager yields the thread's session, commits it on success, rolls it back on error
+    and always releases its connection back to the pool.
+    """
+    session = session_factory()
+    try:
+        start = time.perf_counter()
+        session.connection()
+        pool_metrics.record(time.perf_counter() - start, session.get_bind().pool)
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session_factory.remove()
+
+
+def pool_occupancy(pool: Pool) -> Dict[str, int]:
+    occupancy = {}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        # Only QueuePool (the default for Postgres) reports its occupancy
+        if callable(getattr(pool, name, None)):
+            occupancy[name] = getattr(pool, name)()
+    return occupancy
+
+
+def pool_status(engine) -> Dict[str, float]:
+    """
+    This function reports the pool occupancy of an engine together with the checkout wait times.
+    """
+    return {**pool_metrics.as_dict(), **pool_occupancy(engine.pool)}
+
+
+# Default werkzeug hashing method, see `generate_password_hash` for the available ones
+DEFAULT_PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+
+_password_hasher = None
+
+
+def get_password_hasher():
+    """
+    This function returns the process-wide PasswordHasher configured in the secrets.
+    """
+    global _password_hasher
+    with _registry_lock:
+        if _password_hasher is None:
+            _password_hasher = PasswordHasher(
+                method=st.secrets.get(
+                    "PASSWORD_HASH_METHOD", DEFAULT_PASSWORD_HASH_METHOD
+                ),
+                max_workers=int(st.secrets.get("PASSWORD_HASH_WORKERS", 2)),
+            )
+        return _password_hasher
+
+
+class PasswordHasher:
+    """
+    This class hashes and verifies passwords in a bounded process pool, so the CPU-bound work does
+    not hold the GIL of the thread serving the Streamlit script. The `method` sets the algorithm and
+    its cost, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000".
+    """
+
+    def __init__(
+        self, method: str = DEFAULT_PASSWORD_HASH_METHOD, max_workers: int = 2
+    ):
+        self.method = method
+        self.max_workers = max_workers
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+        # werkzeug fills in the default parameters of the method in the hashes it generates
+        self.hash_prefix = self.hash("").split("$", 1)[0]
+
+    def hash(self, password: str) -> str:
+        return self.executor.submit(
+            generate_password_hash, password, self.method
+        ).result()
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self.executor.submit(
+            check_password_hash, password_hash, password
+        ).result()
+
+    async def hash_async(self, password: str) -> str:
+        return await asyncio.wrap_future(
+            self.executor.submit(generate_password_hash, password, self.method)
+        )
+
+    async def verify_async(self, password_hash: str, password: str) -> bool:
+        return await asyncio.wrap_future(
+            self.executor.submit(check_password_hash, password_hash, password)
+        )
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """
+        This method tells whether a hash was made with a different algorithm or cost.
+        """
+        return password_hash.split("$", 1)[0] != self.hash_prefix
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
 class UserBase(BaseModel):
     """
     This Pydantic model represents the common attributes of a User.
@@ -47,6 +305,31 @@ class UserBase(BaseModel):
     )
 
 
+class UserRecord(NamedTuple):
+    """
+    This immutable record is the logged-in user as the app keeps it in the session state, detached
+    from any database session.
+    """
+
+    id: int
+    username: str
+
+
+class WatchlistMovie(NamedTuple):
+    """
+    This immutable record is a movie of a user's watch-list with the fields the pages render.
+    """
+
+    id: int
+    title: str
+    image: Optional[str]
+    tmdb_id: Optional[int]
+
+
+# Columns of MovieEntity loaded into a WatchlistMovie, in its field order
+WATCHLIST_COLUMNS = ("id", "title", "image", "tmdb_id")
+
+
 class UserEntity(Base):  # type: ignore
     """
     This class represents the User entity in the database.
@@ -63,77 +346,86 @@ class UserEntity(Base):  # type: ignore
     password = Column(String, nullable=False)
     movies = relationship("MovieEntity", backref="user")
 
-    def set_password(self, password):
+    def set_password(self, password, hasher: Optional[PasswordHasher] = None):
         """
         This method hashes the password and stores it in the password field.
         """
-        self.password = generate_password_hash(password)
+        self.password = (hasher or get_password_hasher()).hash(password)
 
-    def check_password(self, password):
+    def check_password(self, password, hasher: Optional[PasswordHasher] = None):
         """
         This method checks if the provided password matches the hashed password stored in the database.
         """
-        return check_password_hash(self.password, password)
+        return (hasher or get_password_hasher()).verify(self.password, password)
 
 
+@trace_methods
 class UserOperations:
     """
     This class handles operations related to the User entity.
     """
 
-    def __init__(self, engine):
+    def __init__(self, engine, hasher: Optional[PasswordHasher] = None):
         self.engine = engine
-        self.Session = sessionmaker(bind=self.engine)
-        if not inspect(self.engine).has_table("users"):
-            Base.metadata.create_all(self.engine)
+        self.Session = get_session_factory(self.engine)
+        self.hasher = hasher or get_password_hasher()
 
     def register_new_user(self, user: UserBase):
         """
         This method registers a new user in the database.
         """
-        session = self.Session()
-
-        existing_user = (
-            session.query(UserEntity).filter_by(username=user.username).first()
-        )
+        with session_scope(self.Session) as session:
+            existing_user = (
+                session.query(UserEntity.id).filter_by(username=user.username).first()
+            )
 
         # Check if the user already exists
         if existing_user:
-            session.close()
             return {"status": "error", "message": "Username already exists"}
 
-        # Create a new user
+        # Create a new user, the password is hashed before a session is opened
+        new_user = UserEntity(username=user.username)
+        new_user.set_password(user.password, self.hasher)
         try:
-            new_user = UserEntity(username=user.username)
-            new_user.set_password(user.password)
-            session.add(new_user)
-            session.commit()
-            session.close()
-            return {
-                "status": "success",
-                "message": "User created successfully. Please login to continue.",
-                "user": new_user,
-            }
+            with session_scope(self.Session) as session:
+                session.add(new_user)
         except IntegrityError:
-            session.rollback()
             return {"status": "error", "message": "Username already exists"}
-        finally:
-            session.close()
+        return {
+            "status": "success",
+            "message": "User created successfully. Please login to continue.",
+            "user": UserRecord(new_user.id, new_user.username),
+        }
 
     def authenticate_user(self, username, password):
         """
-        This method authenticates a user by checking the username and password.
+        This method authenticates a user by checking the username and password. The session is
+        released before the password is verified, and the hash is upgraded when the configured
+        hashing method or cost has changed since it was made.
         """
-        session = self.Session()
-        user = session.query(UserEntity).filter_by(username=username).first()
+        with session_scope(self.Session) as session:
+            row = (
+                session.query(UserEntity.id, UserEntity.username, UserEntity.password)
+                .filter_by(username=username)
+                .first()
+            )
 
         # Check if the user exists and the password is correct
-        if user and user.check_password(password):
-            session.close()
-            # print("Login successful", user.id)
-            return {"status": "success", "message": "Login successful", "user": user}
+        if row and self.hasher.verify(row.password, password):
+            if self.hasher.needs_rehash(row.password):
+                new_hash = self.hasher.hash(password)
+                with session_scope(self.Session) as session:
+                    # Only replace the hash this login verified
+                    session.query(UserEntity).filter_by(
+                        id=row.id, password=row.password
+                    ).update({"password": new_hash})
+            # print("Login successful", row.id)
+            return {
+                "status": "success",
+                "message": "Login successful",
+                "user": UserRecord(row.id, row.username),
+            }
         else:
-            session.close()
             return {"status": "error", "message": "Invalid username or password"}
 
 
@@ -150,8 +442,51 @@ class MovieEntity(Base):  # type: ignore
     user_id = Column(
         Integer, ForeignKey("users.id"), nullable=False
     )  # Add ForeignKey here
+    tmdb_id = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        # A user can have each TMDB movie on their watch-list only once
+        Index("uq_movies_user_id_tmdb_id", "user_id", "tmdb_id", unique=True),
+        # Serves the keyset pagination of a user's watch-list
+        Index("ix_movies_user_id_id", "user_id", "id"),
+    )
 
 
+def movie_insert_statement(dialect: str):
+    """
+    This function returns the dialect's INSERT of MovieEntity, which supports ON CONFLICT.
+    """
+    if dialect == "postgresql":
+        return postgresql.insert(MovieEntity)
+    if dialect == "sqlite":
+        return sqlite.insert(MovieEntity)
+    raise NotImplementedError(f"Upserts are not supported on {dialect}")
+
+
+def watchlist_rows(
+    user_id, movies: Iterable[Dict[str, Any]]
+) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """
+    This function turns movies into watch-list rows, de-duplicated by TMDB id. Movies without a TMDB
+    id are returned apart, de-duplicated and keyed by title, which is their only identity.
+    """
+    rows: Dict[int, Dict[str, Any]] = {}
+    untracked: Dict[str, Dict[str, Any]] = {}
+    for movie in movies:
+        row = {
+            "user_id": user_id,
+            "title": movie["title"],
+            "image": movie.get("image"),
+            "tmdb_id": movie.get("tmdb_id"),
+        }
+        if row["tmdb_id"] is None:
+            untracked.setdefault(row["title"], row)
+        else:
+            rows[row["tmdb_id"]] = row
+    return list(rows.values()), untracked
+
+
+@trace_methods
 class MovieOperations:
     """
     This class handles operations related to the Movie entity.
@@ -159,36 +494,177 @@ class MovieOperations:
 
     def __init__(self, engine):
         self.engine = engine
-        self.Session = sessionmaker(bind=self.engine)
-        if not inspect(self.engine).has_table("movies"):
-            Base.metadata.create_all(self.engine)
+        self.Session = get_session_factory(self.engine)
 
-    def add_movie_for_user(self, user_id, title, image=None):
+    def insert_statement(self):
+        return movie_insert_statement(self.engine.dialect.name)
+
+    def add_movie_for_user(self, user_id, title, image=None, tmdb_id=None) -> bool:
         """
-        This method adds a new movie for a user in the database.
+        This method adds a movie to a user's watch-list, unless it is already on it.
+        It returns whether the movie was added.
         """
-        session = self.Session()
-        movie = MovieEntity(user_id=user_id, title=title, image=image)
-        session.add(movie)
-        session.commit()
-        session.close()
+        with session_scope(self.Session) as session:
+            if tmdb_id is None:
+                # Without a TMDB id the title is the only identity of a movie
+                existing = (
+                    session.query(MovieEntity.id)
+                    .filter_by(user_id=user_id, tmdb_id=None, title=title)
+                    .first()
+                )
+                if existing:
+                    return False
+                session.add(MovieEntity(user_id=user_id, title=title, image=image))
+                return True
+
+            statement = (
+                self.insert_statement()
+                .values(user_id=user_id, title=title, image=image, tmdb_id=tmdb_id)
+                .on_conflict_do_nothing(index_elements=["user_id", "tmdb_id"])
+            )
+            return session.execute(statement).rowcount > 0
+
+    def get_movies_for_user(
+        self, user_id, after_id=None, limit=None
+    ) -> List[WatchlistMovie]:
+        """
+        This method retrieves the movies of a user from the database, ordered by id. Pass `limit` to
+        get one page and the id of the last movie of a page as `after_id` to get the next one.
+        Only the columns of WatchlistMovie are loaded, no ORM entity is created.
+        """
+        with session_scope(self.Session) as session:
+            query = session.query(
+                *(getattr(MovieEntity, column) for column in WATCHLIST_COLUMNS)
+            ).filter_by(user_id=user_id)
+            if after_id is not None:
+                query = query.filter(MovieEntity.id > after_id)
+            query = query.order_by(MovieEntity.id)
+            if limit is not None:
+                query = query.limit(limit)
+            return [WatchlistMovie(*row) for row in query.all()]
+
+    def get_tmdb_ids_for_user(self, user_id) -> Set[int]:
+        """
+        This method retrieves the TMDB ids of the movies on a user's watch-list, without loading
+        the rows.
+        """
+        with session_scope(self.Session) as session:
+            return {
+                tmdb_id
+                for (tmdb_id,) in session.query(MovieEntity.tmdb_id).filter(
+                    MovieEntity.user_id == user_id, MovieEntity.tmdb_id.isnot(None)
+                )
+            }
+
+    def get_watchlist_page(
+        self, user_id, limit: int = 20, after_id=None
+    ) -> Tuple[List[WatchlistMovie], Optional[int]]:
+        """
+        This method retrieves one page of a user's watch-list and the cursor of the next page,
+        which is None on the last page.
+        """
+        movies = self.get_movies_for_user(user_id, after_id=after_id, limit=limit + 1)
+        if len(movies) > limit:
+            return movies[:limit], movies[limit - 1].id
+        return movies, None
+
+    def backfill_tmdb_ids(
+        self, resolve: Callable[[str, Optional[str]], Optional[int]]
+    ) -> int:
+        """
+        This method fills in the TMDB id of the rows added before the id was stored, using `resolve`
+        to look a title and poster path up. Rows `resolve` cannot tell apart keep no id, and so
+        does a row whose id is already on the user's watch-list rather than being deleted, as a
+        title alone does not tell a remake from the original.
+        It returns the number of rows updated.
+        """
+        with session_scope(self.Session) as session:
+            movies = set(
+                session.query(MovieEntity.title, MovieEntity.image)
+                .filter_by(tmdb_id=None)
+                .distinct()
+            )
+        # TMDB is asked without holding a pooled connection
+        resolved = {(title, image): resolve(title, image) for title, image in movies}
+        updated = 0
+        with session_scope(self.Session) as session:
+            rows = (
+                session.query(MovieEntity)
+                .filter_by(tmdb_id=None)
+                .order_by(MovieEntity.id)
+                .all()
+            )
+            for row in rows:
+                tmdb_id = resolved.get((row.title, row.image))
+                if tmdb_id is None:
+                    continue
+                duplicate = session.execute(
+                    select(MovieEntity.id).filter_by(
+                        user_id=row.user_id, tmdb_id=tmdb_id
+                    )
+                ).first()
+                if not duplicate:
+                    row.tmdb_id = tmdb_id
+                    updated += 1
+                    session.flush()
+        return updated
+
+    def add_movies_for_user(self, user_id, movies: Iterable[Dict[str, Any]]) -> int:
+        """
+        This method adds many movies to a user's watch-list in a single INSERT ... ON CONFLICT
+        statement. Each movie is a dict with `title` and optionally `tmdb_id` and `image`; movies
+        already on the watch-list are skipped, those without a TMDB id by title as in
+        `add_movie_for_user`. It returns the number of movies added.
+        """
+        rows, untracked = watchlist_rows(user_id, movies)
+        added = 0
+        with session_scope(self.Session) as session:
+            if rows:
+                statement = (
+                    self.insert_statement()
+                    .values(rows)
+                    .on_conflict_do_nothing(index_elements=["user_id", "tmdb_id"])
+                )
+                added += session.execute(statement).rowcount
+            if untracked:
+                # NULL ids never conflict, the titles already listed are skipped instead
+                listed = session.query(MovieEntity.title).filter(
+                    MovieEntity.user_id == user_id,
+                    MovieEntity.tmdb_id.is_(None),
+                    MovieEntity.title.in_(list(untracked)),
+                )
+                for (title,) in listed:
+                    untracked.pop(title, None)
+            if untracked:
+                statement = self.insert_statement().values(list(untracked.values()))
+                added += session.execute(statement).rowcount
+        return added
+
+    def delete_movies_by_ids(self, user_id, movie_ids: Iterable[int]) -> int:
+        """
+        This method deletes many movies of a user's watch-list in a single DELETE ... WHERE id IN
+        statement. Only the user's own movies are deleted. It returns the number of movies deleted.
+        """
+        movie_ids = list(set(movie_ids))
+        if not movie_ids:
+            return 0
+        statement = delete(MovieEntity).where(
+            MovieEntity.user_id == user_id, MovieEntity.id.in_(movie_ids)
+        )
+        with session_scope(self.Session) as session:
+            return session.execute(statement).rowcount
 
-    def get_movies_for_user(self, user_id):
+    def clear_movies_for_user(self, user_id) -> int:
         """
-        This method retrieves all movies for a user from the database.
+        This method empties a user's watch-list. It returns the number of movies deleted.
         """
-        session = self.Session()
-        movies = session.query(MovieEntity).filter_by(user_id=user_id).all()
-        session.close()
-        return movies
+        statement = delete(MovieEntity).where(MovieEntity.user_id == user_id)
+        with session_scope(self.Session) as session:
+            return session.execute(statement).rowcount
 
-    def delete_movie_by_id(self, user_id, movie_id):
+    def delete_movie_by_id(self, user_id, movie_id) -> bool:
         """
-        This method deletes a movie by its id from the database.
+        This method deletes a movie of a user's watch-list by its id from the database.
+        It returns whether the movie was deleted.
         """
-        session = self.Session()
-        movie = session.query(MovieEntity).filter_by(id=movie_id).first()
-        if movie:
-            session.delete(movie)
-            session.commit()
-        session.close()
+        return self.delete_movies_by_ids(user_id, [movie_id]) > 0
@@ -0,0 +1,390 @@
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import closing
+from typing import Dict, Iterable, List, Optional, Set, Union
+
+import aiohttp
+import requests
+import streamlit as st
+from PIL import Image
+
+from cache import SingleFlight
+from tmdb_api import TMDBTransport, get_transport
+
+TMDB_IMAGE_URL = "https://image.tmdb.org/t/p/"
+
+# Posters are downloaded once at this TMDB size and every thumbnail is generated from it
+SOURCE_SIZE = "w500"
+
+# Widths of the generated thumbnails, a poster is served at the smallest one at least as wide
+# as it is rendered
+THUMBNAIL_WIDTHS = (92, 185, 342, 500)
+
+# Movies without a poster are shown as a flat card of this colour
+PLACEHOLDER_COLOR = (38, 39, 48)
+
+_poster_store = None
+_poster_store_lock = threading.Lock()
+
+
+def get_poster_store() -> "PosterStore":
+    """
+    This function returns the process-wide poster store. The thumbnails are kept in
+    `poster_cache_path` (a directory in the system temp dir by default), up to
+    `poster_cache_max_bytes`.
+    """
+    global _poster_store
+    with _poster_store_lock:
+        if _poster_store is None:
+            _poster_store = PosterStore(
+                ThumbnailCache(
+                    st.secrets.get(
+                        "poster_cache_path",
+                        os.path.join(tempfile.gettempdir(), "cinematch-posters"),
+                    ),
+                    max_bytes=int(
+                        st.secrets.get("poster_cache_max_bytes", 256 * 1024 * 1024)
+                    ),
+                )
+            )
+        return _poster_store
+
+
+def thumbnail_width(width: int) -> int:
+    for thumbnail in THUMBNAIL_WIDTHS:
+        if thumbnail >= width:
+            return thumbnail
+    return THUMBNAIL_WIDTHS[-1]
+
+
+def poster_url(poster_path: Optional[str], size: str = SOURCE_SIZE) -> str:
+    return f"{TMDB_IMAGE_URL}{size}{poster_path}"
+
+
+@functools.lru_cache(maxsize=None)
+def make_placeholder(width: int) -> bytes:
+    """
+    This function returns the JPEG bytes of a blank poster-shaped card `width` pixels wide.
+    """
+    output = io.BytesIO()
+    Image.new("RGB", (width, width * 3 // 2), PLACEHOLDER_COLOR).save(
+        output, format="JPEG"
+    )
+    return output.getvalue()
+
+
+def make_thumbnails(source: bytes) -> Dict[int, bytes]:
+    """
+    This function resizes a poster to every thumbnail width and returns the JPEG bytes by width.
+    """
+    with Image.open(io.BytesIO(source)) as image:
+        image = image.convert("RGB")
+        thumbnails = {}
+        for width in THUMBNAIL_WIDTHS:
+            thumbnail = image
+            if image.width > width:
+                height = round(image.height * width / image.width)
+                thumbnail = image.resize((width, height), Image.LANCZOS)
+            output = io.BytesIO()
+            thumbnail.save(output, format="JPEG", quality=85, optimize=True)
+            thumbnails[width] = output.getvalue()
+    return thumbnails
+
+
+class ThumbnailCache:
+    """
+    On-disk content-addressed thumbnail store. Each thumbnail is a file named after the SHA-256
+    of its bytes, and a SQLite index maps (poster path, width) to it. Once the files take more
+    than `max_bytes`, the least recently used thumbnails are evicted.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024) -> None:
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS thumbnails ("
+                "poster_path TEXT NOT NULL, width INTEGER NOT NULL, "
+                "digest TEXT NOT NULL, size INTEGER NOT NULL, "
+                "accessed_at REAL NOT NULL, PRIMARY KEY (poster_path, width))"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS thumbnails_accessed_at "
+                "ON thumbnails (accessed_at)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS thumbnails_digest ON thumbnails (digest)"
+            )
+
+    def _connect(self) -> "closing[sqlite3.Connection]":
+        return closing(
+            sqlite3.connect(
+                os.path.join(self.directory, "index.sqlite3"),
+                timeout=10,
+                isolation_level=None,
+            )
+        )
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.directory, "objects", digest[:2], f"{digest}.jpg")
+
+    def get(self, poster_path: str, width: int) -> Optional[bytes]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT digest FROM thumbnails WHERE poster_path = ? AND width = ?",
+                (poster_path, width),
+            ).fetchone()
+            if row is not None:
+                try:
+                    with open(self.object_path(row[0]), "rb") as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    # The file was removed behind our back, forget it
+                    conn.execute(
+                        "DELETE FROM thumbnails WHERE poster_path = ? AND width = ?",
+                        (poster_path, width),
+                    )
+                else:
+                    conn.execute(
+                        "UPDATE thumbnails SET accessed_at = ? "
+                        "WHERE poster_path = ? AND width = ?",
+                        (time.time(), poster_path, width),
+                    )
+                    self.hits += 1
+                    return data
+            self.misses += 1
+            return None
+
+    def contains(self, poster_path: str) -> bool:
+        with self._connect() as conn:
+            (count,) = conn.execute(
+                "SELECT COUNT(*) FROM thumbnails WHERE poster_path = ?", (poster_path,)
+            ).fetchone()
+        return count == len(THUMBNAIL_WIDTHS)
+
+    def put_many(self, poster_path: str, thumbnails: Dict[int, bytes]) -> None:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            for width, data in thumbnails.items():
+                digest = hashlib.sha256(data).hexdigest()
+                path = self.object_path(digest)
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(data)
+                    os.replace(tmp_path, path)
+                previous = conn.execute(
+                    "SELECT digest FROM thumbnails WHERE poster_path = ? AND width = ?",
+                    (poster_path, width),
+                ).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO thumbnails "
+                    "(poster_path, width, digest, size, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (poster_path, width, digest, len(data), now),
+                )
+                if previous is not None and previous[0] != digest:
+                    self._remove_unreferenced(conn, previous[0])
+            self._evict(conn)
+
+    def total_bytes(self) -> int:
+        with self._connect() as conn:
+            return self._total_bytes(conn)
+
+    @staticmethod
+    def _total_bytes(conn: sqlite3.Connection) -> int:
+        # Identical thumbnails share one file, so each digest is only counted once
+        (total,) = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM "
+            "(SELECT digest, MAX(size) AS size FROM thumbnails GROUP BY digest)"
+        ).fetchone()
+        return total
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        total = self._total_bytes(conn)
+        while total > self.max_bytes:
+            row = conn.execute(
+                "SELECT poster_path, width, digest FROM thumbnails "
+                "ORDER BY accessed_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return
+            poster_path, width, digest = row
+            conn.execute(
+                "DELETE FROM thumbnails WHERE poster_path = ? AND width = ?",
+                (poster_path, width),
+            )
+            self._remove_unreferenced(conn, digest)
+            self.evictions += 1
+            total = self._total_bytes(conn)
+
+    def _remove_unreferenced(self, conn: sqlite3.Connection, digest: str) -> None:
+        (references,) = conn.execute(
+            "SELECT COUNT(*) FROM thumbnails WHERE digest = ?", (digest,)
+        ).fetchone()
+        if references == 0:
+            try:
+                os.remove(self.object_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def __len__(self) -> int:
+        with self._connect() as conn:
+            (count,) = conn.execute("SELECT COUNT(*) FROM thumbnails").fetchone()
+        return count
+
+
+class PosterStore:
+    """
+    PosterStore serves TMDB posters to the UI as cached thumbnails. A poster is downloaded once,
+    resized to every thumbnail width and kept in the ThumbnailCache. A poster that is not cached
+    yet is served as its TMDB URL and downloaded in the background, so rendering never waits on
+    a download.
+    """
+
+    def __init__(
+        self,
+        cache: ThumbnailCache,
+        transport: Optional[TMDBTransport] = None,
+        workers: int = 4,
+    ) -> None:
+        self.cache: ThumbnailCache = cache
+        self.transport: TMDBTransport = transport or get_transport()
+        self.flights: SingleFlight = SingleFlight()
+        self._prefetching: Set[str] = set()
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="poster-store"
+        )
+
+    def poster(self, poster_path: Optional[str], width: int) -> Union[bytes, str]:
+        """
+        This method returns the thumbnail bytes of a poster rendered `width` pixels wide. A poster
+        that is not cached yet is queued for download and served as its TMDB URL meanwhile, and a
+        movie without a poster gets a blank placeholder.
+        """
+        size = thumbnail_width(width)
+        if not poster_path:
+            return make_placeholder(size)
+        data = self.cache.get(poster_path, size)
+        if data is not None:
+            return data
+        self.queue([poster_path])
+        # TMDB serves every thumbnail width as a poster size
+        return poster_url(poster_path, f"w{size}")
+
+    def queue(self, poster_paths: Iterable[Optional[str]]) -> int:
+        """
+        This method downloads the missing posters on the store's worker threads and returns their
+        number without waiting.
+        """
+        missing = self.claim_missing(poster_paths)
+        for poster_path in missing:
+            self._executor.submit(self._download, poster_path)
+        return len(missing)
+
+    def _download(self, poster_path: str) -> None:
+        try:
+            self.flights.do(poster_path, lambda: self.fetch(poster_path))
+        except (requests.RequestException, OSError):
+            # The poster is served as its TMDB URL until a later render queues it again
+            pass
+        finally:
+            with self._lock:
+                self._prefetching.discard(poster_path)
+
+    def fetch(self, poster_path: str) -> Dict[int, bytes]:
+        response = self.transport.session.get(
+            poster_url(poster_path),
+            timeout=(self.transport.connect_timeout, self.transport.timeout),
+        )
+        response.raise_for_status()
+        thumbnails = make_thumbnails(response.content)
+        self.cache.put_many(poster_path, thumbnails)
+        return thumbnails
+
+    async def fetch_async(self, poster_path: str) -> Dict[int, bytes]:
+        session = self.transport.async_session()
+        async with session.get(poster_url(poster_path)) as response:
+            response.raise_for_status()
+            source = await response.read()
+        # Resizing is CPU bound, keep it off the event loop
+        thumbnails = await asyncio.get_running_loop().run_in_executor(
+            None, make_thumbnails, source
+        )
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.cache.put_many, poster_path, thumbnails
+        )
+        return thumbnails
+
+    def claim_missing(self, poster_paths: Iterable[Optional[str]]) -> List[str]:
+        """
+        This method returns the posters that are neither cached nor being prefetched yet, and marks
+        them as being prefetched until `prefetch_missing` has downloaded them.
+        """
+        with self._lock:
+            missing = [
+                path
+                for path in dict.fromkeys(p for p in poster_paths if p)
+                if path not in self._prefetching and not self.cache.contains(path)
+            ]
+            self._prefetching.update(missing)
+        return missing
+
+    async def prefetch(
+        self, poster_paths: Iterable[Optional[str]], concurrency: int = 8
+    ) -> int:
+        """
+        This method downloads the posters that are not cached yet, at most `concurrency` at a time.
+        It returns the number of posters fetched; posters that fail are left to `poster`.
+        """
+        return await self.prefetch_missing(
+            self.claim_missing(poster_paths), concurrency
+        )
+
+    async def prefetch_missing(self, missing: List[str], concurrency: int = 8) -> int:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(poster_path: str) -> bool:
+            async with semaphore:
+                try:
+                    await self.flights.do_async(
+                        poster_path, lambda: self.fetch_async(poster_path)
+                    )
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+                    return False
+                finally:
+                    with self._lock:
+                        self._prefetching.discard(poster_path)
+                return True
+
+        try:
+            fetched = await asyncio.gather(*(fetch(path) for path in missing))
+        finally:
+            # Paths whose download never started are not left marked
+            with self._lock:
+                self._prefetching.difference_update(missing)
+        return sum(fetched)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+            "evictions": self.cache.evictions,
+            "bytes": self.cache.total_bytes(),
+        }
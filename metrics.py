@@ -0,0 +1,309 @@
+import atexit
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import streamlit as st
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+QUANTILES: Tuple[float, ...] = (0.5, 0.95, 0.99)
+
+
+class SpanStats:
+    """
+    This class aggregates the latencies and errors of one span name: a cumulative histogram for
+    Prometheus, and the most recent `window` latencies for the p50/p95/p99 estimates.
+    """
+
+    def __init__(self, window: int = 1024) -> None:
+        self.count: int = 0
+        self.errors: int = 0
+        self.total: float = 0.0
+        self.buckets: List[int] = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.recent: deque = deque(maxlen=window)
+
+    def record(self, duration: float, error: bool) -> None:
+        self.count += 1
+        self.total += duration
+        self.buckets[bisect_left(LATENCY_BUCKETS, duration)] += 1
+        self.recent.append(duration)
+        if error:
+            self.errors += 1
+
+    def quantiles(self) -> Dict[float, float]:
+        durations = sorted(self.recent)
+        if not durations:
+            return {q: 0.0 for q in QUANTILES}
+        return {
+            q: durations[min(int(len(durations) * q), len(durations) - 1)]
+            for q in QUANTILES
+        }
+
+
+class Metrics:
+    """
+    Metrics is the registry of the app's spans. A span times a block of code under a name and
+    counts it as an error when it raises; streamlit's rerun and stop signals are not errors.
+    While the registry is disabled, spans only cost an attribute lookup.
+    """
+
+    def __init__(self, enabled: bool = False, window: int = 1024) -> None:
+        self.enabled: bool = enabled
+        self.window: int = window
+        self._spans: Dict[str, SpanStats] = {}
+        self._gauges: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._writer: Optional[threading.Thread] = None
+
+    def record(self, name: str, duration: float, error: bool = False) -> None:
+        with self._lock:
+            stats = self._spans.get(name)
+            if stats is None:
+                stats = self._spans[name] = SpanStats(self.window)
+            stats.record(duration, error)
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def gauges(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(sorted(self._gauges.items()))
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start, error)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        This method returns the count, error count and p50/p95/p99 latency of every span.
+        """
+        with self._lock:
+            summary = {}
+            for name, stats in sorted(self._spans.items()):
+                quantiles = stats.quantiles()
+                summary[name] = {
+                    "count": stats.count,
+                    "errors": stats.errors,
+                    "p50": quantiles[0.5],
+                    "p95": quantiles[0.95],
+                    "p99": quantiles[0.99],
+                }
+            return summary
+
+    def render_prometheus(self) -> str:
+        """
+        This method renders the spans in the Prometheus text exposition format.
+        """
+        lines = [
+            "# HELP cinematch_span_duration_seconds Duration of the traced operations.",
+            "# TYPE cinematch_span_duration_seconds histogram",
+        ]
+        errors = [
+            "# HELP cinematch_span_errors_total Traced operations that raised.",
+            "# TYPE cinematch_span_errors_total counter",
+        ]
+        quantiles = [
+            "# HELP cinematch_span_duration_quantile_seconds Latency quantiles of the "
+            "most recent operations.",
+            "# TYPE cinematch_span_duration_quantile_seconds gauge",
+        ]
+        gauges = [
+            "# HELP cinematch_gauge Current value of the app's gauges (e.g. queue depths).",
+            "# TYPE cinematch_gauge gauge",
+        ]
+        with self._lock:
+            for name, stats in sorted(self._spans.items()):
+                label = f'span="{name}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(
+                        f"cinematch_span_duration_seconds_bucket"
+                        f'{{{label},le="{bound}"}} {cumulative}'
+                    )
+                lines.append(
+                    f'cinematch_span_duration_seconds_bucket{{{label},le="+Inf"}} '
+                    f"{stats.count}"
+                )
+                lines.append(
+                    f"cinematch_span_duration_seconds_sum{{{label}}} {stats.total}"
+                )
+                lines.append(
+                    f"cinematch_span_duration_seconds_count{{{label}}} {stats.count}"
+                )
+                errors.append(f"cinematch_span_errors_total{{{label}}} {stats.errors}")
+                for q, value in stats.quantiles().items():
+                    quantiles.append(
+                        f"cinematch_span_duration_quantile_seconds"
+                        f'{{{label},quantile="{q}"}} {value}'
+                    )
+            for name, value in sorted(self._gauges.items()):
+                gauges.append(f'cinematch_gauge{{name="{name}"}} {value}')
+        return "\n".join(lines + errors + quantiles + gauges) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """
+        This method serves the Prometheus text on http://host:port/metrics from a daemon thread.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(
+            target=self._server.serve_forever, name="metrics-server", daemon=True
+        ).start()
+        return self._server
+
+    def write_periodically(self, path: str, interval: float = 15.0) -> None:
+        def run() -> None:
+            while True:
+                time.sleep(interval)
+                self.write_prometheus(path)
+
+        self._writer = threading.Thread(target=run, name="metrics-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.write_prometheus, path)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._spans.clear()
+            self._gauges.clear()
+
+
+metrics = Metrics()
+_configure_lock = threading.Lock()
+_configured = False
+
+
+def configure_metrics() -> Metrics:
+    """
+    This function enables the process-wide metrics when `metrics_enabled` is set in the secrets,
+    and exports them on `metrics_port` and/or to the `metrics_path` file. It only acts once.
+    """
+    global _configured
+    with _configure_lock:
+        if not _configured:
+            _configured = True
+            metrics.enabled = bool(st.secrets.get("metrics_enabled", False))
+            if metrics.enabled:
+                port = st.secrets.get("metrics_port")
+                if port:
+                    metrics.serve(int(port))
+                path = st.secrets.get("metrics_path")
+                if path:
+                    metrics.write_periodically(
+                        path, float(st.secrets.get("metrics_interval", 15))
+                    )
+        return metrics
+
+
+def traced(fn: Callable, name: Optional[str] = None) -> Callable:
+    """
+    This function wraps a function, coroutine function or async generator function in a span
+    named after its qualified name.
+    """
+    name = name or fn.__qualname__
+
+    if inspect.isasyncgenfunction(fn):
+
+        @functools.wraps(fn)
+        async def async_gen_wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                async for item in fn(*args, **kwargs):
+                    yield item
+                return
+            with metrics.span(name):
+                async for item in fn(*args, **kwargs):
+                    yield item
+
+        return async_gen_wrapper
+
+    if inspect.iscoroutinefunction(fn):
+
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return await fn(*args, **kwargs)
+            with metrics.span(name):
+                return await fn(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not metrics.enabled:
+            return fn(*args, **kwargs)
+        with metrics.span(name):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def trace_methods(cls: type) -> type:
+    """
+    This class decorator traces every public method defined on the class.
+    """
+    for attribute, value in list(vars(cls).items()):
+        if attribute.startswith("_") or not inspect.isfunction(value):
+            continue
+        setattr(cls, attribute, traced(value))
+    return cls
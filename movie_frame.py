@@ -0,0 +1,221 @@
+import threading
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+# Bit of each TMDB genre id in the genre masks, shared by every frame so masks are comparable.
+# Genres get the next free bit the first time they are seen; TMDB has fewer than 64 genres.
+GENRE_BITS: Dict[int, int] = {}
+_genre_bits_lock = threading.Lock()
+
+
+def genre_bit(genre_id: int) -> int:
+    bit = GENRE_BITS.get(genre_id)
+    if bit is not None:
+        return bit
+    # Concurrent sessions must not give two genres the same bit
+    with _genre_bits_lock:
+        if genre_id not in GENRE_BITS:
+            if len(GENRE_BITS) >= 64:
+                raise ValueError("A genre mask holds at most 64 genres")
+            GENRE_BITS[genre_id] = len(GENRE_BITS)
+        return GENRE_BITS[genre_id]
+
+
+def genre_mask(genre_ids: Iterable[int]) -> int:
+    mask = 0
+    for genre_id in genre_ids:
+        mask |= 1 << genre_bit(genre_id)
+    return mask
+
+
+def release_year(release_date: Optional[str]) -> int:
+    if release_date and release_date[:4].isdigit():
+        return int(release_date[:4])
+    return 0
+
+
+class MovieFrame:
+    """
+    MovieFrame holds a set of movies column by column in NumPy arrays (id, popularity, vote_average,
+    vote_count, release year and a genre bitmask), so filtering, de-duplication and ranking run
+    vectorized over tens of thousands of movies. The movie objects are kept alongside the columns
+    and returned in the frame's order by `to_movies`.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        popularity: np.ndarray,
+        vote_average: np.ndarray,
+        vote_count: np.ndarray,
+        year: np.ndarray,
+        genres: np.ndarray,
+        movies: np.ndarray,
+    ) -> None:
+        self.ids = ids
+        self.popularity = popularity
+        self.vote_average = vote_average
+        self.vote_count = vote_count
+        self.year = year
+        self.genres = genres
+        self.movies = movies
+
+    @classmethod
+    def from_movies(cls, movies: Sequence[Any]) -> "MovieFrame":
+        count = len(movies)
+        # Assigned one by one: numpy would try to unpack the (iterable) pydantic models
+        objects = np.empty(count, dtype=object)
+        for i, movie in enumerate(movies):
+            objects[i] = movie
+        return cls(
+            ids=np.fromiter((m.id for m in movies), dtype=np.int64, count=count),
+            popularity=np.fromiter(
+                (m.popularity for m in movies), dtype=np.float64, count=count
+            ),
+            vote_average=np.fromiter(
+                (m.vote_average for m in movies), dtype=np.float32, count=count
+            ),
+            vote_count=np.fromiter(
+                (m.vote_count for m in movies), dtype=np.int32, count=count
+            ),
+            year=np.fromiter(
+                (release_year(m.release_date) for m in movies),
+                dtype=np.int16,
+                count=count,
+            ),
+            genres=np.fromiter(
+                (genre_mask(m.genre_ids) for m in movies), dtype=np.uint64, count=count
+            ),
+            movies=objects,
+        )
+
+    @classmethod
+    def from_response(cls, response: Any) -> "MovieFrame":
+        return cls.from_movies(response.results)
+
+    @classmethod
+    def concat(cls, frames: Sequence["MovieFrame"]) -> "MovieFrame":
+        if not frames:
+            return cls.from_movies([])
+        return cls(
+            *(
+                np.concatenate([getattr(frame, column) for frame in frames])
+                for column in cls.columns()
+            )
+        )
+
+    @classmethod
+    def batches(cls, movies: Iterable[Any], size: int = 20) -> Iterator["MovieFrame"]:
+        """
+        This method groups a stream of movies into frames of `size` movies, e.g. to filter the
+        streamed discover results one TMDB page at a time.
+        """
+        iterator = iter(movies)
+        while True:
+            batch = list(islice(iterator, size))
+            if not batch:
+                return
+            yield cls.from_movies(batch)
+
+    @staticmethod
+    def columns() -> List[str]:
+        return [
+            "ids",
+            "popularity",
+            "vote_average",
+            "vote_count",
+            "year",
+            "genres",
+            "movies",
+        ]
+
+    def take(self, indices: np.ndarray) -> "MovieFrame":
+        return MovieFrame(
+            *(getattr(self, column)[indices] for column in self.columns())
+        )
+
+    def filter(
+        self,
+        min_rating: Optional[float] = None,
+        max_rating: Optional[float] = None,
+        min_votes: int = 0,
+        genre_ids: Optional[Iterable[int]] = None,
+        match_all_genres: bool = False,
+        min_year: Optional[int] = None,
+        max_year: Optional[int] = None,
+    ) -> "MovieFrame":
+        keep = np.ones(len(self), dtype=bool)
+        if min_rating is not None:
+            keep &= self.vote_average >= min_rating
+        if max_rating is not None:
+            keep &= self.vote_average <= max_rating
+        if min_votes:
+            keep &= self.vote_count >= min_votes
+        if genre_ids:
+            wanted = np.uint64(genre_mask(genre_ids))
+            matched = self.genres & wanted
+            keep &= (matched == wanted) if match_all_genres else (matched != 0)
+        if min_year is not None:
+            keep &= self.year >= min_year
+        if max_year is not None:
+            keep &= (self.year <= max_year) & (self.year > 0)
+        return self.take(np.flatnonzero(keep))
+
+    def dedupe(self) -> "MovieFrame":
+        """
+        This method drops the movies whose id was already seen, keeping the first occurrence.
+        """
+        _, first = np.unique(self.ids, return_index=True)
+        return self.take(np.sort(first))
+
+    def bayesian_rating(self, prior_votes: Optional[float] = None) -> np.ndarray:
+        """
+        This method shrinks each movie's vote_average towards the mean rating of the frame, the
+        fewer votes a movie has the stronger: (v * R + m * C) / (v + m).
+        """
+        if len(self) == 0:
+            return np.zeros(0)
+        votes = self.vote_count.astype(np.float64)
+        if prior_votes is None:
+            prior_votes = float(np.median(votes))
+        mean_rating = float(np.average(self.vote_average, weights=votes + 1))
+        return (votes * self.vote_average + prior_votes * mean_rating) / (
+            votes + prior_votes + 1e-9
+        )
+
+    def score(
+        self,
+        rating_weight: float = 0.8,
+        popularity_weight: float = 0.2,
+        prior_votes: Optional[float] = None,
+    ) -> np.ndarray:
+        if len(self) == 0:
+            return np.zeros(0)
+        popularity = np.log1p(self.popularity)
+        top = popularity.max()
+        if top > 0:
+            popularity = popularity / top
+        return (
+            rating_weight * self.bayesian_rating(prior_votes) / 10
+            + popularity_weight * popularity
+        )
+
+    def rank(
+        self,
+        rating_weight: float = 0.8,
+        popularity_weight: float = 0.2,
+        prior_votes: Optional[float] = None,
+        limit: Optional[int] = None,
+    ) -> "MovieFrame":
+        order = np.argsort(
+            -self.score(rating_weight, popularity_weight, prior_votes), kind="stable"
+        )
+        return self.take(order[:limit])
+
+    def to_movies(self) -> List[Any]:
+        return self.movies.tolist()
+
+    def __len__(self) -> int:
+        return len(self.ids)
@@ -0,0 +1,92 @@
+from typing import Any, Callable, Optional
+
+import streamlit as st
+
+from view_models import ResultSet, WatchlistState
+
+
+@st.fragment
+def render_movie_card(
+    movie: Any,
+    grid_key: str,
+    user: Any,
+    movie_operations: Any,
+    poster_store: Any,
+    watchlist: WatchlistState,
+    width: int = 340,
+) -> None:
+    """
+    This function renders one movie card. It is a fragment: clicking its button reruns only this
+    card, not the page and the other cards of the grid.
+    """
+    st.markdown(f"<div >", unsafe_allow_html=True)
+
+    # Display movie poster
+    st.image(poster_store.poster(movie.poster_path, width), width=width)
+
+    # Display movie title
+    st.markdown(
+        f"<div style='font-size: 20px; font-weight: bold; overflow: hidden; text-overflow: ellipsis'>{movie.title}</div>",
+        unsafe_allow_html=True,
+    )
+
+    # Display movie details
+    st.markdown(
+        f"<div style='color: #f4a261; font-size: 16px; margin-top: 8px; margin-bottom: 4px'>Rating: <b>{movie.vote_average}</b></div>",
+        unsafe_allow_html=True,
+    )
+    st.write(movie.release_date)
+
+    if watchlist.contains(movie.id):
+        st.caption("✔️ On your watch-list")
+    elif st.button(
+        "Add to my Watch-list! :popcorn:",
+        key=f"{grid_key}_watchlist_button_{movie.id}",
+    ):
+        if user is not None:
+            if movie_operations.add_movie_for_user(
+                user.id, movie.title, movie.poster_path, tmdb_id=movie.id
+            ):
+                st.success(f"**{movie.title}** is on your watch-list! :partying_face:")
+                st.balloons()
+            else:
+                st.info(f"**{movie.title}** is already on your watch-list.")
+            watchlist.add(movie.id)
+        else:
+            st.error("You must be logged in to add movies to your watchlist.")
+
+
+def render_grid(
+    result_set: ResultSet,
+    grid_key: str,
+    render_card: Callable[[Any, str], None],
+    columns: int = 2,
+    prefetch: Optional[Callable[[Any], Any]] = None,
+) -> None:
+    """
+    This function renders the visible page of a result set as a grid, with the controls to move
+    between pages. Only the posters of the visible page are prefetched.
+    """
+    movies = result_set.visible()
+    if prefetch is not None:
+        prefetch([movie.poster_path for movie in movies])
+
+    for i in range(0, len(movies), columns):
+        cols = st.columns(columns)
+        for j, movie in enumerate(movies[i : i + columns]):
+            with cols[j]:
+                render_card(movie, grid_key)
+
+    if result_set.page_count > 1:
+        previous_column, page_column, next_column = st.columns([1, 2, 1])
+        if result_set.page > 0 and previous_column.button(
+            "◀ Previous", key=f"{grid_key}_previous_page"
+        ):
+            result_set.go_to(result_set.page - 1)
+            st.rerun()
+        page_column.caption(f"Page {result_set.page + 1} of {result_set.page_count}")
+        if result_set.page < result_set.page_count - 1 and next_column.button(
+            "Next ▶", key=f"{grid_key}_next_page"
+        ):
+            result_set.go_to(result_set.page + 1)
+            st.rerun()
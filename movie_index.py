@@ -0,0 +1,278 @@
+import gzip
+import json
+import os
+import re
+import threading
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+# Fields of a TMDB movie object kept in the index, in the order they are stored on disk
+MOVIE_FIELDS = [
+    "id",
+    "adult",
+    "backdrop_path",
+    "genre_ids",
+    "original_language",
+    "original_title",
+    "overview",
+    "popularity",
+    "poster_path",
+    "release_date",
+    "title",
+    "video",
+    "vote_average",
+    "vote_count",
+]
+
+# Weight of a term match in each indexed field
+FIELD_WEIGHTS = {"title": 3.0, "original_title": 2.0, "overview": 1.0}
+
+# Fields TMDB's movie search matches queries against
+TITLE_FIELDS = ("title", "original_title")
+
+STOPWORDS = {"a", "an", "and", "at", "for", "in", "of", "on", "the", "to", "with"}
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    if not text:
+        return []
+    return [
+        token for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS
+    ]
+
+
+def trigrams(term: str) -> Set[str]:
+    padded = f"  {term} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(tokenize(query))
+
+
+class MovieIndex:
+    """
+    MovieIndex is a local catalogue of the TMDB movies the app has seen. It keeps an inverted index
+    over title, original_title and overview, plus a trigram index over the indexed terms for fuzzy
+    matching of misspelled queries. Only the movies are written to disk (gzip-compressed JSON rows);
+    the inverted and trigram indexes are rebuilt when the file is loaded.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        fuzzy_threshold: float = 0.5,
+        save_interval: float = 60.0,
+    ) -> None:
+        self.path: Optional[str] = path
+        self.fuzzy_threshold: float = fuzzy_threshold
+        self.save_interval: float = save_interval
+        self.movies: Dict[int, Dict[str, Any]] = {}
+        self.queries: Set[str] = set()
+        self._postings: Dict[str, Dict[int, float]] = defaultdict(dict)
+        self._titles: Dict[str, Set[int]] = defaultdict(set)
+        self._trigrams: Dict[str, Set[str]] = defaultdict(set)
+        self._lock = threading.RLock()
+        self._dirty: bool = False
+        self._save_lock = threading.Lock()
+        self._autosave: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        if path and os.path.exists(path):
+            self.load()
+
+    def add(
+        self, movies: Iterable[Dict[str, Any]], query: Optional[str] = None
+    ) -> None:
+        """
+        This method indexes raw TMDB movie objects. When they are the complete TMDB answer to a
+        search `query`, the query is remembered so it can later be answered from the index alone.
+        """
+        with self._lock:
+            for movie in movies:
+                self._index({field: movie.get(field) for field in MOVIE_FIELDS})
+            if query is not None:
+                self.queries.add(normalize_query(query))
+            self._dirty = True
+
+    def _index(self, movie: Dict[str, Any]) -> None:
+        movie_id = movie["id"]
+        if movie_id in self.movies:
+            self._unindex(self.movies[movie_id])
+        self.movies[movie_id] = movie
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in tokenize(movie.get(field)):
+                postings = self._postings[term]
+                postings[movie_id] = postings.get(movie_id, 0.0) + weight
+                for trigram in trigrams(term):
+                    self._trigrams[trigram].add(term)
+        for field in TITLE_FIELDS:
+            for term in tokenize(movie.get(field)):
+                self._titles[term].add(movie_id)
+
+    def _unindex(self, movie: Dict[str, Any]) -> None:
+        for field in FIELD_WEIGHTS:
+            for term in tokenize(movie.get(field)):
+                postings = self._postings.get(term)
+                if postings is not None:
+                    postings.pop(movie["id"], None)
+        for field in TITLE_FIELDS:
+            for term in tokenize(movie.get(field)):
+                self._titles.get(term, set()).discard(movie["id"])
+
+    def fuzzy_terms(self, term: str) -> Dict[str, float]:
+        """
+        This method returns the indexed terms similar to `term` with their trigram similarity.
+        """
+        query = trigrams(term)
+        counts: Dict[str, int] = defaultdict(int)
+        for trigram in query:
+            for candidate in self._trigrams.get(trigram, ()):
+                counts[candidate] += 1
+        matches = {}
+        for candidate, common in counts.items():
+            score = common / (len(query) + len(trigrams(candidate)) - common)
+            if score >= self.fuzzy_threshold and self._postings.get(candidate):
+                matches[candidate] = score
+        return matches
+
+    def search(
+        self, query: str, limit: int = 20, fuzzy: bool = True
+    ) -> List[Dict[str, Any]]:
+        """
+        This method returns the movies matching every term of the query, best matches first.
+        Terms that are not indexed are matched to similar indexed terms when `fuzzy` is set.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self._lock:
+            scores: Optional[Dict[int, float]] = None
+            for term in terms:
+                expansions = {term: 1.0} if self._postings.get(term) else {}
+                if not expansions and fuzzy:
+                    expansions = self.fuzzy_terms(term)
+                term_scores: Dict[int, float] = defaultdict(float)
+                for expansion, similarity in expansions.items():
+                    for movie_id, weight in self._postings[expansion].items():
+                        term_scores[movie_id] = max(
+                            term_scores[movie_id], weight * similarity
+                        )
+                if scores is None:
+                    scores = dict(term_scores)
+                else:
+                    scores = {
+                        movie_id: score + term_scores[movie_id]
+                        for movie_id, score in scores.items()
+                        if movie_id in term_scores
+                    }
+                if not scores:
+                    return []
+            return self._rank(scores, limit)
+
+    def _rank(self, scores: Dict[int, float], limit: int) -> List[Dict[str, Any]]:
+        ranked = sorted(
+            scores,
+            key=lambda movie_id: (
+                scores[movie_id],
+                self.movies[movie_id].get("popularity") or 0.0,
+            ),
+            reverse=True,
+        )
+        return [self.movies[movie_id] for movie_id in ranked[:limit]]
+
+    def lookup(
+        self, query: str, limit: int = 20, min_results: int = 5
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        This method answers a search from the index when it can be trusted to be complete: the same
+        query was answered by TMDB before, or at least `min_results` movies have every term of it in
+        their title. Matches in the overview do not count, TMDB's search only looks at titles.
+        It returns None on a miss.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return None
+        with self._lock:
+            if normalize_query(query) in self.queries:
+                return self.search(query, limit)
+            titled = set.intersection(
+                *(self._titles.get(term, set()) for term in terms)
+            )
+            if len(titled) < min_results:
+                return None
+            return self._rank(
+                {
+                    movie_id: sum(self._postings[term][movie_id] for term in terms)
+                    for movie_id in titled
+                },
+                limit,
+            )
+
+    def start_autosave(self) -> None:
+        """
+        This method starts a background thread that writes the index to disk every `save_interval`
+        seconds when it has changed, so `add` never blocks the request path on disk I/O.
+        """
+        if not self.path or self._autosave is not None:
+            return
+        self._stop.clear()
+        self._autosave = threading.Thread(
+            target=self._run_autosave, name="movie-index-autosave", daemon=True
+        )
+        self._autosave.start()
+
+    def stop_autosave(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._autosave is not None:
+            self._autosave.join(timeout)
+            self._autosave = None
+
+    def _run_autosave(self) -> None:
+        while not self._stop.wait(self.save_interval):
+            self.save_if_dirty()
+        # Stopping writes the last changes
+        self.save_if_dirty()
+
+    def save_if_dirty(self) -> bool:
+        """
+        This method writes the index to disk if it changed since the last save and returns whether
+        it did.
+        """
+        if not self._dirty:
+            return False
+        self.save()
+        return True
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        # The autosave thread and the exit hook may save at the same time
+        with self._save_lock:
+            with self._lock:
+                payload = {
+                    "fields": MOVIE_FIELDS,
+                    "movies": [
+                        [movie.get(field) for field in MOVIE_FIELDS]
+                        for movie in self.movies.values()
+                    ],
+                    "queries": sorted(self.queries),
+                }
+                self._dirty = False
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                json.dump(payload, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+
+    def load(self) -> None:
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            payload = json.load(f)
+        fields = payload["fields"]
+        with self._lock:
+            for row in payload["movies"]:
+                self._index(dict(zip(fields, row)))
+            self.queries.update(payload.get("queries", []))
+
+    def __len__(self) -> int:
+        return len(self.movies)
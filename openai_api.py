@@ -1,34 +1,659 @@
 import requests as req
 import streamlit as st
 import asyncio
+import atexit
+import concurrent.futures
 import json
+import logging
+import queue
+import re
+import threading
 import time
-from openai import OpenAI
+import uuid
+from openai import AsyncOpenAI, OpenAI
 
-from typing import List, Any, Union
+from collections import OrderedDict
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 from openai.types.beta import Assistant
 from openai.types.beta.thread import Thread
 from openai.types.beta.threads.run import Run
 from openai.types.beta.threads.thread_message import ThreadMessage
 
-from tmdb_api import MovieDB
+from cache import CacheStats, SingleFlight
+from images import get_poster_store
+from metrics import trace_methods
+from tmdb_api import MovieDB, close_transport_async
+
+logger = logging.getLogger(__name__)
 
 
 class AsyncManager:
-    def __init__(self):
-        self.movie_db = MovieDB()
+    """
+    AsyncManager runs one background event-loop thread per process. Sync Streamlit code submits
+    coroutines to it and waits on thread-safe futures, so async connection pools survive reruns.
+    """
+
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _thread: Optional[threading.Thread] = None
+    _lock = threading.Lock()
+    _futures: Set[concurrent.futures.Future] = set()
+
+    def __init__(self, movie_db: Optional[MovieDB] = None):
+        self._movie_db: Optional[MovieDB] = movie_db
 
-    def run_until_complete(self, task):
-        loop = asyncio.new_event_loop()
+    @property
+    def movie_db(self) -> MovieDB:
+        # Code that only needs the loop does not read the TMDB secrets
+        if self._movie_db is None:
+            self._movie_db = MovieDB()
+        return self._movie_db
+
+    @classmethod
+    def get_loop(cls) -> asyncio.AbstractEventLoop:
+        with cls._lock:
+            if cls._loop is None or cls._loop.is_closed():
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(
+                    target=cls._run_loop,
+                    args=(loop,),
+                    name="async-manager",
+                    daemon=True,
+                )
+                thread.start()
+                cls._loop, cls._thread = loop, thread
+            return cls._loop
+
+    @staticmethod
+    def _run_loop(loop: asyncio.AbstractEventLoop) -> None:
         asyncio.set_event_loop(loop)
-        return loop.run_until_complete(task)
+        loop.run_forever()
+
+    def submit(self, task) -> concurrent.futures.Future:
+        """
+        This method schedules a coroutine on the background loop and returns a thread-safe future.
+        Cancelling the future cancels the coroutine.
+        """
+        future = asyncio.run_coroutine_threadsafe(task, self.get_loop())
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard_future)
+        return future
+
+    @classmethod
+    def _discard_future(cls, future: concurrent.futures.Future) -> None:
+        with cls._lock:
+            cls._futures.discard(future)
+
+    def run_until_complete(self, task, timeout: Optional[float] = None):
+        future = self.submit(task)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def iterate(
+        self, iterator: AsyncIterator[Any], timeout: Optional[float] = None
+    ) -> Iterator[Any]:
+        """
+        This method turns an async iterator into a sync generator. The async iterator is consumed
+        on the background loop and its items are handed over through a queue as they are produced;
+        closing the generator early cancels the async side.
+        """
+        items: "queue.Queue[Any]" = queue.Queue()
+        done = object()
+
+        async def consume():
+            try:
+                async for item in iterator:
+                    items.put(item)
+            finally:
+                items.put(done)
+
+        future = self.submit(consume())
+        try:
+            while True:
+                try:
+                    item = items.get(timeout=timeout)
+                except queue.Empty:
+                    raise concurrent.futures.TimeoutError()
+                if item is done:
+                    break
+                yield item
+            future.result()
+        finally:
+            future.cancel()
+
+    @classmethod
+    def in_flight(cls) -> int:
+        with cls._lock:
+            return len(cls._futures)
+
+    @classmethod
+    def shutdown(cls, timeout: float = 5.0) -> None:
+        """
+        This method cancels the tasks still in flight, closes the async TMDB session and stops
+        the background loop.
+        """
+        with cls._lock:
+            loop, thread = cls._loop, cls._thread
+            cls._loop, cls._thread = None, None
+        if loop is None or loop.is_closed():
+            return
+
+        async def drain():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await close_transport_async()
+
+        try:
+            asyncio.run_coroutine_threadsafe(drain(), loop).result(timeout)
+        except (concurrent.futures.TimeoutError, RuntimeError):
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+        if thread is not None:
+            thread.join(timeout)
+        if not loop.is_running():
+            loop.close()
 
     def search_movies_by_keywords(self, keywords: List[str]):
-        print("search_movies_by_keywords", keywords)
         task = self.movie_db.search_movies_by_keywords(keywords)
         return self.run_until_complete(task)
 
+    def iter_discover_movies(
+        self, params: Dict[str, Any], max_pages: int = 5, concurrency: int = 4
+    ) -> Iterator[Any]:
+        pages = self.movie_db.discover_movies_pages(params, max_pages, concurrency)
+        return self.iterate(pages)
+
+    def prefetch_posters(self, poster_paths: Iterable[Optional[str]]) -> int:
+        """
+        This method starts downloading the missing posters of a result set in parallel on the
+        background loop and returns at once with their number. Until a poster is cached, the poster
+        store serves its TMDB URL, so a slow image host never holds up or fails the render.
+        """
+        poster_store = get_poster_store()
+        missing = poster_store.claim_missing(poster_paths)
+        if missing:
+            self.submit(poster_store.prefetch_missing(missing))
+        return len(missing)
+
+
+# Run statuses after which a run will never complete
+RUN_FAILURE_STATUSES = ("failed", "cancelled", "expired", "incomplete")
+
+
+class RunFailedError(Exception):
+    """Raised when an assistant run ends in a terminal failure state"""
+
+    def __init__(self, run: Run):
+        self.run: Run = run
+        error = getattr(run, "last_error", None)
+        detail = f": {error.message}" if error is not None else ""
+        super().__init__(f"Run {run.id} ended with status '{run.status}'{detail}")
+
+
+class RunTimeoutError(Exception):
+    """Raised when an assistant run does not complete before its deadline"""
+
+
+_run_poller: Optional["RunPoller"] = None
+
+
+def get_run_poller() -> "RunPoller":
+    """
+    This function returns the process-wide RunPoller. It must be called on the AsyncManager loop,
+    so every user request shares the same poller task.
+    """
+    global _run_poller
+    loop = asyncio.get_running_loop()
+    if _run_poller is None or _run_poller.loop is not loop:
+        _run_poller = RunPoller(
+            AsyncOpenAI(
+                api_key=st.secrets["OPENAI_API_KEY"],
+                base_url=st.secrets.get("openai_base_url"),
+            )
+        )
+    return _run_poller
+
+
+class RunPoller:
+    """
+    RunPoller waits on many assistant runs from a single task. Each run is polled with its own
+    adaptive interval: it starts at `min_interval`, grows by `backoff` while the status does not
+    change and is capped at `max_interval`.
+    """
+
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        min_interval: float = 0.25,
+        max_interval: float = 2.0,
+        backoff: float = 1.5,
+    ) -> None:
+        self.client: AsyncOpenAI = client
+        self.min_interval: float = min_interval
+        self.max_interval: float = max_interval
+        self.backoff: float = backoff
+        self.loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        self.polls: int = 0
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._wakeup: asyncio.Event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def wait(self, thread_id: str, run_id: str, timeout: float) -> Run:
+        entry = self._pending.get(run_id)
+        if entry is None:
+            entry = {
+                "thread_id": thread_id,
+                "future": self.loop.create_future(),
+                "status": None,
+                "interval": self.min_interval,
+                "next_poll": self.loop.time() + self.min_interval,
+                "waiters": 0,
+            }
+            self._pending[run_id] = entry
+        entry["waiters"] += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        else:
+            self._wakeup.set()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(entry["future"]), timeout)
+        except asyncio.TimeoutError:
+            raise RunTimeoutError(f"Run {run_id} did not complete within {timeout}s")
+        finally:
+            entry["waiters"] -= 1
+            # The run is polled until the last of the waiters sharing it gives up
+            if entry["waiters"] == 0 and self._pending.get(run_id) is entry:
+                del self._pending[run_id]
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def _run(self) -> None:
+        while self._pending:
+            now = self.loop.time()
+            due = [
+                (run_id, entry)
+                for run_id, entry in self._pending.items()
+                if entry["next_poll"] <= now
+            ]
+            if due:
+                await asyncio.gather(*(self._poll(*item) for item in due))
+            if not self._pending:
+                break
+            delay = (
+                min(e["next_poll"] for e in self._pending.values()) - self.loop.time()
+            )
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, run_id: str, entry: Dict[str, Any]) -> None:
+        self.polls += 1
+        try:
+            run = await self.client.beta.threads.runs.retrieve(
+                thread_id=entry["thread_id"], run_id=run_id
+            )
+        except Exception as e:
+            # Transient API errors are retried until the waiter's deadline
+            logger.warning("Polling run %s failed: %s", run_id, e)
+            run = None
+
+        future: asyncio.Future = entry["future"]
+        if run is not None and run.status == "completed":
+            self._pending.pop(run_id, None)
+            if not future.done():
+                future.set_result(run)
+            return
+        if run is not None and run.status in RUN_FAILURE_STATUSES:
+            self._pending.pop(run_id, None)
+            if not future.done():
+                future.set_exception(RunFailedError(run))
+            return
+
+        if run is not None and run.status != entry["status"]:
+            entry["status"] = run.status
+            entry["interval"] = self.min_interval
+        else:
+            entry["interval"] = min(entry["interval"] * self.backoff, self.max_interval)
+        entry["next_poll"] = self.loop.time() + entry["interval"]
+
+
+_params_cache: Optional["ParamsCache"] = None
+
+
+def get_params_cache() -> "ParamsCache":
+    """
+    This function returns the process-wide cache of preference-to-params translations.
+    """
+    global _params_cache
+    if _params_cache is None:
+        _params_cache = ParamsCache(
+            threshold=float(st.secrets.get("params_cache_threshold", 0.8)),
+            ttl=float(st.secrets.get("params_cache_ttl", 24 * 60 * 60)),
+            max_entries=int(st.secrets.get("params_cache_max_entries", 2048)),
+        )
+    return _params_cache
+
+
+def trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class ParamsCache:
+    """
+    ParamsCache remembers the TMDB discover params the assistant produced for a set of preferences.
+    Lookups are keyed on the normalized (genres, preference text, rating range); when there is no
+    exact match the preference text is matched against entries with the same genres and rating
+    range by character trigram similarity, and the best match at or above `threshold` is returned.
+    """
+
+    def __init__(
+        self, threshold: float = 0.8, ttl: float = 24 * 60 * 60, max_entries: int = 2048
+    ) -> None:
+        self.threshold: float = threshold
+        self.ttl: float = ttl
+        self.max_entries: int = max_entries
+        self.stats: CacheStats = CacheStats()
+        self.near_hits: int = 0
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._buckets: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(
+        genres: Sequence[str], preference: str, rating_range: Sequence[float]
+    ) -> Tuple[str, str]:
+        bucket = json.dumps(
+            [
+                sorted({genre.strip().lower() for genre in genres}),
+                [round(float(rating), 1) for rating in rating_range],
+            ]
+        )
+        text = " ".join(re.sub(r"[^\w\s]", " ", preference.lower()).split())
+        return bucket, text
+
+    def get(
+        self, genres: Sequence[str], preference: str, rating_range: Sequence[float]
+    ) -> Optional[Dict[str, Any]]:
+        bucket, text = self.normalize(genres, preference, rating_range)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(f"{bucket}|{text}")
+            if entry is None and text:
+                query = trigrams(text)
+                best_score = self.threshold
+                for key in self._buckets.get(bucket, ()):
+                    candidate = self._entries[key]
+                    if not candidate["trigrams"] or candidate["expires_at"] < now:
+                        continue
+                    common = len(query & candidate["trigrams"])
+                    score = common / len(query | candidate["trigrams"])
+                    if score >= best_score:
+                        best_score, entry = score, candidate
+                if entry is not None:
+                    self.near_hits += 1
+            if entry is None or entry["expires_at"] < now:
+                if entry is not None:
+                    self._remove(entry["key"])
+                    self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(entry["key"])
+            self.stats.hits += 1
+            return dict(entry["params"])
+
+    def set(
+        self,
+        genres: Sequence[str],
+        preference: str,
+        rating_range: Sequence[float],
+        params: Dict[str, Any],
+    ) -> None:
+        bucket, text = self.normalize(genres, preference, rating_range)
+        key = f"{bucket}|{text}"
+        with self._lock:
+            self._entries[key] = {
+                "key": key,
+                "bucket": bucket,
+                "trigrams": trigrams(text) if text else set(),
+                "params": dict(params),
+                "expires_at": time.time() + self.ttl,
+            }
+            self._entries.move_to_end(key)
+            self._buckets.setdefault(bucket, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        keys = self._buckets[entry["bucket"]]
+        keys.discard(key)
+        if not keys:
+            del self._buckets[entry["bucket"]]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+ASSISTANT_ID = "asst_sA2PRCNHBFq8Ca9fVbEXllBp"
+
+_openai_client: Optional[OpenAI] = None
+_assistants: Dict[str, Assistant] = {}
+_thread_pool: Optional["ThreadPool"] = None
+_openai_lock = threading.Lock()
+
+
+def get_openai_client() -> OpenAI:
+    """
+    This function returns the process-wide OpenAI client, so its HTTP connections are reused.
+    """
+    global _openai_client
+    with _openai_lock:
+        if _openai_client is None:
+            _openai_client = OpenAI(
+                api_key=st.secrets["OPENAI_API_KEY"],
+                base_url=st.secrets.get("openai_base_url"),
+            )
+        return _openai_client
+
+
+def get_assistant(assistant_id: str = ASSISTANT_ID) -> Assistant:
+    """
+    This function retrieves the assistant once per process and returns the cached handle afterwards.
+    """
+    client = get_openai_client()
+    with _openai_lock:
+        if assistant_id not in _assistants:
+            _assistants[assistant_id] = client.beta.assistants.retrieve(assistant_id)
+        return _assistants[assistant_id]
+
+
+def get_thread_pool() -> "ThreadPool":
+    """
+    This function returns the process-wide pool of assistant threads.
+    """
+    global _thread_pool
+    client = get_openai_client()
+    with _openai_lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPool(
+                client,
+                max_threads=int(st.secrets.get("openai_thread_pool_size", 64)),
+                min_idle=int(st.secrets.get("openai_thread_pool_min_idle", 4)),
+                idle_timeout=float(st.secrets.get("openai_thread_idle_timeout", 1800)),
+            )
+        return _thread_pool
+
+
+class ThreadPoolExhausted(Exception):
+    """Raised when every thread of the ThreadPool is checked out by a live session"""
+
+
+class ThreadPool:
+    """
+    ThreadPool hands out pre-created assistant threads, one per user session. A session keeps its
+    thread across reruns; when the session is released (or has been idle for `idle_timeout` seconds)
+    the thread is deleted, so conversations never leak between users, and a fresh one is created
+    in the background to keep `min_idle` threads ready.
+    """
+
+    def __init__(
+        self,
+        client: OpenAI,
+        max_threads: int = 64,
+        min_idle: int = 4,
+        idle_timeout: float = 1800.0,
+    ) -> None:
+        self.client: OpenAI = client
+        self.max_threads: int = max_threads
+        self.min_idle: int = min(min_idle, max_threads)
+        self.idle_timeout: float = idle_timeout
+        self.metrics: Dict[str, int] = {
+            "created": 0,
+            "deleted": 0,
+            "checkouts": 0,
+            "reuses": 0,
+            "exhausted": 0,
+        }
+        self._idle: List[Thread] = []
+        self._sessions: Dict[str, Tuple[Thread, float]] = {}
+        self._creating: int = 0
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="openai-thread-pool"
+        )
+        self._executor.submit(self._refill)
+
+    def checkout(self, session_id: str) -> Thread:
+        """
+        This method returns the thread of the session, checking out an idle one on first use.
+        """
+        self.reap()
+        with self._lock:
+            self.metrics["checkouts"] += 1
+            if session_id in self._sessions:
+                thread, _ = self._sessions[session_id]
+                self._sessions[session_id] = (thread, time.time())
+                self.metrics["reuses"] += 1
+                return thread
+            if self._idle:
+                thread = self._idle.pop()
+            elif len(self._sessions) + self._creating < self.max_threads:
+                self._creating += 1
+                thread = None
+            else:
+                self.metrics["exhausted"] += 1
+                raise ThreadPoolExhausted(
+                    f"All {self.max_threads} assistant threads are in use"
+                )
+
+        if thread is None:
+            try:
+                thread = self._create()
+            finally:
+                with self._lock:
+                    self._creating -= 1
+        with self._lock:
+            self._sessions[session_id] = (thread, time.time())
+        self._executor.submit(self._refill)
+        return thread
+
+    def release(self, session_id: str) -> None:
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self._executor.submit(self._recycle, entry[0])
+
+    def reap(self) -> None:
+        """
+        This method releases the sessions that have not used their thread for `idle_timeout` seconds.
+        """
+        deadline = time.time() - self.idle_timeout
+        with self._lock:
+            expired = [
+                session_id
+                for session_id, (_, last_used) in self._sessions.items()
+                if last_used < deadline
+            ]
+        for session_id in expired:
+            self.release(session_id)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                **self.metrics,
+                "idle": len(self._idle),
+                "in_use": len(self._sessions),
+                "max_threads": self.max_threads,
+            }
+
+    def _create(self) -> Thread:
+        thread = self.client.beta.threads.create()
+        with self._lock:
+            self.metrics["created"] += 1
+        return thread
+
+    def _recycle(self, thread: Thread) -> None:
+        try:
+            self.client.beta.threads.delete(thread.id)
+            with self._lock:
+                self.metrics["deleted"] += 1
+        except Exception:
+            logger.exception("Failed to delete assistant thread %s", thread.id)
+        self._refill()
+
+    def _refill(self) -> None:
+        while True:
+            with self._lock:
+                in_pool = len(self._idle) + len(self._sessions) + self._creating
+                if len(self._idle) >= self.min_idle or in_pool >= self.max_threads:
+                    return
+                self._creating += 1
+            try:
+                thread = self._create()
+                with self._lock:
+                    self._idle.append(thread)
+            except Exception:
+                logger.exception("Failed to create an assistant thread")
+                return
+            finally:
+                with self._lock:
+                    self._creating -= 1
+
+
+_run_flights = SingleFlight()
+
+
+def get_run_flights() -> SingleFlight:
+    """
+    This function returns the process-wide SingleFlight that shares one assistant run between
+    sessions sending the same message at the same time.
+    """
+    return _run_flights
+
 
 class MessageItem:
     def __init__(self, role: str, content: Union[str, Any]):
@@ -36,23 +661,35 @@ class MessageItem:
         self.content: str | Any = content
 
 
+@trace_methods
 class OpenAIBot:
-    def __init__(self, model: str = "gpt-3.5-turbo-1106") -> None:
-        OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
-        assistants_id = "asst_sA2PRCNHBFq8Ca9fVbEXllBp"
-
+    def __init__(
+        self,
+        model: str = "gpt-3.5-turbo-1106",
+        session_id: Optional[str] = None,
+        async_manager: Optional[AsyncManager] = None,
+    ) -> None:
         self.model: str = model
-        self.client: OpenAI = OpenAI(api_key=OPENAI_API_KEY)
-        self.assistant = self.client.beta.assistants.retrieve(assistants_id)
-        self.thread: Thread = self.client.beta.threads.create()
+        self.session_id: str = session_id or uuid.uuid4().hex
+        self.client: OpenAI = get_openai_client()
+        self.assistant: Assistant = get_assistant()
+        self.thread_pool: ThreadPool = get_thread_pool()
+        self.thread: Thread = self.thread_pool.checkout(self.session_id)
         self.messages: list[MessageItem] = []
+        self.async_manager: AsyncManager = async_manager or AsyncManager()
+
+    def close(self) -> None:
+        """
+        This method hands the session's thread back to the pool, which deletes and replaces it.
+        """
+        self.thread_pool.release(self.session_id)
 
     def send_message(self, message: str):
-        print("message: ", message)
+        # The pool gives a fresh thread if this session's one was reaped while idle
+        self.thread = self.thread_pool.checkout(self.session_id)
         latest_message: ThreadMessage = self.client.beta.threads.messages.create(
             thread_id=self.thread.id, role="user", content=message
         )
-        print("latest_message: ", latest_message)
 
         self.latest_run: Run = self.client.beta.threads.runs.create(
             thread_id=self.thread.id,
@@ -62,21 +699,47 @@ class OpenAIBot:
         # print("message sent on thread id: ", self.thread.id)
         self.addMessage(MessageItem(role="user", content=message))
 
-    def isCompleted(self) -> bool:
-        print("Status: ", self.latest_run.status)
-        while self.latest_run.status != "completed":
-            print("Going to sleep")
-            time.sleep(1)
-            self.latest_run: Run = self.client.beta.threads.runs.retrieve(  # type: ignore
-                thread_id=self.thread.id, run_id=self.latest_run.id
+    def ask(self, message: str, timeout: float = 60.0) -> MessageItem:
+        """
+        This method sends a message and returns the assistant's answer. When another session is
+        already waiting on a run for the same message (ignoring case and spacing), its answer is
+        shared and no run is made on this session's thread. RunFailedError and RunTimeoutError
+        are raised to every session sharing the run.
+        """
+        key = " ".join(message.lower().split())
+        sent = []
+
+        def run() -> MessageItem:
+            sent.append(True)
+            self.send_message(message)
+            self.isCompleted(timeout)
+            return self.get_lastest_response()
+
+        response = get_run_flights().do(key, run)
+        if not sent:
+            self.addMessage(MessageItem(role="user", content=message))
+            self.addMessage(response)
+        return response
+
+    async def wait_for_completion(self, timeout: float = 60.0) -> Run:
+        """
+        This method waits for the latest run on the shared RunPoller. It raises RunFailedError
+        when the run fails, is cancelled or expires and RunTimeoutError after `timeout` seconds.
+        """
+        if self.latest_run.status in RUN_FAILURE_STATUSES:
+            raise RunFailedError(self.latest_run)
+        if self.latest_run.status != "completed":
+            self.latest_run = await get_run_poller().wait(
+                self.thread.id, self.latest_run.id, timeout
             )
-            print("Latest Status: ", self.latest_run.status)
-            # print("Latest Run: ", self.latest_run)
+        return self.latest_run
+
+    def isCompleted(self, timeout: float = 60.0) -> bool:
+        self.async_manager.run_until_complete(self.wait_for_completion(timeout))
         return True
 
     def get_lastest_response(self) -> MessageItem:
         messages = self.client.beta.threads.messages.list(thread_id=self.thread.id)
-        print("Response: ", messages.data[0])
         m = MessageItem(messages.data[0].role, messages.data[0].content[0].text.value)
         self.addMessage(m)
         return m
@@ -86,3 +749,6 @@ class OpenAIBot:
 
     def addMessage(self, message: MessageItem) -> None:
         self.messages.append(message)
+
+
+atexit.register(AsyncManager.shutdown)
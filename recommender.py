@@ -0,0 +1,238 @@
+import atexit
+import os
+import threading
+import zlib
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import streamlit as st
+
+from movie_index import tokenize
+
+_recommender = None
+_recommender_lock = threading.Lock()
+
+
+def get_recommender() -> "ContentRecommender":
+    """
+    This function returns the process-wide recommender, loaded from `recommender_path` when that
+    is set in the secrets.
+    """
+    global _recommender
+    with _recommender_lock:
+        if _recommender is None:
+            _recommender = ContentRecommender(st.secrets.get("recommender_path"))
+            atexit.register(_recommender.save)
+        return _recommender
+
+
+def feature_slot(value: str, size: int) -> int:
+    # crc32 rather than hash(), which is salted per process and would not survive a reload
+    return zlib.crc32(value.encode("utf-8")) % size
+
+
+class ContentRecommender:
+    """
+    ContentRecommender answers "more like these movies" queries without any external call. Each
+    movie is a vector of three blocks: TF-IDF of its overview (hashed into `text_features` slots),
+    its genres and its original language. A user's profile is the mean vector of their watch-list
+    and recommendations are the top-k movies by cosine similarity to it.
+
+    Movies are added incrementally: only the raw term counts and document frequencies are stored,
+    so adding or changing movies never reprocesses the other ones, and the IDF weighting is applied
+    when the matrix is next queried.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        text_features: int = 512,
+        genre_features: int = 64,
+        language_features: int = 32,
+        text_weight: float = 1.0,
+        genre_weight: float = 1.0,
+        language_weight: float = 0.3,
+    ) -> None:
+        self.path: Optional[str] = path
+        self.text_features: int = text_features
+        self.genre_features: int = genre_features
+        self.language_features: int = language_features
+        self.weights: Tuple[float, float, float] = (
+            text_weight,
+            genre_weight,
+            language_weight,
+        )
+        self.ids: np.ndarray = np.zeros(0, dtype=np.int64)
+        self.term_counts: np.ndarray = np.zeros((0, text_features), dtype=np.float32)
+        self.genres: np.ndarray = np.zeros((0, genre_features), dtype=np.float32)
+        self.languages: np.ndarray = np.zeros((0, language_features), dtype=np.float32)
+        self.document_frequency: np.ndarray = np.zeros(text_features, dtype=np.int64)
+        self._positions: Dict[int, int] = {}
+        # Version of the catalogue the recommender was last updated from
+        self.catalogue_version: int = 0
+        self._matrix: Optional[np.ndarray] = None
+        self._lock = threading.RLock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def update(self, movies: Iterable[Dict[str, Any]]) -> int:
+        """
+        This method adds the movies (raw TMDB movie objects) that are not indexed yet, and indexes
+        again in place the ones whose overview, genres or language changed.
+        It returns the number of movies added or changed.
+        """
+        with self._lock:
+            movies = list({m["id"]: m for m in movies}.values())
+            if not movies:
+                return 0
+            term_counts, genres, languages = self.features(movies)
+            positions = np.array(
+                [self._positions.get(movie["id"], -1) for movie in movies],
+                dtype=np.int64,
+            )
+            new = positions < 0
+            changed = ~new
+            if changed.any():
+                rows = positions[changed]
+                changed[changed] = ~(
+                    (self.term_counts[rows] == term_counts[changed]).all(axis=1)
+                    & (self.genres[rows] == genres[changed]).all(axis=1)
+                    & (self.languages[rows] == languages[changed]).all(axis=1)
+                )
+            if changed.any():
+                rows = positions[changed]
+                self.document_frequency += (term_counts[changed] > 0).sum(axis=0)
+                self.document_frequency -= (self.term_counts[rows] > 0).sum(axis=0)
+                self.term_counts[rows] = term_counts[changed]
+                self.genres[rows] = genres[changed]
+                self.languages[rows] = languages[changed]
+            if new.any():
+                start = len(self.ids)
+                new_ids = [movie["id"] for movie, is_new in zip(movies, new) if is_new]
+                self.ids = np.concatenate([self.ids, np.array(new_ids, dtype=np.int64)])
+                self.term_counts = np.vstack([self.term_counts, term_counts[new]])
+                self.genres = np.vstack([self.genres, genres[new]])
+                self.languages = np.vstack([self.languages, languages[new]])
+                self.document_frequency += (term_counts[new] > 0).sum(axis=0)
+                for offset, movie_id in enumerate(new_ids):
+                    self._positions[movie_id] = start + offset
+            count = int(new.sum() + changed.sum())
+            if count:
+                self._matrix = None
+            return count
+
+    def update_from_catalogue(self, catalogue: Any) -> int:
+        """
+        This method indexes the catalogue records stored since the last call, so a rerun never
+        reads the whole catalogue. It returns the number of movies added or changed.
+        """
+        with self._lock:
+            movies, version = catalogue.changes_since(self.catalogue_version)
+            self.catalogue_version = version
+            return self.update(movies)
+
+    def features(
+        self, movies: Sequence[Dict[str, Any]]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        This method returns the raw term counts, genres and language rows of the movies.
+        """
+        count = len(movies)
+        term_counts = np.zeros((count, self.text_features), dtype=np.float32)
+        genres = np.zeros((count, self.genre_features), dtype=np.float32)
+        languages = np.zeros((count, self.language_features), dtype=np.float32)
+        for row, movie in enumerate(movies):
+            terms = Counter(
+                feature_slot(term, self.text_features)
+                for term in tokenize(movie.get("overview"))
+            )
+            for slot, term_count in terms.items():
+                # Sub-linear term frequency, so one repeated word does not dominate
+                term_counts[row, slot] = 1 + np.log(term_count)
+            for genre_id in movie.get("genre_ids") or []:
+                genres[row, feature_slot(str(genre_id), self.genre_features)] = 1
+            language = movie.get("original_language")
+            if language:
+                languages[row, feature_slot(language, self.language_features)] = 1
+        return term_counts, genres, languages
+
+    def matrix(self) -> np.ndarray:
+        """
+        This method returns the L2-normalized item matrix, rebuilt only after movies were added.
+        """
+        with self._lock:
+            if self._matrix is None:
+                idf = np.log((1 + len(self.ids)) / (1 + self.document_frequency)) + 1
+                blocks = []
+                for block, weight in zip(
+                    (
+                        self.term_counts * idf.astype(np.float32),
+                        self.genres,
+                        self.languages,
+                    ),
+                    self.weights,
+                ):
+                    norms = np.linalg.norm(block, axis=1, keepdims=True)
+                    blocks.append(weight * block / np.maximum(norms, 1e-12))
+                matrix = np.hstack(blocks)
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                self._matrix = matrix / np.maximum(norms, 1e-12)
+            return self._matrix
+
+    def recommend_for_movies(
+        self, tmdb_ids: Sequence[int], k: int = 20
+    ) -> List[Tuple[int, float]]:
+        """
+        This method returns the `k` movies most similar to the given ones, as (TMDB id, score) pairs.
+        The given movies are never recommended back.
+        """
+        with self._lock:
+            rows = [self._positions[i] for i in tmdb_ids if i in self._positions]
+            if not rows:
+                return []
+            matrix = self.matrix()
+            profile = matrix[rows].mean(axis=0)
+            scores = matrix @ profile
+            scores[rows] = -np.inf
+            k = min(k, len(scores) - len(set(rows)))
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(int(self.ids[i]), float(scores[i])) for i in top]
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp.npz"
+            np.savez_compressed(
+                tmp_path,
+                ids=self.ids,
+                term_counts=self.term_counts,
+                genres=self.genres,
+                languages=self.languages,
+                document_frequency=self.document_frequency,
+            )
+            os.replace(tmp_path, self.path)
+
+    def load(self) -> None:
+        with np.load(self.path) as data:
+            if data["term_counts"].shape[1] != self.text_features:
+                raise ValueError(
+                    f"{self.path} was built with {data['term_counts'].shape[1]} text features"
+                )
+            with self._lock:
+                self.ids = data["ids"]
+                self.term_counts = data["term_counts"]
+                self.genres = data["genres"]
+                self.languages = data["languages"]
+                self.document_frequency = data["document_frequency"]
+                self._positions = {int(i): row for row, i in enumerate(self.ids)}
+                self._matrix = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
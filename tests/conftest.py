@@ -0,0 +1,23 @@
+def make_movie(movie_id, title=None, genre_ids=(28,), **fields):
+    """
+    This function returns a TMDB movie object, as the list endpoints send it, with a default for
+    every field. Tests that need a `Movie` pass it to the model.
+    """
+    title = title or f"Movie {movie_id}"
+    return {
+        "adult": False,
+        "backdrop_path": None,
+        "genre_ids": list(genre_ids),
+        "id": movie_id,
+        "original_language": "en",
+        "original_title": title,
+        "overview": "",
+        "popularity": 1.0,
+        "poster_path": f"/{movie_id}.jpg",
+        "release_date": "2020-01-01",
+        "title": title,
+        "video": False,
+        "vote_average": 7.0,
+        "vote_count": 100,
+        **fields,
+    }
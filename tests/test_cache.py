@@ -0,0 +1,95 @@
+import pytest
+import sys
+import os
+import asyncio
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from cache import MemoryCache, DiskCache, SingleFlight
+
+
+def test_memory_cache_ttl_and_lru():
+    cache = MemoryCache(max_entries=2)
+    cache.set("a", {"page": 1}, ttl=60)
+    cache.set("b", {"page": 2}, ttl=60)
+    assert cache.get("a") == {"page": 1}
+    cache.set("c", {"page": 3}, ttl=60)
+    assert cache.get("b") is None
+    assert cache.get("a") == {"page": 1}
+    cache.set("d", {"page": 4}, ttl=-1)
+    assert cache.get("d") is None
+    assert cache.stats.as_dict() == {
+        "hits": 2,
+        "misses": 2,
+        "evictions": 2,
+        "expirations": 1,
+    }
+
+
+def test_disk_cache_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "tmdb.sqlite")
+    cache = DiskCache(path, max_entries=2)
+    cache.set("a", {"genres": []}, ttl=60)
+    cache.set("b", {"genres": []}, ttl=60)
+    time.sleep(0.01)
+    assert DiskCache(path).get("a") == {"genres": []}
+    cache.set("c", {"genres": []}, ttl=60)
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.stats.evictions == 1
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return {"page": 1}
+
+    results = []
+    callers = [
+        threading.Thread(target=lambda: results.append(flights.do("discover", fetch)))
+        for _ in range(5)
+    ]
+    for caller in callers:
+        caller.start()
+    while flights.collapsed < 4:
+        time.sleep(0.01)
+    release.set()
+    for caller in callers:
+        caller.join(5)
+
+    assert calls == [1]
+    assert results == [{"page": 1}] * 5
+    assert flights.stats() == {
+        "executions": 1,
+        "collapsed": 4,
+        "errors": 0,
+        "in_flight": 0,
+    }
+
+
+def test_single_flight_shares_errors_with_every_caller():
+    flights = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        raise ConnectionError("TMDB is down")
+
+    async def main():
+        return await asyncio.gather(
+            *(flights.do_async("genres", fetch) for _ in range(3)),
+            return_exceptions=True,
+        )
+
+    errors = asyncio.run(main())
+    assert all(isinstance(error, ConnectionError) for error in errors)
+    assert (flights.executions, flights.collapsed, flights.errors) == (1, 2, 1)
+    with pytest.raises(ValueError):
+        flights.do("genres", lambda: int("not a number"))
+    assert flights.in_flight() == 0
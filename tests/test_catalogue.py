@@ -0,0 +1,119 @@
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from catalogue import Catalogue, movie_from_details
+from conftest import make_movie
+
+DAY = 24 * 60 * 60
+
+
+def test_batch_lookup_skips_unknown_and_stale_movies(tmp_path):
+    catalogue = Catalogue(str(tmp_path / "catalogue.sqlite3"), max_age=DAY)
+    catalogue.add_movies([make_movie(1), make_movie(2)])
+    catalogue.add_movies([make_movie(3)], verified_at=time.time() - 2 * DAY)
+    assert set(catalogue.get_many([1, 2, 3, 4, None])) == {1, 2}
+    assert set(catalogue.get_many([3], max_age=3 * DAY)) == {3}
+    catalogue.set_genres([{"id": 28, "name": "Action"}, {"id": 35, "name": "Comedy"}])
+    assert catalogue.genre_names([35, 99, 28]) == ["Comedy", "Action"]
+
+    # The records and genres are read back from the file
+    catalogue.close()
+    reloaded = Catalogue(str(tmp_path / "catalogue.sqlite3"), max_age=DAY)
+    assert reloaded.get(1)["title"] == "Movie 1"
+    assert len(reloaded) == 3
+    assert reloaded.genres() == {28: "Action", 35: "Comedy"}
+
+
+def test_sync_refreshes_changed_movies_and_verifies_the_others():
+    now = time.time()
+    catalogue = Catalogue()
+    catalogue.add_movies([make_movie(i) for i in range(1, 6)], verified_at=now - DAY)
+    catalogue._set_synced_at(now - DAY)
+    windows = []
+
+    def changed_ids(start_date, end_date):
+        windows.append((start_date, end_date))
+        return [1, 2, 3, 42]
+
+    def fetch_movie(movie_id):
+        if movie_id == 2:
+            return None
+        if movie_id == 3:
+            raise RuntimeError("TMDB is down")
+        return make_movie(movie_id, title="Renamed")
+
+    refreshed, verified = catalogue.sync(changed_ids, fetch_movie, now=now)
+    assert (refreshed, verified) == (1, 2)
+    assert len(windows) == 1
+    assert catalogue.get(1)["title"] == "Renamed"
+    # Gone from TMDB
+    assert catalogue.get(2) is None
+    # Could not be checked, keeps its old timestamp
+    assert catalogue.verified_at(3) == now - DAY
+    assert catalogue.verified_at(4) == catalogue.verified_at(5) == now
+    assert 42 not in catalogue.get_many([42], max_age=10 * DAY)
+    assert catalogue.synced_at == now
+
+
+def test_first_sync_does_not_refetch_the_records_it_just_stored():
+    # Noon UTC, so the records and the sync fall on the same day
+    now = time.time() // DAY * DAY + DAY / 2
+    catalogue = Catalogue()
+    catalogue.add_movies([make_movie(1), make_movie(2)], verified_at=now - 60)
+    windows, fetched = [], []
+
+    def changed_ids(start_date, end_date):
+        windows.append((start_date, end_date))
+        return [1, 2]
+
+    def fetch_movie(movie_id):
+        fetched.append(movie_id)
+        return make_movie(movie_id, title="Renamed")
+
+    refreshed, verified = catalogue.sync(changed_ids, fetch_movie, now=now)
+    # The window starts with the oldest record instead of 14 days back
+    assert windows[0][0] == time.strftime("%Y-%m-%d", time.gmtime(now - 60))
+    assert (refreshed, verified, fetched) == (0, 0, [])
+    assert catalogue.verified_at(1) == now - 60
+
+    # The next day's sync reads that day again and refreshes them
+    catalogue.sync(changed_ids, fetch_movie, now=now + DAY)
+    assert sorted(fetched) == [1, 2]
+    assert catalogue.get(1)["title"] == "Renamed"
+
+
+def test_sync_of_an_empty_catalogue_skips_the_changes_feed():
+    catalogue = Catalogue()
+
+    def changed_ids(start_date, end_date):
+        raise AssertionError("the changes feed should not be read")
+
+    assert catalogue.sync(changed_ids, lambda movie_id: None) == (0, 0)
+    assert catalogue.synced_at is not None
+
+
+def test_movie_from_details_maps_genres_to_ids():
+    movie = movie_from_details(
+        {"id": 7, "title": "Seven", "genres": [{"id": 80, "name": "Crime"}]}
+    )
+    assert movie["genre_ids"] == [80]
+    assert movie["title"] == "Seven"
+
+
+def test_changes_since_returns_the_records_stored_after_a_version():
+    catalogue = Catalogue()
+    catalogue.add_movies([make_movie(1), make_movie(2)])
+    movies, version = catalogue.changes_since(0)
+    assert [movie["id"] for movie in movies] == [1, 2]
+    assert catalogue.changes_since(version) == ([], version)
+
+    catalogue.add_movies([make_movie(2, title="Renamed"), make_movie(3)])
+    movies, latest = catalogue.changes_since(version)
+    assert [(movie["id"], movie["title"]) for movie in movies] == [
+        (2, "Renamed"),
+        (3, "Movie 3"),
+    ]
+    assert latest > version
@@ -1,15 +1,25 @@
 import pytest
 import sys
 import os
+import streamlit as st
+from sqlalchemy import create_engine, select, text
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+import db
 from db import (
     create_database_connection,
+    get_session_factory,
+    session_scope,
     UserOperations,
     MovieOperations,
     UserBase,
+    UserEntity,
+    UserRecord,
+    WatchlistMovie,
+    PasswordHasher,
 )
+from metrics import metrics
 
 
 def test_create_database_connection():
@@ -31,3 +41,188 @@ def test_movie_operations():
     assert movies[0].title == "Test Movie"
     movie_ops.delete_movie_by_id(1, movies[0].id)
     assert len(movie_ops.get_movies_for_user(1)) == 0
+
+
+def test_watchlist_upsert_and_keyset_pagination(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'cinematch.db'}")
+    movie_ops = MovieOperations(engine)
+    assert movie_ops.add_movie_for_user(1, "Movie 1", "/1.jpg", tmdb_id=1)
+    assert not movie_ops.add_movie_for_user(1, "Movie 1", "/1.jpg", tmdb_id=1)
+    for tmdb_id in range(2, 6):
+        movie_ops.add_movie_for_user(1, f"Movie {tmdb_id}", tmdb_id=tmdb_id)
+
+    movie_ops.add_movie_for_user(1, "No id")
+    assert movie_ops.get_tmdb_ids_for_user(1) == {1, 2, 3, 4, 5}
+
+    page, cursor = movie_ops.get_watchlist_page(1, limit=2)
+    assert [movie.tmdb_id for movie in page] == [1, 2]
+    assert page[0] == WatchlistMovie(page[0].id, "Movie 1", "/1.jpg", 1)
+    page, cursor = movie_ops.get_watchlist_page(1, limit=2, after_id=cursor)
+    assert [movie.tmdb_id for movie in page] == [3, 4]
+    page, cursor = movie_ops.get_watchlist_page(1, limit=2, after_id=cursor)
+    assert [movie.tmdb_id for movie in page] == [5, None]
+    assert cursor is None
+
+
+def test_bulk_watchlist_operations(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'cinematch.db'}")
+    movie_ops = MovieOperations(engine)
+    movies = [{"title": f"Movie {i}", "tmdb_id": i} for i in range(1, 4)]
+    assert movie_ops.add_movies_for_user(1, movies) == 3
+    assert (
+        movie_ops.add_movies_for_user(1, movies + [{"title": "M", "tmdb_id": 9}]) == 1
+    )
+    assert movie_ops.add_movies_for_user(2, movies[:1]) == 1
+
+    ids = [movie.id for movie in movie_ops.get_movies_for_user(1)]
+    other_user_ids = [movie.id for movie in movie_ops.get_movies_for_user(2)]
+    assert movie_ops.delete_movies_by_ids(1, ids[:2] + other_user_ids) == 2
+    assert len(movie_ops.get_movies_for_user(2)) == 1
+    assert movie_ops.clear_movies_for_user(1) == 2
+    assert movie_ops.get_movies_for_user(1) == []
+
+
+def test_bulk_add_dedupes_movies_without_a_tmdb_id_by_title(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'cinematch.db'}")
+    movie_ops = MovieOperations(engine)
+    assert movie_ops.add_movie_for_user(1, "Old Movie")
+    movies = [
+        {"title": "Old Movie", "tmdb_id": None},
+        {"title": "Home Video", "tmdb_id": None},
+        # No tmdb_id key at all
+        {"title": "Home Video"},
+        {"title": "Found", "tmdb_id": 5},
+    ]
+    assert movie_ops.add_movies_for_user(1, movies) == 2
+    assert movie_ops.add_movies_for_user(1, movies) == 0
+    assert sorted(movie.title for movie in movie_ops.get_movies_for_user(1)) == [
+        "Found",
+        "Home Video",
+        "Old Movie",
+    ]
+
+
+def test_authenticate_user_rehashes_outdated_passwords(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'cinematch.db'}")
+    old_hasher = PasswordHasher(method="pbkdf2:sha256:1000", max_workers=1)
+    new_hasher = PasswordHasher(method="pbkdf2:sha256:2000", max_workers=1)
+    user = UserBase(username="test_user", password="test_password")
+    assert (
+        UserOperations(engine, old_hasher).register_new_user(user)["status"]
+        == "success"
+    )
+
+    user_ops = UserOperations(engine, new_hasher)
+    assert (
+        user_ops.authenticate_user("test_user", "wrong_password")["status"] == "error"
+    )
+    response = user_ops.authenticate_user("test_user", "test_password")
+    assert response["status"] == "success"
+    user = user_ops.authenticate_user("test_user", "test_password")["user"]
+    # The session keeps a detached record without the password hash
+    assert user == UserRecord(user.id, "test_user")
+    with engine.connect() as connection:
+        stored_hash = connection.execute(
+            select(UserEntity.password).where(UserEntity.id == user.id)
+        ).scalar_one()
+    assert stored_hash.startswith("pbkdf2:sha256:2000$")
+    assert not new_hasher.needs_rehash(stored_hash)
+
+
+def test_migration_keeps_rows_and_backfill_resolves_tmdb_ids(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'cinematch.db'}")
+    with engine.begin() as connection:
+        # The movies table of the versions that did not store the TMDB id
+        connection.execute(
+            text(
+                "CREATE TABLE movies (id INTEGER PRIMARY KEY, title VARCHAR NOT NULL, "
+                "image VARCHAR, user_id INTEGER NOT NULL)"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO movies (title, image, user_id) VALUES "
+                "('Dune', '/1984.jpg', 1), ('Dune', '/2021.jpg', 1), ('Alien', NULL, 1)"
+            )
+        )
+    movie_ops = MovieOperations(engine)
+    # Rows sharing a title may be different films, the migration keeps them all
+    assert len(movie_ops.get_movies_for_user(1)) == 3
+
+    resolved = []
+    ids = {("Dune", "/1984.jpg"): 841, ("Dune", "/2021.jpg"): 438631}
+
+    def resolve(title, poster_path):
+        resolved.append((title, poster_path))
+        # Alien has several candidates and no poster to tell them apart
+        return ids.get((title, poster_path))
+
+    assert movie_ops.backfill_tmdb_ids(resolve) == 2
+    assert sorted(resolved) == [
+        ("Alien", None),
+        ("Dune", "/1984.jpg"),
+        ("Dune", "/2021.jpg"),
+    ]
+    assert [movie.tmdb_id for movie in movie_ops.get_movies_for_user(1)] == [
+        841,
+        438631,
+        None,
+    ]
+    # Adding a backfilled movie again from a card no longer duplicates it
+    assert not movie_ops.add_movie_for_user(1, "Dune", "/1984.jpg", tmdb_id=841)
+    assert len(movie_ops.get_movies_for_user(1)) == 3
+
+
+@pytest.fixture
+def sqlite_secrets(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'cinematch.db'}"
+    monkeypatch.setattr(st, "secrets", {"DATABASE_URL": url})
+    # Every test starts with an empty registry of engines
+    monkeypatch.setattr(db, "_engines", {})
+    return url
+
+
+def test_one_engine_is_shared_per_process(sqlite_secrets):
+    engine = create_database_connection()
+    assert create_database_connection() is engine
+    assert str(engine.url) == sqlite_secrets
+    assert get_session_factory(engine) is get_session_factory(engine)
+    # The schema was created with the engine
+    assert MovieOperations(engine).get_movies_for_user(1) == []
+
+
+def test_session_scope_commits_rolls_back_and_returns_the_connection(
+    sqlite_secrets,
+):
+    engine = create_database_connection()
+    factory = get_session_factory(engine)
+    with session_scope(factory) as session:
+        session.add(UserEntity(username="kept", password="hash"))
+        assert engine.pool.checkedout() == 1
+    assert engine.pool.checkedout() == 0
+
+    with pytest.raises(RuntimeError):
+        with session_scope(factory) as session:
+            session.add(UserEntity(username="dropped", password="hash"))
+            session.flush()
+            raise RuntimeError("the request failed")
+    assert engine.pool.checkedout() == 0
+
+    with engine.connect() as connection:
+        usernames = connection.execute(select(UserEntity.username)).scalars().all()
+    assert usernames == ["kept"]
+
+
+def test_pool_checkout_waits_are_exported_as_metrics(sqlite_secrets):
+    metrics.enabled = True
+    metrics.reset()
+    try:
+        engine = create_database_connection()
+        with session_scope(get_session_factory(engine)):
+            pass
+        assert metrics.summary()["db.pool.checkout_wait"]["count"] == 1
+        assert metrics.gauges()["db.pool.checkedout"] == 1
+        assert 'span="db.pool.checkout_wait"' in metrics.render_prometheus()
+    finally:
+        metrics.enabled = False
+        metrics.reset()
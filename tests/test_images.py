@@ -0,0 +1,119 @@
+import pytest
+import sys
+import os
+import io
+import asyncio
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import aiohttp
+from PIL import Image
+
+from images import (
+    THUMBNAIL_WIDTHS,
+    PosterStore,
+    ThumbnailCache,
+    make_thumbnails,
+    thumbnail_width,
+)
+from tmdb_api import TMDBTransport
+
+
+def make_poster(color, size=(500, 750)):
+    output = io.BytesIO()
+    Image.new("RGB", size, color).save(output, format="JPEG")
+    return output.getvalue()
+
+
+def test_make_thumbnails_resizes_to_every_width():
+    thumbnails = make_thumbnails(make_poster("red"))
+    assert sorted(thumbnails) == list(THUMBNAIL_WIDTHS)
+    with Image.open(io.BytesIO(thumbnails[92])) as image:
+        assert image.size == (92, 138)
+    assert len(thumbnails[92]) < len(thumbnails[500])
+    assert thumbnail_width(80) == 92
+    assert thumbnail_width(340) == 342
+    assert thumbnail_width(1000) == 500
+
+
+def test_thumbnail_cache_is_content_addressed(tmp_path):
+    cache = ThumbnailCache(str(tmp_path))
+    thumbnails = make_thumbnails(make_poster("blue"))
+    cache.put_many("/a.jpg", thumbnails)
+    # The same image under another path is stored once
+    cache.put_many("/b.jpg", thumbnails)
+    assert len(cache) == 2 * len(THUMBNAIL_WIDTHS)
+    assert cache.total_bytes() == sum(len(data) for data in thumbnails.values())
+    assert cache.get("/b.jpg", 92) == thumbnails[92]
+    assert cache.contains("/a.jpg")
+    assert cache.get("/c.jpg", 92) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # A second instance reads the same directory
+    assert ThumbnailCache(str(tmp_path)).get("/a.jpg", 342) == thumbnails[342]
+
+
+def test_thumbnail_cache_evicts_least_recently_used(tmp_path):
+    red = make_thumbnails(make_poster("red"))
+    green = make_thumbnails(make_poster("green"))
+    cache = ThumbnailCache(
+        str(tmp_path), max_bytes=sum(len(data) for data in red.values()) + 1
+    )
+    cache.put_many("/red.jpg", red)
+    cache.put_many("/green.jpg", green)
+    assert cache.evictions > 0
+    assert cache.total_bytes() <= cache.max_bytes
+    assert cache.get("/green.jpg", 500) == green[500]
+    assert not cache.contains("/red.jpg")
+    remaining = {
+        name for _, _, names in os.walk(tmp_path / "objects") for name in names
+    }
+    assert len(remaining) == len(cache)
+
+
+def test_posters_being_prefetched_are_served_as_tmdb_urls(tmp_path):
+    store = PosterStore(ThumbnailCache(str(tmp_path)), TMDBTransport())
+    assert store.claim_missing(["/a.jpg", "/a.jpg", None]) == ["/a.jpg"]
+    assert store.claim_missing(["/a.jpg"]) == []
+    # The render does not wait for the background download
+    assert store.poster("/a.jpg", 80) == "https://image.tmdb.org/t/p/w92/a.jpg"
+
+    async def fetch_async(poster_path):
+        if poster_path == "/a.jpg":
+            raise aiohttp.ClientConnectionError("slow image host")
+        return make_thumbnails(make_poster("red"))
+
+    store.fetch_async = fetch_async
+    assert asyncio.run(store.prefetch_missing(["/a.jpg"])) == 0
+    assert store.claim_missing(["/a.jpg"]) == ["/a.jpg"]
+
+
+def test_poster_misses_are_downloaded_in_the_background(tmp_path):
+    store = PosterStore(ThumbnailCache(str(tmp_path)), TMDBTransport())
+    release = threading.Event()
+    fetched = []
+
+    def fetch(poster_path):
+        release.wait(5)
+        fetched.append(poster_path)
+        thumbnails = make_thumbnails(make_poster("red"))
+        store.cache.put_many(poster_path, thumbnails)
+        return thumbnails
+
+    store.fetch = fetch
+    # The miss is served as the TMDB URL while the download is queued
+    assert store.poster("/a.jpg", 200) == "https://image.tmdb.org/t/p/w342/a.jpg"
+    assert store.poster("/a.jpg", 200) == "https://image.tmdb.org/t/p/w342/a.jpg"
+    release.set()
+    store._executor.shutdown(wait=True)
+    assert fetched == ["/a.jpg"]
+    with Image.open(io.BytesIO(store.poster("/a.jpg", 200))) as image:
+        assert image.width == 342
+
+
+def test_movies_without_a_poster_get_a_placeholder(tmp_path):
+    store = PosterStore(ThumbnailCache(str(tmp_path)), TMDBTransport())
+    with Image.open(io.BytesIO(store.poster(None, 80))) as image:
+        assert image.size == (92, 138)
+    assert store.claim_missing([None, ""]) == []
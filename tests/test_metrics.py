@@ -0,0 +1,108 @@
+import pytest
+import sys
+import os
+import asyncio
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from metrics import Metrics, metrics, trace_methods
+
+
+@trace_methods
+class Catalogue:
+    def lookup(self, movie_id):
+        if movie_id < 0:
+            raise KeyError(movie_id)
+        return movie_id
+
+    async def fetch(self, movie_id):
+        await asyncio.sleep(0)
+        return movie_id
+
+    async def pages(self):
+        for page in range(3):
+            yield page
+
+    def _private(self):
+        return "untraced"
+
+
+@pytest.fixture
+def enabled_metrics():
+    metrics.enabled = True
+    metrics.reset()
+    yield metrics
+    metrics.enabled = False
+    metrics.reset()
+
+
+def test_spans_record_latency_and_errors():
+    registry = Metrics(enabled=True)
+    for _ in range(10):
+        with registry.span("tmdb.discover"):
+            pass
+    with pytest.raises(ValueError):
+        with registry.span("tmdb.discover"):
+            raise ValueError("bad payload")
+    # Streamlit's rerun and stop signals are BaseExceptions, not errors
+    with pytest.raises(KeyboardInterrupt):
+        with registry.span("home.sidebar"):
+            raise KeyboardInterrupt
+
+    summary = registry.summary()
+    assert summary["tmdb.discover"]["count"] == 11
+    assert summary["tmdb.discover"]["errors"] == 1
+    assert summary["home.sidebar"]["errors"] == 0
+    assert 0 <= summary["tmdb.discover"]["p50"] <= summary["tmdb.discover"]["p99"]
+
+
+def test_disabled_metrics_record_nothing():
+    registry = Metrics(enabled=False)
+    with registry.span("tmdb.discover"):
+        pass
+    assert registry.summary() == {}
+    assert Catalogue().lookup(1) == 1
+    assert metrics.summary() == {}
+
+
+def test_trace_methods_wraps_public_methods(enabled_metrics):
+    catalogue = Catalogue()
+    assert catalogue.lookup(1) == 1
+    with pytest.raises(KeyError):
+        catalogue.lookup(-1)
+
+    async def main():
+        return await catalogue.fetch(2), [page async for page in catalogue.pages()]
+
+    assert asyncio.run(main()) == (2, [0, 1, 2])
+    assert catalogue._private() == "untraced"
+
+    summary = enabled_metrics.summary()
+    assert set(summary) == {"Catalogue.lookup", "Catalogue.fetch", "Catalogue.pages"}
+    assert summary["Catalogue.lookup"]["errors"] == 1
+
+
+def test_prometheus_export(tmp_path):
+    registry = Metrics(enabled=True)
+    registry.record("MovieDB.get_json", 0.02)
+    registry.record("MovieDB.get_json", 3.0, error=True)
+    registry.set_gauge("tmdb.scheduler.queue_depth.background", 4)
+    text = registry.render_prometheus()
+    assert (
+        'cinematch_span_duration_seconds_bucket{span="MovieDB.get_json",le="0.025"} 1'
+        in text
+    )
+    assert (
+        'cinematch_span_duration_seconds_bucket{span="MovieDB.get_json",le="+Inf"} 2'
+        in text
+    )
+    assert 'cinematch_span_errors_total{span="MovieDB.get_json"} 1' in text
+    assert (
+        'cinematch_span_duration_quantile_seconds{span="MovieDB.get_json",quantile="0.99"} 3.0'
+        in text
+    )
+    assert 'cinematch_gauge{name="tmdb.scheduler.queue_depth.background"} 4' in text
+
+    path = tmp_path / "metrics.prom"
+    registry.write_prometheus(str(path))
+    assert path.read_text() == text
@@ -0,0 +1,65 @@
+import pytest
+import sys
+import os
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from conftest import make_movie
+from movie_frame import GENRE_BITS, MovieFrame, genre_bit
+from tmdb_api import Movie, MovieResponse
+
+
+def test_movie_frame_filter_dedupe_and_rank():
+    response = MovieResponse(
+        page=1,
+        results=[
+            Movie(
+                **make_movie(
+                    movie_id,
+                    genre_ids=genre_ids,
+                    vote_average=vote_average,
+                    vote_count=vote_count,
+                )
+            )
+            for movie_id, genre_ids, vote_average, vote_count in [
+                (1, [28], 9.5, 2),
+                (2, [28, 12], 8.0, 5000),
+                (3, [18], 7.0, 300),
+                (2, [28, 12], 8.0, 5000),
+                (4, [12], 4.0, 800),
+            ]
+        ],
+        total_pages=1,
+        total_results=5,
+    )
+    frame = MovieFrame.from_response(response).dedupe()
+    assert frame.ids.tolist() == [1, 2, 3, 4]
+
+    assert frame.filter(min_rating=5.0, max_rating=9.0).ids.tolist() == [2, 3]
+    assert frame.filter(genre_ids=[28, 18]).ids.tolist() == [1, 2, 3]
+    assert frame.filter(genre_ids=[28, 12], match_all_genres=True).ids.tolist() == [2]
+    assert frame.filter(min_year=2024).ids.tolist() == []
+
+    # A 9.5 from two votes ranks below an 8.0 from thousands
+    ranked = frame.rank(popularity_weight=0.0)
+    assert ranked.ids.tolist()[0] == 2
+    assert [movie.id for movie in ranked.to_movies()] == ranked.ids.tolist()
+
+
+def test_concurrent_sessions_get_distinct_genre_bits():
+    genre_ids = list(range(90001, 90017))
+    barrier = threading.Barrier(8)
+
+    def assign():
+        barrier.wait()
+        for genre_id in genre_ids:
+            genre_bit(genre_id)
+
+    threads = [threading.Thread(target=assign) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(set(GENRE_BITS.values())) == len(GENRE_BITS)
+    assert sorted(GENRE_BITS.values()) == list(range(len(GENRE_BITS)))
@@ -0,0 +1,75 @@
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from conftest import make_movie
+from movie_index import MovieIndex
+
+
+def test_movie_index_search_ranks_title_matches_first():
+    index = MovieIndex()
+    index.add(
+        [
+            make_movie(
+                1,
+                "Interstellar",
+                overview="A team travels through a wormhole in space.",
+            ),
+            make_movie(
+                2,
+                "Gravity",
+                overview="Two astronauts stranded in space.",
+                popularity=2.0,
+            ),
+            make_movie(
+                3, "Space Jam", overview="Basketball with cartoons.", popularity=9.0
+            ),
+        ]
+    )
+    assert [movie["id"] for movie in index.search("space")] == [3, 2, 1]
+    assert [movie["id"] for movie in index.search("space astronauts")] == [2]
+    assert [movie["id"] for movie in index.search("intersteller")] == [1]
+    assert index.search("intersteller", fuzzy=False) == []
+
+
+def test_movie_index_lookup_and_persistence(tmp_path):
+    path = str(tmp_path / "movies.json.gz")
+    index = MovieIndex(path)
+    index.add([make_movie(1, "Alien")], query="Alien")
+    assert [movie["id"] for movie in index.lookup("alien")] == [1]
+    assert index.lookup("gravity") is None
+    index.save()
+
+    reloaded = MovieIndex(path)
+    assert len(reloaded) == 1
+    assert reloaded.lookup("ALIEN") == index.lookup("alien")
+
+
+def test_lookup_only_trusts_title_matches():
+    index = MovieIndex()
+    index.add(
+        make_movie(i, f"Film {i}", overview="A heist in Paris goes wrong.")
+        for i in range(1, 7)
+    )
+    # Six movies mention the word, but TMDB may know titles with it the index has never seen
+    assert len(index.search("heist", fuzzy=False)) == 6
+    assert index.lookup("heist") is None
+
+    index.add(make_movie(i, f"Heist {i}") for i in range(10, 15))
+    assert sorted(movie["id"] for movie in index.lookup("heist")) == list(range(10, 15))
+
+
+def test_movie_index_add_leaves_saving_to_the_autosave_thread(tmp_path):
+    path = str(tmp_path / "movies.json.gz")
+    index = MovieIndex(path, save_interval=60)
+    index.add([make_movie(1, "Alien")])
+    # Indexing a page never writes to disk on the request path
+    assert not os.path.exists(path)
+    assert index.save_if_dirty()
+    assert not index.save_if_dirty()
+    index.add([make_movie(2, "Aliens")])
+    index.start_autosave()
+    index.stop_autosave(5)
+    assert len(MovieIndex(path)) == 2
@@ -1,10 +1,28 @@
 import pytest
 import sys
 import os
+import asyncio
+import concurrent.futures
+import itertools
+import threading
+import time
+from types import SimpleNamespace
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from openai_api import AsyncManager, OpenAIBot, MessageItem
+import openai_api
+from cache import SingleFlight
+from openai_api import (
+    AsyncManager,
+    OpenAIBot,
+    MessageItem,
+    ParamsCache,
+    RunFailedError,
+    RunPoller,
+    RunTimeoutError,
+    ThreadPool,
+    ThreadPoolExhausted,
+)
 
 
 def test_async_manager():
@@ -12,9 +30,301 @@ def test_async_manager():
     assert async_manager is not None
 
 
+def test_async_manager_reuses_one_loop():
+    async def current_loop():
+        return asyncio.get_running_loop()
+
+    # The loop does not need TMDB, so the secrets are not read
+    async_manager = AsyncManager(movie_db=object())
+    first = async_manager.run_until_complete(current_loop())
+    assert async_manager.run_until_complete(current_loop()) is first
+    with pytest.raises(concurrent.futures.TimeoutError):
+        async_manager.run_until_complete(asyncio.sleep(1), timeout=0.01)
+    AsyncManager.shutdown()
+    assert first.is_closed()
+    assert async_manager.in_flight() == 0
+
+
 def test_openai_bot():
     bot = OpenAIBot()
     bot.send_message("Hello, world!")
     assert bot.isCompleted()
     assert isinstance(bot.get_lastest_response(), MessageItem)
     assert len(bot.getMessages()) > 0
+
+
+def test_params_cache_exact_and_near_duplicate_matches():
+    cache = ParamsCache(threshold=0.6, ttl=60, max_entries=2)
+    params = {"with_genres": "28", "with_keywords": "space"}
+    cache.set(["Action"], "A movie set in space!", (5.0, 10.0), params)
+    assert cache.get([" action "], "a movie set in space", (5, 10)) == params
+    assert cache.get(["Action"], "movies set in space", (5.0, 10.0)) == params
+    assert cache.get(["Action"], "a romantic comedy", (5.0, 10.0)) is None
+    assert cache.get(["Drama"], "a movie set in space", (5.0, 10.0)) is None
+    assert cache.near_hits == 1
+    cache.set(["Drama"], "", (0.0, 10.0), {})
+    cache.set(["Comedy"], "", (0.0, 10.0), {})
+    assert cache.get(["Action"], "a movie set in space", (5.0, 10.0)) is None
+    assert len(cache) == 2
+
+
+class FakeRuns:
+    """Answers `runs.retrieve` with the next status of a run, or raises it when it is an error"""
+
+    def __init__(self, statuses, poller=None):
+        self.statuses = list(statuses)
+        self.poller = poller
+        self.intervals = []
+
+    async def retrieve(self, thread_id, run_id):
+        if self.poller is not None:
+            self.intervals.append(self.poller._pending[run_id]["interval"])
+        status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        if isinstance(status, Exception):
+            raise status
+        return SimpleNamespace(id=run_id, status=status, last_error=None)
+
+
+def make_poller(runs, **kwargs):
+    client = SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(runs=runs)))
+    return RunPoller(client, **{"min_interval": 0.01, "max_interval": 0.04, **kwargs})
+
+
+def test_run_poller_returns_the_completed_run():
+    async def run():
+        poller = make_poller(FakeRuns(["queued", "in_progress", "completed"]))
+        completed = await poller.wait("thread", "run", timeout=1.0)
+        return completed, poller
+
+    completed, poller = asyncio.run(run())
+    assert completed.status == "completed"
+    assert poller.polls == 3
+    assert poller.pending() == 0
+
+
+@pytest.mark.parametrize("status", ["failed", "cancelled", "expired"])
+def test_run_poller_raises_on_terminal_failures(status):
+    async def run():
+        poller = make_poller(FakeRuns(["in_progress", status]))
+        await poller.wait("thread", "run", timeout=1.0)
+
+    with pytest.raises(RunFailedError, match=status):
+        asyncio.run(run())
+
+
+def test_run_poller_gives_up_at_the_deadline():
+    async def run():
+        poller = make_poller(FakeRuns(["in_progress"]))
+        with pytest.raises(RunTimeoutError):
+            await poller.wait("thread", "run", timeout=0.05)
+        return poller
+
+    assert asyncio.run(run()).pending() == 0
+
+
+def test_run_poller_backs_off_until_the_status_changes():
+    async def run():
+        runs = FakeRuns(
+            ["queued"] * 4 + ["in_progress"] * 2 + ["completed"],
+        )
+        poller = make_poller(runs, backoff=2.0)
+        runs.poller = poller
+        await poller.wait("thread", "run", timeout=1.0)
+        return runs.intervals
+
+    intervals = asyncio.run(run())
+    # Doubled while queued, capped at max_interval, reset when the run starts
+    assert intervals == pytest.approx([0.01, 0.01, 0.02, 0.04, 0.04, 0.01, 0.02])
+
+
+def test_run_poller_retries_transient_errors(caplog):
+    async def run():
+        poller = make_poller(
+            FakeRuns([ConnectionError("reset"), ConnectionError("reset"), "completed"])
+        )
+        return await poller.wait("thread", "run", timeout=1.0), poller
+
+    completed, poller = asyncio.run(run())
+    assert completed.status == "completed" and poller.polls == 3
+    assert "Polling run run failed" in caplog.text
+
+
+def test_waiters_sharing_a_run_keep_it_polled_until_the_last_one_leaves():
+    async def run():
+        poller = make_poller(
+            FakeRuns(["in_progress"] * 3 + ["completed"]), max_interval=0.01
+        )
+        impatient = asyncio.ensure_future(poller.wait("thread", "run", timeout=0.015))
+        patient = asyncio.ensure_future(poller.wait("thread", "run", timeout=1.0))
+        with pytest.raises(RunTimeoutError):
+            await impatient
+        return await patient, poller
+
+    completed, poller = asyncio.run(run())
+    assert completed.status == "completed"
+    # One retrieve per poll, however many sessions wait on the run
+    assert poller.polls == 4
+
+
+class FakeThreads:
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.deleted = []
+
+    def create(self):
+        return SimpleNamespace(id=f"thread_{next(self.ids)}")
+
+    def delete(self, thread_id):
+        self.deleted.append(thread_id)
+
+
+def make_thread_pool(**kwargs):
+    threads = FakeThreads()
+    client = SimpleNamespace(beta=SimpleNamespace(threads=threads))
+    return ThreadPool(client, **kwargs), threads
+
+
+def settle(pool):
+    # The pool's background work runs on a single worker, in order
+    pool._executor.submit(lambda: None).result(5)
+
+
+def test_thread_pool_checks_out_idle_threads_and_reuses_them_per_session():
+    pool, threads = make_thread_pool(max_threads=4, min_idle=2)
+    settle(pool)
+    assert pool.stats()["idle"] == 2
+    first = pool.checkout("a")
+    assert pool.checkout("a") is first
+    assert pool.checkout("b") is not first
+    settle(pool)
+    stats = pool.stats()
+    assert (stats["checkouts"], stats["reuses"], stats["in_use"]) == (3, 1, 2)
+    # Checked out threads are replaced to keep min_idle ready
+    assert stats["idle"] == 2 and stats["created"] == 4
+
+
+def test_thread_pool_raises_when_every_thread_is_in_use():
+    pool, threads = make_thread_pool(max_threads=2, min_idle=1)
+    pool.checkout("a")
+    pool.checkout("b")
+    with pytest.raises(ThreadPoolExhausted):
+        pool.checkout("c")
+    assert pool.stats()["exhausted"] == 1
+    # Releasing a session makes room again
+    pool.release("a")
+    settle(pool)
+    assert pool.checkout("c") is not None
+
+
+def test_thread_pool_reaps_idle_sessions_and_refills():
+    pool, threads = make_thread_pool(max_threads=4, min_idle=1, idle_timeout=0.05)
+    settle(pool)
+    first = pool.checkout("a")
+    time.sleep(0.1)
+    # Another session's checkout releases the idle one, whose thread is deleted
+    pool.checkout("b")
+    settle(pool)
+    assert threads.deleted == [first.id]
+    assert pool.checkout("a").id != first.id
+    settle(pool)
+    stats = pool.stats()
+    assert stats["deleted"] == 1 and stats["idle"] == 1
+
+
+class FakeAssistantAPI:
+    """The threads, messages and runs endpoints of the assistants API used by OpenAIBot"""
+
+    def __init__(self, status="completed"):
+        self.status = status
+        self.runs_created = 0
+        self.release = threading.Event()
+        self.release.set()
+        self.threads = FakeThreads()
+        self.threads.messages = SimpleNamespace(
+            create=lambda **kwargs: None, list=self.list_messages
+        )
+        self.threads.runs = SimpleNamespace(create=self.create_run)
+        self.beta = SimpleNamespace(threads=self.threads)
+
+    def create_run(self, thread_id, assistant_id):
+        self.runs_created += 1
+        self.release.wait(5)
+        return SimpleNamespace(
+            id=f"run_{self.runs_created}", status=self.status, last_error=None
+        )
+
+    def list_messages(self, thread_id):
+        text = SimpleNamespace(value='{"with_genres": "28"}')
+        message = SimpleNamespace(
+            role="assistant", content=[SimpleNamespace(text=text)]
+        )
+        return SimpleNamespace(data=[message])
+
+
+@pytest.fixture
+def assistant_api(monkeypatch):
+    api = FakeAssistantAPI()
+    monkeypatch.setattr(openai_api, "_openai_client", api)
+    monkeypatch.setattr(
+        openai_api, "_assistants", {openai_api.ASSISTANT_ID: SimpleNamespace(id="a")}
+    )
+    monkeypatch.setattr(openai_api, "_thread_pool", ThreadPool(api, min_idle=0))
+    monkeypatch.setattr(openai_api, "_run_flights", SingleFlight())
+    return api
+
+
+def ask_concurrently(messages):
+    bots = [OpenAIBot(session_id=f"session_{i}") for i in range(len(messages))]
+    results = [None] * len(messages)
+
+    def ask(i):
+        try:
+            results[i] = bots[i].ask(messages[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=ask, args=(i,)) for i in range(len(messages))]
+    for thread in threads:
+        thread.start()
+    return bots, threads, results
+
+
+def wait_for_collapsed(flights, count, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while flights.collapsed < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_identical_concurrent_messages_share_one_run(assistant_api):
+    assistant_api.release.clear()
+    bots, threads, results = ask_concurrently(["Space movies", "  space MOVIES "])
+    # The second session waits on the first one's run
+    wait_for_collapsed(openai_api.get_run_flights(), 1)
+    assistant_api.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert assistant_api.runs_created == 1
+    assert results[0] is results[1]
+    assert results[0].content == '{"with_genres": "28"}'
+    # Both sessions keep the exchange in their own history
+    assert [len(bot.getMessages()) for bot in bots] == [2, 2]
+
+
+def test_a_failed_run_reaches_every_waiter_and_is_not_cached(assistant_api):
+    assistant_api.status = "failed"
+    assistant_api.release.clear()
+    bots, threads, results = ask_concurrently(["Space movies", "space movies"])
+    wait_for_collapsed(openai_api.get_run_flights(), 1)
+    assistant_api.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert assistant_api.runs_created == 1
+    assert all(isinstance(result, RunFailedError) for result in results)
+
+    # The next ask makes a new run instead of getting the failure again
+    assistant_api.status = "completed"
+    assert bots[0].ask("Space movies").role == "assistant"
+    assert assistant_api.runs_created == 2
@@ -0,0 +1,86 @@
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from catalogue import Catalogue
+from conftest import make_movie
+from recommender import ContentRecommender
+
+
+MOVIES = [
+    make_movie(
+        1,
+        genre_ids=[878],
+        overview="Astronauts travel through a wormhole to save humanity.",
+    ),
+    make_movie(
+        2, genre_ids=[878, 12], overview="A crew of astronauts is stranded on Mars."
+    ),
+    make_movie(
+        3,
+        genre_ids=[10749, 35],
+        overview="Two strangers fall in love in Paris.",
+        original_language="fr",
+    ),
+    make_movie(
+        4,
+        genre_ids=[878],
+        overview="Astronauts explore a distant planet and a wormhole.",
+    ),
+    make_movie(5, genre_ids=[35], overview="A wedding goes hilariously wrong."),
+]
+
+
+def test_recommender_returns_similar_movies():
+    recommender = ContentRecommender()
+    assert recommender.update(MOVIES) == 5
+    assert recommender.update(MOVIES[:2]) == 0
+    recommended = [tmdb_id for tmdb_id, _ in recommender.recommend_for_movies([1], 2)]
+    assert recommended == [4, 2]
+    assert recommender.recommend_for_movies([999]) == []
+
+
+def test_recommender_incremental_update_and_persistence(tmp_path):
+    path = str(tmp_path / "recommender.npz")
+    recommender = ContentRecommender(path)
+    recommender.update(MOVIES[:3])
+    recommender.update(MOVIES[3:])
+    recommender.save()
+
+    reloaded = ContentRecommender(path)
+    assert len(reloaded) == 5
+    assert reloaded.recommend_for_movies([3, 5], 3) == recommender.recommend_for_movies(
+        [3, 5], 3
+    )
+
+
+def test_changed_movies_are_indexed_again_in_place():
+    recommender = ContentRecommender()
+    recommender.update(MOVIES)
+    remade = make_movie(5, genre_ids=[878], overview="Astronauts find a wormhole.")
+    assert recommender.update([remade]) == 1
+    assert recommender.update([remade]) == 0
+
+    fresh = ContentRecommender()
+    fresh.update(MOVIES[:4] + [remade])
+    assert len(recommender) == 5
+    assert (recommender.document_frequency == fresh.document_frequency).all()
+    assert recommender.recommend_for_movies([1], 4) == pytest.approx(
+        fresh.recommend_for_movies([1], 4)
+    )
+
+
+def test_recommender_follows_the_catalogue_changes():
+    catalogue = Catalogue()
+    recommender = ContentRecommender()
+    catalogue.add_movies(MOVIES[:3])
+    assert recommender.update_from_catalogue(catalogue) == 3
+    # Nothing stored since the last update
+    assert recommender.update_from_catalogue(catalogue) == 0
+
+    catalogue.add_movies(MOVIES[3:])
+    catalogue.add_movies([dict(MOVIES[0], overview="A wedding in space.")])
+    assert recommender.update_from_catalogue(catalogue) == 3
+    assert len(recommender) == 5
@@ -1,15 +1,473 @@
 import pytest
 import sys
 import os
+import json
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from tmdb_api import MovieDB
+import streamlit as st
+
+from cache import MemoryCache, SingleFlight
+from catalogue import Catalogue
+from conftest import make_movie
+from movie_index import MovieIndex
+from tmdb_api import (
+    BACKGROUND,
+    INTERACTIVE,
+    MovieDB,
+    RequestScheduler,
+    RequestShedError,
+    TMDBTransport,
+    decode_movie_page,
+    request_priority,
+)
+
+
+class StubResponse:
+    def __init__(self, data, status=200):
+        self.content = json.dumps(data).encode()
+        self.ok = status < 400
+
+
+class StubTransport:
+    """Answers TMDB requests with `respond(endpoint, params)` and records them"""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+
+    def get(self, url, params, acquire=None):
+        endpoint = url.rsplit("/3/", 1)[-1]
+        params = {key: value for key, value in params.items() if key != "api_key"}
+        self.requests.append((endpoint, params))
+        return StubResponse(self.respond(endpoint, params))
+
+    async def get_async(self, url, params, acquire=None):
+        endpoint = url.rsplit("/3/", 1)[-1]
+        params = {key: value for key, value in params.items() if key != "api_key"}
+        self.requests.append((endpoint, params))
+        data = self.respond(endpoint, params)
+        if asyncio.iscoroutine(data):
+            data = await data
+        return True, data
+
+
+@pytest.fixture
+def make_movie_db(monkeypatch):
+    monkeypatch.setattr(
+        st,
+        "secrets",
+        {
+            "tmdb_apikey": "key",
+            "tmdb_accesstoken": "token",
+            "tmdb_base_url": "https://tmdb.test/3/",
+        },
+    )
+
+    def make(respond, **kwargs):
+        transport = StubTransport(respond)
+        movie_db = MovieDB(
+            cache=kwargs.pop("cache", MemoryCache()),
+            transport=transport,
+            movie_index=MovieIndex(),
+            flights=SingleFlight(),
+            catalogue=Catalogue(),
+            scheduler=RequestScheduler(),
+            **kwargs,
+        )
+        return movie_db, transport
+
+    return make
 
 
 def test_movie_db():
     movie_db = MovieDB()
-    movies = movie_db.get_popular_movies()
-    assert len(movies) > 0
-    genres = movie_db.get_genres()
-    assert len(genres) > 0
+    movies = movie_db.discover_movies()
+    assert len(movies.results) > 0
+    genres = movie_db.get_movie_genres()
+    assert len(genres.genres) > 0
+
+
+def test_decode_movie_page_tolerates_bad_rows():
+    raw = json.dumps(
+        {
+            "page": 2,
+            "results": [
+                {"id": 1, "title": "Alien", "poster_path": None, "vote_average": 8.2},
+                {"id": 2, "title": "Broken", "vote_average": 11},
+                {"title": "No id", "genre_ids": None},
+            ],
+            "total_pages": 3,
+            "total_results": 45,
+        }
+    ).encode("utf-8")
+    page = decode_movie_page(raw)
+    assert page.page == 2 and page.total_pages == 3
+    assert len(page.records) == 3
+    assert [record.id for record in page.valid_records()] == [1]
+    movie = page.records[0].to_movie()
+    assert movie.title == "Alien" and movie.poster_path is None
+    assert page.records[1].errors() == ["vote_average must be between 0 and 10"]
+
+
+def wait_for_queued(scheduler, priority, count, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while scheduler.stats()[priority]["queued"] < count:
+        assert time.monotonic() < deadline, f"{count} {priority} requests never queued"
+        time.sleep(0.001)
+
+
+def test_scheduler_serves_interactive_requests_first():
+    # A token every 200 ms leaves the queue time to fill before the first grant
+    scheduler = RequestScheduler(rate=5, burst=2, background_reserve=0)
+    scheduler.acquire()
+    scheduler.acquire()
+    order = []
+
+    def request(priority):
+        with request_priority(priority):
+            scheduler.acquire()
+        order.append(priority)
+
+    threads = [threading.Thread(target=request, args=(BACKGROUND,)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    # The background requests are queued before the interactive one arrives
+    wait_for_queued(scheduler, BACKGROUND, 3)
+    threads.append(threading.Thread(target=request, args=(INTERACTIVE,)))
+    threads[-1].start()
+    for thread in threads:
+        thread.join(5)
+    assert order[0] == INTERACTIVE
+    assert scheduler.stats()[BACKGROUND]["granted"] == 3
+
+
+def test_scheduler_keeps_a_reserve_for_interactive_requests():
+    scheduler = RequestScheduler(
+        rate=1, burst=4, background_reserve=0.5, max_wait={BACKGROUND: 0.05}
+    )
+    scheduler.acquire(BACKGROUND)
+    scheduler.acquire(BACKGROUND)
+    # The last two tokens are reserved, so background work is deferred and then shed
+    with pytest.raises(RequestShedError):
+        scheduler.acquire(BACKGROUND)
+    scheduler.acquire(INTERACTIVE)
+    scheduler.acquire(INTERACTIVE)
+    stats = scheduler.stats()
+    assert stats[BACKGROUND]["shed"] == 1 and stats[INTERACTIVE]["granted"] == 2
+
+
+def test_full_queue_sheds_background_requests_first():
+    scheduler = RequestScheduler(rate=0.01, burst=1, max_queue=1)
+    scheduler.acquire()
+    errors = []
+
+    def background():
+        try:
+            scheduler.acquire(BACKGROUND)
+        except RequestShedError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=background)
+    thread.start()
+    wait_for_queued(scheduler, BACKGROUND, 1)
+    interactive = threading.Thread(target=lambda: scheduler.acquire(INTERACTIVE))
+    interactive.daemon = True
+    interactive.start()
+    thread.join(5)
+    assert len(errors) == 1
+    # An interactive request cannot shed another interactive one
+    with pytest.raises(RequestShedError):
+        scheduler.acquire(INTERACTIVE)
+
+
+def test_async_acquire_waits_for_tokens_and_throttle():
+    scheduler = RequestScheduler(rate=50, burst=1)
+
+    async def run():
+        started = time.monotonic()
+        await scheduler.acquire_async()
+        scheduler.throttle(0.1)
+        await scheduler.acquire_async()
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) >= 0.1
+    assert scheduler.stats()[INTERACTIVE]["granted"] == 2
+
+
+def test_throttle_does_not_credit_the_pause_as_a_burst():
+    scheduler = RequestScheduler(rate=25, burst=5)
+    for _ in range(5):
+        scheduler.acquire()
+    scheduler.throttle(0.2)
+    time.sleep(0.25)
+    # Only the 50ms since the end of the pause are credited, about one token
+    granted = 0
+    with pytest.raises(RequestShedError):
+        for _ in range(5):
+            scheduler.acquire(timeout=0)
+            granted += 1
+    assert 1 <= granted <= 2
+    scheduler.acquire()
+
+
+def test_acquire_gives_up_after_its_timeout():
+    scheduler = RequestScheduler(rate=0.01, burst=1)
+    scheduler.acquire()
+    with pytest.raises(RequestShedError):
+        scheduler.acquire(timeout=0.05)
+    stats = scheduler.stats()[INTERACTIVE]
+    assert (stats["queued"], stats["shed"]) == (0, 1)
+
+
+def test_waiters_of_a_closed_loop_do_not_stop_dispatch():
+    scheduler = RequestScheduler(rate=20, burst=1)
+    scheduler.acquire()
+    loop = asyncio.new_event_loop()
+    loop.create_task(scheduler.acquire_async())
+    loop.run_until_complete(asyncio.sleep(0))
+    wait_for_queued(scheduler, INTERACTIVE, 1)
+    loop.close()
+    # The closed loop's waiter is granted and dropped, the next request is still served
+    scheduler.acquire(timeout=1.0)
+    assert scheduler.stats()[INTERACTIVE]["granted"] == 3
+
+
+def test_transport_closes_the_session_of_a_previous_loop():
+    transport = TMDBTransport()
+
+    async def session():
+        return transport.async_session()
+
+    first_loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=first_loop.run_forever, daemon=True)
+    thread.start()
+    first = asyncio.run_coroutine_threadsafe(session(), first_loop).result()
+
+    async def switch():
+        second = transport.async_session()
+        await transport.close_async()
+        return second
+
+    second = asyncio.run(switch())
+    # The close was scheduled on the first loop before this no-op
+    asyncio.run_coroutine_threadsafe(asyncio.sleep(0), first_loop).result()
+    assert first.closed and second.closed
+    first_loop.call_soon_threadsafe(first_loop.stop)
+    thread.join(5)
+    first_loop.close()
+
+
+class RateLimitedHandler(BaseHTTPRequestHandler):
+    # Every other request is answered 429, starting with the first
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        limited = type(self).requests % 2 == 1
+        body = b'{"error": "rate limited"}' if limited else b'{"results": []}'
+        self.send_response(429 if limited else 200)
+        if limited:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_transport_retries_take_a_token_and_report_every_429():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RateLimitedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/3/discover/movie"
+    transport = TMDBTransport(max_retries=3, backoff_factor=0.0)
+    throttled, tokens = [], []
+    transport.on_rate_limited = throttled.append
+
+    response = transport.get(url, {}, acquire=lambda: tokens.append("sync"))
+    assert response.status_code == 200
+    assert tokens == ["sync", "sync"] and throttled == [0.0]
+
+    async def acquire():
+        tokens.append("async")
+
+    async def get():
+        try:
+            return await transport.get_async(url, {}, acquire=acquire)
+        finally:
+            await transport.close_async()
+
+    assert asyncio.run(get()) == (True, {"results": []})
+    assert tokens.count("async") == 2 and throttled == [0.0, 0.0]
+    server.shutdown()
+    server.server_close()
+    transport.close()
+
+
+def test_resolve_tmdb_id_tells_same_title_movies_apart_by_poster(make_movie_db):
+    dunes = [
+        {"id": 841, "title": "Dune", "poster_path": "/1984.jpg", "popularity": 20.0},
+        {"id": 438631, "title": "Dune", "poster_path": "/2021.jpg", "popularity": 90.0},
+        {"id": 1, "title": "Dune Drifter", "poster_path": None, "popularity": 99.0},
+    ]
+    movie_db, _ = make_movie_db(lambda endpoint, params: {"results": dunes})
+    assert movie_db.resolve_tmdb_id("Dune", "/1984.jpg") == 841
+    assert movie_db.resolve_tmdb_id("dune", "/2021.jpg") == 438631
+    # Without a matching poster the popular remake is not guessed
+    assert movie_db.resolve_tmdb_id("Dune", None) is None
+    assert movie_db.resolve_tmdb_id("Dune", "/other.jpg") is None
+    assert movie_db.resolve_tmdb_id("Dune Drifter") == 1
+
+
+def discover_page(page, ids, total_pages=10):
+    return {
+        "page": page,
+        "total_pages": total_pages,
+        "results": [make_movie(movie_id) for movie_id in ids],
+    }
+
+
+def requested_pages(transport):
+    return sorted(params["page"] for _, params in transport.requests)
+
+
+def test_search_asks_tmdb_when_the_index_only_matches_overviews(make_movie_db):
+    movie_db, transport = make_movie_db(
+        lambda endpoint, params: {"results": [make_movie(99, "Heist")]}
+    )
+    movie_db.movie_index.add(
+        make_movie(i, overview="A heist goes wrong.") for i in range(1, 7)
+    )
+    movies = asyncio.run(movie_db.search_movies("heist"))
+    assert [movie.id for movie in movies] == [99]
+    assert transport.requests == [("search/movie", {"query": "heist"})]
+
+
+def test_discover_movies_skips_bad_rows(make_movie_db):
+    def respond(endpoint, params):
+        data = discover_page(1, [1, 2, 3], total_pages=2)
+        data["results"][1]["vote_average"] = 11
+        data["results"][2]["id"] = None
+        return data
+
+    movie_db, transport = make_movie_db(respond)
+    response = movie_db.discover_movies()
+    assert [movie.id for movie in response.results] == [1]
+    assert response.total_pages == 2
+    assert response.fetched_at is not None
+
+
+def test_discover_pages_dedupes_movies_and_stops_at_max_pages(make_movie_db):
+    # Each page repeats the last movie of the page before
+    movie_db, transport = make_movie_db(
+        lambda endpoint, params: discover_page(
+            params["page"], [params["page"] * 10 - 10, params["page"] * 10]
+        )
+    )
+
+    async def collect():
+        pages = movie_db.discover_movies_pages({"page": 7}, max_pages=3)
+        return [movie.id async for movie in pages]
+
+    ids = asyncio.run(collect())
+    assert sorted(ids) == [0, 10, 20, 30]
+    assert requested_pages(transport) == [1, 2, 3]
+
+
+def test_discover_pages_caps_the_requests_in_flight(make_movie_db):
+    in_flight, peak = [0], [0]
+
+    async def respond(endpoint, params):
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        return discover_page(params["page"], [params["page"]])
+
+    movie_db, transport = make_movie_db(respond)
+
+    async def collect():
+        pages = movie_db.discover_movies_pages({}, max_pages=8, concurrency=2)
+        return [movie.id async for movie in pages]
+
+    assert sorted(asyncio.run(collect())) == list(range(1, 9))
+    assert peak[0] == 2
+
+
+def test_closing_discover_pages_early_cancels_the_pending_pages(make_movie_db):
+    release = None
+
+    async def respond(endpoint, params):
+        if params["page"] > 1:
+            await release.wait()
+        return discover_page(params["page"], [params["page"]])
+
+    movie_db, transport = make_movie_db(respond)
+
+    async def consume():
+        nonlocal release
+        release = asyncio.Event()
+        pages = movie_db.discover_movies_pages({}, max_pages=6, concurrency=2)
+        first = await pages.__anext__()
+        # The consumer goes away while pages 2 and 3 hold the two slots, as AsyncManager.iterate
+        # does when its sync generator is closed
+        waiting = asyncio.ensure_future(pages.__anext__())
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        await pages.aclose()
+        release.set()
+        await asyncio.sleep(0.01)
+        return first.id
+
+    assert asyncio.run(consume()) == 1
+    # Pages 4 to 6 never got a slot
+    assert requested_pages(transport) == [1, 2, 3]
+
+
+def test_movie_db_serves_repeat_calls_from_the_cache(make_movie_db):
+    movie_db, transport = make_movie_db(
+        lambda endpoint, params: {"genres": [{"id": 28, "name": "Action"}]}
+    )
+    first = movie_db.get_json("genre/movie/list", {}, "genres")
+    assert movie_db.get_json("genre/movie/list", {}, "genres") == first
+    assert len(transport.requests) == 1
+    # Other params are another cache entry
+    movie_db.get_json("genre/movie/list", {"language": "fr"}, "genres")
+    assert len(transport.requests) == 2
+
+
+def test_movie_db_caches_each_endpoint_for_its_own_ttl(make_movie_db, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    movie_db, transport = make_movie_db(
+        lambda endpoint, params: {"results": []},
+        cache_ttls={"discover": 60, "genres": 600},
+    )
+
+    def fetch_both():
+        movie_db.get_json("discover/movie", {"page": 1}, "discover")
+        movie_db.get_json("genre/movie/list", {}, "genres")
+
+    fetch_both()
+    now[0] += 59
+    fetch_both()
+    assert len(transport.requests) == 2
+    # Only the discover page has expired and is fetched again
+    now[0] += 2
+    fetch_both()
+    assert [endpoint for endpoint, _ in transport.requests] == [
+        "discover/movie",
+        "genre/movie/list",
+        "discover/movie",
+    ]
+    now[0] += 600
+    fetch_both()
+    assert len(transport.requests) == 5
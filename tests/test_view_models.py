@@ -0,0 +1,98 @@
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from db import WatchlistMovie
+from view_models import ResultStore, WatchlistState, query_hash
+
+
+class FakeMovieOperations:
+    def __init__(self, tmdb_ids):
+        self.tmdb_ids = tmdb_ids
+        self.queries = 0
+
+    def get_tmdb_ids_for_user(self, user_id):
+        self.queries += 1
+        return {tmdb_id for tmdb_id in self.tmdb_ids if tmdb_id is not None}
+
+    def get_watchlist_page(self, user_id, limit=20, after_id=None):
+        self.queries += 1
+        movies = [
+            WatchlistMovie(row_id, f"Movie {tmdb_id}", None, tmdb_id)
+            for row_id, tmdb_id in enumerate(self.tmdb_ids, start=1)
+            if after_id is None or row_id > after_id
+        ]
+        if len(movies) > limit:
+            return movies[:limit], movies[limit - 1].id
+        return movies, None
+
+
+def test_query_hash_ignores_field_order():
+    assert query_hash({"genres": ["Action"], "rating_range": [0, 10]}) == query_hash(
+        {"rating_range": [0, 10], "genres": ["Action"]}
+    )
+    assert query_hash({"genres": ["Action"]}) != query_hash({"genres": ["Drama"]})
+
+
+def test_result_store_keeps_result_sets_across_reruns():
+    session_state = {}
+    store = ResultStore(session_state, max_sets=2)
+    result_set = store.put("a", list(range(25)), page_size=10)
+    store.activate("search", "a")
+    assert result_set.page_count == 3
+    result_set.go_to(5)
+    assert result_set.visible() == [20, 21, 22, 23, 24]
+
+    # A rerun builds a new store over the same session state
+    store = ResultStore(session_state, max_sets=2)
+    assert store.active("search") is result_set
+    assert store.active("search").page == 2
+
+    store.put("b", [])
+    store.put("c", [])
+    assert store.get("a") is None
+    assert store.active("search") is None
+
+
+def test_watchlist_state_is_loaded_once_per_user():
+    session_state = {}
+    movie_operations = FakeMovieOperations([550, 680, None])
+    watchlist = WatchlistState(session_state)
+    assert watchlist.load(1, movie_operations) == {550, 680}
+    watchlist.load(1, movie_operations)
+    assert movie_operations.queries == 1
+
+    watchlist.add(13)
+    watchlist.discard([550])
+    assert watchlist.contains(13) and not watchlist.contains(550)
+
+    watchlist.load(2, movie_operations)
+    assert movie_operations.queries == 2
+    watchlist.reset()
+    assert not watchlist.contains(680)
+
+
+def test_watchlist_pages_are_memoized_until_a_write():
+    session_state = {}
+    movie_operations = FakeMovieOperations([550, 680, 13, 24, 603])
+    watchlist = WatchlistState(session_state)
+    watchlist.load(1, movie_operations)
+    page, cursor = watchlist.page(1, movie_operations, limit=2)
+    assert [movie.tmdb_id for movie in page] == [550, 680]
+    page, cursor = watchlist.page(1, movie_operations, limit=2, after_id=cursor)
+    assert [movie.tmdb_id for movie in page] == [13, 24]
+    page, cursor = watchlist.page(1, movie_operations, limit=2, after_id=cursor)
+    assert [movie.tmdb_id for movie in page] == [603] and cursor is None
+    assert movie_operations.queries == 4
+    # Going back to a page visited before does not query it again
+    page, _ = watchlist.page(1, movie_operations, limit=2)
+    assert [movie.tmdb_id for movie in page] == [550, 680]
+    assert movie_operations.queries == 4
+
+    # A write drops the pages but the membership stays known
+    watchlist.discard([680])
+    assert not watchlist.contains(680) and watchlist.contains(550)
+    watchlist.page(1, movie_operations, limit=2)
+    assert movie_operations.queries == 5
@@ -0,0 +1,144 @@
+import pytest
+import sys
+import os
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from sqlalchemy import create_engine
+
+from catalogue import Catalogue
+from conftest import make_movie
+from db import MovieOperations
+from tmdb_api import Genre, GenresResponse, Movie, MovieResponse
+from warmup import WarmupScheduler
+
+
+class FakeMovieDB:
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.catalogue = Catalogue()
+
+    def get_movie_genres(self):
+        self.calls.append("genres")
+        self.started.set()
+        self.release.wait(5)
+        return GenresResponse(genres=[Genre(id=28, name="Action")])
+
+    def discover_movies(self):
+        self.calls.append("discover")
+        results = [
+            Movie(**make_movie(1, genre_ids=[28, 12])),
+            Movie(**make_movie(2, genre_ids=[28])),
+            Movie(**make_movie(3, genre_ids=[35])),
+        ]
+        return MovieResponse(
+            page=1, results=results, total_pages=1, total_results=len(results)
+        )
+
+    def resolve_tmdb_id(self, title, poster_path=None):
+        self.calls.append(f"resolve:{title}")
+        return 1
+
+    def sync_catalogue(self):
+        self.calls.append("sync")
+        return self.catalogue.sync(lambda start, end: [], lambda movie_id: None)
+
+
+def test_refresh_prefetches_the_home_page_data():
+    movie_db = FakeMovieDB()
+    warmup = WarmupScheduler(movie_db)
+    warmup.refresh()
+    assert movie_db.calls == ["genres", "discover"]
+    assert warmup.genres().value.genres[0].name == "Action"
+    assert len(warmup.discover().value.results) == 3
+    assert movie_db.calls.count("genres") == 1
+
+
+def test_snapshots_keep_the_time_tmdb_sent_the_data():
+    movie_db = FakeMovieDB()
+    discover_movies = movie_db.discover_movies
+
+    def cached_discover_movies():
+        # A response read from the cache still carries the time it was fetched at
+        response = discover_movies()
+        response.fetched_at = 1000.0
+        return response
+
+    movie_db.discover_movies = cached_discover_movies
+    warmup = WarmupScheduler(movie_db)
+    warmup.refresh()
+    assert warmup.discover().fetched_at == 1000.0
+    assert warmup.genres().age() < 60
+
+
+def test_readers_wait_for_the_first_warmup():
+    movie_db = FakeMovieDB()
+    movie_db.release.clear()
+    warmup = WarmupScheduler(movie_db, interval=60)
+    warmup.start()
+    assert movie_db.started.wait(5)
+
+    snapshots = []
+    readers = [
+        threading.Thread(target=lambda: snapshots.append(warmup.genres()))
+        for _ in range(8)
+    ]
+    for reader in readers:
+        reader.start()
+    movie_db.release.set()
+    for reader in readers:
+        reader.join(5)
+    warmup.stop(5)
+
+    assert len(snapshots) == 8
+    assert len({id(snapshot) for snapshot in snapshots}) == 1
+    assert movie_db.calls.count("genres") == 1
+
+
+def test_failed_refresh_keeps_the_previous_snapshot():
+    movie_db = FakeMovieDB()
+    warmup = WarmupScheduler(movie_db)
+    warmup.refresh()
+    previous = warmup.discover()
+
+    def fail():
+        raise ConnectionError("TMDB is down")
+
+    movie_db.discover_movies = fail
+    warmup.refresh()
+    assert warmup.discover() is previous
+    assert warmup.failures == 1
+
+
+def test_catalogue_is_synced_once_per_interval():
+    movie_db = FakeMovieDB()
+    warmup = WarmupScheduler(movie_db, catalogue_sync_interval=3600)
+    warmup.sync_catalogue()
+    warmup.sync_catalogue()
+    assert movie_db.calls == ["sync"]
+
+
+def test_watchlist_rows_are_backfilled_until_a_run_succeeds(tmp_path):
+    movie_ops = MovieOperations(create_engine(f"sqlite:///{tmp_path / 'cinematch.db'}"))
+    movie_ops.add_movie_for_user(1, "Movie 1")
+    movie_db = FakeMovieDB()
+    warmup = WarmupScheduler(movie_db, movie_operations=movie_ops)
+
+    def fail(title, poster_path):
+        raise ConnectionError("TMDB is down")
+
+    resolve_tmdb_id = movie_db.resolve_tmdb_id
+    movie_db.resolve_tmdb_id = fail
+    warmup.backfill_tmdb_ids()
+    assert not warmup.backfilled and warmup.failures == 1
+
+    movie_db.resolve_tmdb_id = resolve_tmdb_id
+    warmup.backfill_tmdb_ids()
+    warmup.backfill_tmdb_ids()
+    assert warmup.backfilled
+    assert movie_db.calls == ["resolve:Movie 1"]
+    assert movie_ops.get_movies_for_user(1)[0].tmdb_id == 1
@@ -1,11 +1,618 @@
 # Import the required libraries
 import streamlit as st
 import requests as req
-from typing import List, Dict, Any, Optional
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 from datetime import datetime
 import aiohttp
 import asyncio
+import atexit
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode
 from pydantic import BaseModel, validator
+from requests.adapters import HTTPAdapter
+
+from cache import MemoryCache, DiskCache, SingleFlight
+from catalogue import Catalogue, movie_from_details
+from metrics import metrics, trace_methods
+from movie_index import MovieIndex, normalize_query
+
+try:
+    # orjson decodes TMDB payloads several times faster than the standard library
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Default time-to-live (in seconds) of the cached responses for each TMDB endpoint
+DEFAULT_CACHE_TTLS: Dict[str, float] = {
+    "genres": 6 * 60 * 60,
+    "discover": 10 * 60,
+    "search": 30 * 60,
+    "details": 24 * 60 * 60,
+    "changes": 60 * 60,
+}
+
+# TMDB refuses to serve discover pages past this one
+TMDB_MAX_PAGE = 500
+
+# Key of the time a response was fetched from TMDB, stored with it in the response cache
+FETCHED_AT = "_fetched_at"
+
+# Priority classes of the TMDB requests, lower values are served first
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+PRIORITIES: Dict[str, int] = {INTERACTIVE: 0, BACKGROUND: 1}
+
+# HTTP status codes that are worth retrying: rate limited or a transient server error
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_response_cache = None
+_transport = None
+_movie_index = None
+_flights = None
+_catalogue = None
+_scheduler = None
+
+# Priority class of the TMDB requests made by the current thread or task
+_request_priority: ContextVar[str] = ContextVar(
+    "tmdb_request_priority", default=INTERACTIVE
+)
+
+
+def get_response_cache():
+    """
+    This function returns the process-wide TMDB response cache. The cache lives on disk when
+    `tmdb_cache_path` is set in the secrets (so several app workers share it), otherwise in memory.
+    """
+    global _response_cache
+    if _response_cache is None:
+        cache_path = st.secrets.get("tmdb_cache_path")
+        max_entries = int(st.secrets.get("tmdb_cache_max_entries", 1024))
+        if cache_path:
+            _response_cache = DiskCache(cache_path, max_entries=max_entries)
+        else:
+            _response_cache = MemoryCache(max_entries=max_entries)
+    return _response_cache
+
+
+def get_movie_index() -> MovieIndex:
+    """
+    This function returns the process-wide local movie index. It is kept on disk at
+    `movie_index_path` when that is set in the secrets.
+    """
+    global _movie_index
+    if _movie_index is None:
+        _movie_index = MovieIndex(st.secrets.get("movie_index_path"))
+        _movie_index.start_autosave()
+        atexit.register(_movie_index.save_if_dirty)
+    return _movie_index
+
+
+def get_catalogue() -> Catalogue:
+    """
+    This function returns the process-wide catalogue of TMDB movie records and genres. It is kept
+    in a SQLite file at `catalogue_path` when that is set in the secrets.
+    """
+    global _catalogue
+    if _catalogue is None:
+        _catalogue = Catalogue(
+            st.secrets.get("catalogue_path"),
+            max_age=float(st.secrets.get("catalogue_max_age", 14 * 24 * 60 * 60)),
+        )
+    return _catalogue
+
+
+def get_single_flight() -> SingleFlight:
+    """
+    This function returns the process-wide SingleFlight that coalesces identical concurrent TMDB
+    requests made by different sessions.
+    """
+    global _flights
+    if _flights is None:
+        _flights = SingleFlight()
+    return _flights
+
+
+def get_scheduler() -> "RequestScheduler":
+    """
+    This function returns the process-wide scheduler every TMDB request goes through, so all the
+    sessions and the background jobs share one rate limit.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RequestScheduler(
+            rate=float(st.secrets.get("tmdb_rate_limit", 40)),
+            burst=float(st.secrets.get("tmdb_burst", 20)),
+            max_queue=int(st.secrets.get("tmdb_queue_size", 100)),
+            background_reserve=float(st.secrets.get("tmdb_background_reserve", 0.25)),
+        )
+    return _scheduler
+
+
+@contextmanager
+def request_priority(priority: str) -> Iterator[None]:
+    """
+    This context manager sets the priority class of the TMDB requests made inside it.
+    """
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+def get_transport():
+    """
+    This function returns the process-wide pooled HTTP transport used by every MovieDB instance,
+    so the TLS connections to TMDB are reused across Streamlit reruns.
+    """
+    global _transport
+    if _transport is None:
+        _transport = TMDBTransport(
+            pool_size=int(st.secrets.get("tmdb_pool_size", 10)),
+            limit_per_host=int(st.secrets.get("tmdb_pool_limit_per_host", 10)),
+            timeout=float(st.secrets.get("tmdb_timeout", 10.0)),
+            max_retries=int(st.secrets.get("tmdb_max_retries", 3)),
+        )
+        # Rate limited responses pause the scheduler for the time TMDB asks for
+        _transport.on_rate_limited = get_scheduler().throttle
+    return _transport
+
+
+async def close_transport_async() -> None:
+    """
+    This function closes the pooled async session of the process-wide transport, it must be awaited
+    on the event loop the session was created on.
+    """
+    if _transport is not None:
+        await _transport.close_async()
+
+
+class RequestShedError(Exception):
+    """Raised when the scheduler drops a TMDB request instead of queueing it any longer"""
+
+
+class _Waiter:
+    __slots__ = ("priority", "enqueued_at", "event", "future", "granted", "error")
+
+    def __init__(self, priority: str, future: Optional[asyncio.Future] = None):
+        self.priority: str = priority
+        self.enqueued_at: float = time.monotonic()
+        self.event: Optional[threading.Event] = None if future else threading.Event()
+        self.future: Optional[asyncio.Future] = future
+        self.granted: bool = False
+        self.error: Optional[Exception] = None
+
+
+class RequestScheduler:
+    """
+    RequestScheduler is a token bucket of `rate` requests per second (up to `burst` at once) that
+    every TMDB request takes a token from. Requests that find the bucket empty wait in a priority
+    queue: interactive requests are served before background ones, and background requests leave
+    `background_reserve` of the burst to interactive ones, so they are deferred first when the app
+    gets close to the limit.
+
+    The queue holds at most `max_queue` requests. When it is full, a request sheds the newest
+    request of a lower class, or is itself shed; requests that waited longer than the `max_wait` of
+    their class are shed too. Shed requests raise RequestShedError.
+    """
+
+    def __init__(
+        self,
+        rate: float = 40.0,
+        burst: float = 20.0,
+        max_queue: int = 100,
+        background_reserve: float = 0.25,
+        max_wait: Optional[Dict[str, float]] = None,
+        window: int = 1024,
+    ) -> None:
+        self.rate: float = rate
+        self.burst: float = burst
+        self.max_queue: int = max_queue
+        self.max_wait: Dict[str, float] = {
+            INTERACTIVE: 10.0,
+            BACKGROUND: 60.0,
+            **(max_wait or {}),
+        }
+        # Tokens a class needs in the bucket before it may take one
+        self.thresholds: Dict[str, float] = {
+            INTERACTIVE: 1.0,
+            BACKGROUND: 1.0 + background_reserve * burst,
+        }
+        self.tokens: float = burst
+        self.paused_until: float = 0.0
+        self.granted: Dict[str, int] = dict.fromkeys(PRIORITIES, 0)
+        self.queued: Dict[str, int] = dict.fromkeys(PRIORITIES, 0)
+        self.shed: Dict[str, int] = dict.fromkeys(PRIORITIES, 0)
+        self.waits: Dict[str, deque] = {
+            priority: deque(maxlen=window) for priority in PRIORITIES
+        }
+        self._updated: float = time.monotonic()
+        self._queue: List[Tuple[int, int, _Waiter]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._dispatcher: Optional[threading.Thread] = None
+
+    def _refill(self, now: float) -> None:
+        # Nothing is credited before the end of a pause
+        if now <= self._updated:
+            return
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self, priority: str, now: float) -> bool:
+        self._refill(now)
+        if now < self.paused_until or self.tokens < self.thresholds[priority]:
+            return False
+        self.tokens -= 1
+        return True
+
+    def _head(self) -> Optional[_Waiter]:
+        # Waiters that gave up or were shed stay in the heap until they reach its top
+        while self._queue and (
+            self._queue[0][2].granted or self._queue[0][2].error is not None
+        ):
+            heapq.heappop(self._queue)
+        return self._queue[0][2] if self._queue else None
+
+    def _record(self, priority: str, wait: float) -> None:
+        self.granted[priority] += 1
+        self.waits[priority].append(wait)
+        if metrics.enabled:
+            metrics.record(f"tmdb.scheduler.wait.{priority}", wait)
+
+    def _grant(self, waiter: _Waiter, now: float) -> None:
+        waiter.granted = True
+        self._dequeued(waiter)
+        self._record(waiter.priority, now - waiter.enqueued_at)
+        self._wake(waiter)
+
+    def _reject(self, waiter: _Waiter, reason: str) -> None:
+        waiter.error = RequestShedError(reason)
+        self._dequeued(waiter)
+        self.shed[waiter.priority] += 1
+        self._wake(waiter)
+
+    def _dequeued(self, waiter: _Waiter) -> None:
+        self.queued[waiter.priority] -= 1
+        if metrics.enabled:
+            metrics.set_gauge(
+                f"tmdb.scheduler.queue_depth.{waiter.priority}",
+                self.queued[waiter.priority],
+            )
+
+    @staticmethod
+    def _wake(waiter: _Waiter) -> None:
+        if waiter.event is not None:
+            waiter.event.set()
+            return
+        future = waiter.future
+        try:
+            future.get_loop().call_soon_threadsafe(
+                lambda: future.done() or future.set_result(None)
+            )
+        except RuntimeError:
+            # The waiter's event loop was closed, nobody is left to wake
+            pass
+
+    def _enqueue(self, waiter: _Waiter) -> None:
+        if sum(self.queued.values()) >= self.max_queue:
+            # Make room by shedding the newest request of the lowest class below this one
+            victims = [
+                entry
+                for entry in self._queue
+                if not entry[2].granted
+                and entry[2].error is None
+                and entry[0] > PRIORITIES[waiter.priority]
+            ]
+            if not victims:
+                self.shed[waiter.priority] += 1
+                raise RequestShedError("The TMDB request queue is full")
+            self._reject(max(victims)[2], "Shed for a request of a higher class")
+        heapq.heappush(
+            self._queue, (PRIORITIES[waiter.priority], next(self._sequence), waiter)
+        )
+        self.queued[waiter.priority] += 1
+        if metrics.enabled:
+            metrics.set_gauge(
+                f"tmdb.scheduler.queue_depth.{waiter.priority}",
+                self.queued[waiter.priority],
+            )
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(
+                target=self._dispatch, name="tmdb-scheduler", daemon=True
+            )
+            self._dispatcher.start()
+        self._condition.notify()
+
+    def _can_skip_queue(self, priority: str) -> bool:
+        head = self._head()
+        return head is None or PRIORITIES[head.priority] > PRIORITIES[priority]
+
+    def _dispatch(self) -> None:
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                head = self._head()
+                while head is not None and self._take(head.priority, now):
+                    heapq.heappop(self._queue)
+                    self._grant(head, now)
+                    head = self._head()
+                next_deadline = None
+                for _, _, waiter in self._queue:
+                    if waiter.granted or waiter.error is not None:
+                        continue
+                    deadline = waiter.enqueued_at + self.max_wait[waiter.priority]
+                    if deadline <= now:
+                        self._reject(waiter, "Waited too long for a TMDB rate slot")
+                    elif next_deadline is None or deadline < next_deadline:
+                        next_deadline = deadline
+                head = self._head()
+                if head is None:
+                    self._condition.wait()
+                    continue
+                # Sleep until the head can take a token or a waiter times out
+                missing = max(self.thresholds[head.priority] - self.tokens, 0.0)
+                wake_at = max(now, self.paused_until) + missing / self.rate
+                self._condition.wait(max(min(wake_at, next_deadline) - now, 0.001))
+
+    def acquire(
+        self, priority: Optional[str] = None, timeout: Optional[float] = None
+    ) -> None:
+        """
+        This method blocks until the calling thread may send a TMDB request. The priority class
+        defaults to the one set with `request_priority`, and the wait is given up with
+        RequestShedError after `timeout` seconds (the `max_wait` of the class by default).
+        """
+        priority = priority or _request_priority.get()
+        with self._condition:
+            now = time.monotonic()
+            if self._can_skip_queue(priority) and self._take(priority, now):
+                self._record(priority, 0.0)
+                return
+            waiter = _Waiter(priority)
+            self._enqueue(waiter)
+        if timeout is None:
+            timeout = self.max_wait[priority]
+        if not waiter.event.wait(timeout):
+            with self._condition:
+                if not waiter.granted and waiter.error is None:
+                    waiter.error = RequestShedError(
+                        "Waited too long for a TMDB rate slot"
+                    )
+                    self._dequeued(waiter)
+                    self.shed[priority] += 1
+        if waiter.error is not None:
+            raise waiter.error
+
+    async def acquire_async(self, priority: Optional[str] = None) -> None:
+        """
+        This method waits, without blocking the event loop, until the task may send a TMDB request.
+        """
+        priority = priority or _request_priority.get()
+        with self._condition:
+            now = time.monotonic()
+            if self._can_skip_queue(priority) and self._take(priority, now):
+                self._record(priority, 0.0)
+                return
+            waiter = _Waiter(priority, asyncio.get_running_loop().create_future())
+            self._enqueue(waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._condition:
+                if not waiter.granted and waiter.error is None:
+                    waiter.error = RequestShedError("Cancelled")
+                    self._dequeued(waiter)
+            raise
+        if waiter.error is not None:
+            raise waiter.error
+
+    def throttle(self, delay: float) -> None:
+        """
+        This method empties the bucket and pauses every class for `delay` seconds, it is called
+        when TMDB answers 429.
+        """
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = 0.0
+            self.paused_until = max(self.paused_until, now + delay)
+            # The bucket refills from the end of the pause, not from the last refill
+            self._updated = self.paused_until
+            self._condition.notify()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        This method returns the granted, shed and queued requests of every class, with the p50 and
+        p95 time they waited in the queue.
+        """
+        with self._condition:
+            stats = {}
+            for priority in PRIORITIES:
+                waits = sorted(self.waits[priority])
+                stats[priority] = {
+                    "granted": self.granted[priority],
+                    "shed": self.shed[priority],
+                    "queued": self.queued[priority],
+                    "p50_wait": waits[int(len(waits) * 0.5)] if waits else 0.0,
+                    "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                }
+            return stats
+
+
+class TMDBTransport:
+    """
+    TMDBTransport class owns one keep-alive `requests.Session` and one `aiohttp.ClientSession`.
+    Both are pooled and have timeouts. `get` and `get_async` retry 429/5xx responses and
+    connection errors with exponential backoff, honouring the `Retry-After` header sent by TMDB;
+    every 429 is reported to `on_rate_limited` as soon as it arrives, and the `acquire` callback
+    runs before every attempt, so retries take their own scheduler token.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        limit_per_host: int = 10,
+        timeout: float = 10.0,
+        connect_timeout: float = 3.05,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        max_backoff: float = 30.0,
+    ) -> None:
+        self.pool_size: int = pool_size
+        self.limit_per_host: int = limit_per_host
+        self.timeout: float = timeout
+        self.connect_timeout: float = connect_timeout
+        self.max_retries: int = max_retries
+        self.backoff_factor: float = backoff_factor
+        self.max_backoff: float = max_backoff
+
+        # Retries are not left to urllib3, they would bypass the scheduler
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=limit_per_host)
+        self.session: req.Session = req.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._async_session: Optional[aiohttp.ClientSession] = None
+        self._async_loop: Optional[asyncio.AbstractEventLoop] = None
+        # Called with the delay TMDB asked for whenever it answers 429
+        self.on_rate_limited: Optional[Callable[[float], None]] = None
+
+    def rate_limited(self, status: int, retry_after: Optional[str]) -> None:
+        if status == 429 and self.on_rate_limited is not None:
+            self.on_rate_limited(self.retry_delay(0, retry_after))
+
+    def get(
+        self,
+        url: str,
+        params: Dict[str, Any],
+        acquire: Optional[Callable[[], None]] = None,
+    ) -> req.Response:
+        """
+        This method sends a GET request over the pooled session, retrying 429/5xx responses and
+        connection errors. `acquire` is called before every attempt.
+        """
+        attempt = 0
+        while True:
+            if acquire is not None:
+                acquire()
+            try:
+                response = self.session.get(
+                    url, params=params, timeout=(self.connect_timeout, self.timeout)
+                )
+            except (req.ConnectionError, req.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.retry_delay(attempt, None)
+            else:
+                retry_after = response.headers.get("Retry-After")
+                self.rate_limited(response.status_code, retry_after)
+                if (
+                    response.status_code not in RETRY_STATUSES
+                    or attempt >= self.max_retries
+                ):
+                    return response
+                delay = self.retry_delay(attempt, retry_after)
+            attempt += 1
+            time.sleep(delay)
+
+    def async_session(self) -> aiohttp.ClientSession:
+        # An aiohttp session is bound to the event loop it was created on
+        loop = asyncio.get_running_loop()
+        if self._async_session is None or self._async_loop is not loop:
+            self._close_async_session()
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, limit_per_host=self.limit_per_host
+            )
+            self._async_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=self.timeout, connect=self.connect_timeout
+                ),
+            )
+            self._async_loop = loop
+        return self._async_session
+
+    def retry_delay(self, attempt: int, retry_after: Optional[str]) -> float:
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = 0.0
+            return min(max(delay, 0.0), self.max_backoff)
+        return min(self.backoff_factor * (2**attempt), self.max_backoff)
+
+    async def get_async(
+        self,
+        url: str,
+        params: Dict[str, Any],
+        acquire: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        """
+        This method sends a GET request over the pooled async session and returns a tuple of
+        (ok, json data), retrying 429/5xx responses and connection errors. `acquire` is awaited
+        before every attempt.
+        """
+        session = self.async_session()
+        attempt = 0
+        while True:
+            if acquire is not None:
+                await acquire()
+            try:
+                async with session.get(url, params=params) as response:
+                    self.rate_limited(
+                        response.status, response.headers.get("Retry-After")
+                    )
+                    if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                        delay = self.retry_delay(
+                            attempt, response.headers.get("Retry-After")
+                        )
+                    else:
+                        return response.ok, json_loads(await response.read())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.retry_delay(attempt, None)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _close_async_session(self) -> None:
+        # The session of another loop is closed on that loop, the sockets of a closed loop are gone
+        session, loop = self._async_session, self._async_loop
+        self._async_session = self._async_loop = None
+        if session is not None and not session.closed and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+    async def close_async(self) -> None:
+        if self._async_loop is asyncio.get_running_loop():
+            session = self._async_session
+            self._async_session = self._async_loop = None
+            await session.close()
+        else:
+            self._close_async_session()
+
+    def close(self) -> None:
+        self.session.close()
 
 
 class Movie(BaseModel):
@@ -19,7 +626,7 @@ class Movie(BaseModel):
     original_title: str
     overview: str
     popularity: float
-    poster_path: str
+    poster_path: Optional[str] = None
     release_date: str = ""
     title: str
     video: bool
@@ -40,6 +647,126 @@ class MovieResponse(BaseModel):
     results: List[Movie]
     total_pages: int
     total_results: int
+    # When TMDB sent the response, which may be older than the call when it came from a cache
+    fetched_at: Optional[float] = None
+
+
+class MovieRecord:
+    """
+    MovieRecord is a compact, unvalidated movie for high-throughput decoding. It has the fields of
+    `Movie`, null or missing fields get a default instead of failing, and validation only runs when
+    `errors()` or `to_movie()` is called.
+    """
+
+    __slots__ = (
+        "id",
+        "title",
+        "original_title",
+        "original_language",
+        "overview",
+        "poster_path",
+        "backdrop_path",
+        "release_date",
+        "genre_ids",
+        "popularity",
+        "vote_average",
+        "vote_count",
+        "adult",
+        "video",
+    )
+
+    def __init__(self, movie: Dict[str, Any]) -> None:
+        get = movie.get
+        self.id = get("id")
+        self.title = get("title") or ""
+        self.original_title = get("original_title") or ""
+        self.original_language = get("original_language") or ""
+        self.overview = get("overview") or ""
+        self.poster_path = get("poster_path")
+        self.backdrop_path = get("backdrop_path")
+        self.release_date = get("release_date") or ""
+        self.genre_ids = get("genre_ids") or []
+        self.popularity = get("popularity") or 0.0
+        self.vote_average = get("vote_average") or 0.0
+        self.vote_count = get("vote_count") or 0
+        self.adult = bool(get("adult"))
+        self.video = bool(get("video"))
+
+    def errors(self) -> List[str]:
+        errors = []
+        if not isinstance(self.id, int):
+            errors.append("id must be an integer")
+        if not isinstance(self.vote_average, (int, float)) or not (
+            0 <= self.vote_average <= 10
+        ):
+            errors.append("vote_average must be between 0 and 10")
+        if not isinstance(self.vote_count, int):
+            errors.append("vote_count must be an integer")
+        if not isinstance(self.popularity, (int, float)):
+            errors.append("popularity must be a number")
+        return errors
+
+    def is_valid(self) -> bool:
+        return not self.errors()
+
+    def to_movie(self) -> Movie:
+        return Movie(**{name: getattr(self, name) for name in self.__slots__})
+
+
+class MoviePage:
+    """MoviePage class holds one page of MovieRecord decoded from a TMDB movie list response"""
+
+    __slots__ = ("page", "records", "total_pages", "total_results", "fetched_at")
+
+    def __init__(
+        self,
+        page: int,
+        records: List[MovieRecord],
+        total_pages: int,
+        total_results: int,
+        fetched_at: Optional[float] = None,
+    ) -> None:
+        self.page = page
+        self.records = records
+        self.total_pages = total_pages
+        self.total_results = total_results
+        self.fetched_at = fetched_at
+
+    @classmethod
+    def from_payload(cls, data: Dict[str, Any]) -> "MoviePage":
+        return cls(
+            page=data.get("page") or 1,
+            records=[MovieRecord(movie) for movie in data.get("results") or ()],
+            total_pages=data.get("total_pages") or 0,
+            total_results=data.get("total_results") or 0,
+            fetched_at=data.get(FETCHED_AT),
+        )
+
+    def valid_records(self) -> List[MovieRecord]:
+        """
+        This method returns the records that pass validation, a bad row never fails the page.
+        """
+        return [record for record in self.records if record.is_valid()]
+
+    def to_response(self) -> MovieResponse:
+        """
+        This method returns the page as a MovieResponse of its valid movies.
+        """
+        return MovieResponse(
+            page=self.page,
+            results=[record.to_movie() for record in self.valid_records()],
+            total_pages=self.total_pages,
+            total_results=self.total_results,
+            fetched_at=self.fetched_at,
+        )
+
+
+def decode_movie_page(raw: bytes) -> MoviePage:
+    """
+    This function decodes the raw JSON bytes of a TMDB movie list response in bulk, without
+    per-field pydantic validation.
+    """
+    return MoviePage.from_payload(json_loads(raw))
 
 
 class Genre(BaseModel):
@@ -53,65 +780,303 @@ class GenresResponse(BaseModel):
     """GenresResponse class to handle the structure of a response from the TMDB API when requesting genres"""
 
     genres: List[Genre]
+    fetched_at: Optional[float] = None
 
 
 # MovieDB class to interact with the TMDB API
+@trace_methods
 class MovieDB:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        cache: Optional[Any] = None,
+        cache_ttls: Optional[Dict[str, float]] = None,
+        transport: Optional[TMDBTransport] = None,
+        movie_index: Optional[MovieIndex] = None,
+        flights: Optional[SingleFlight] = None,
+        catalogue: Optional[Catalogue] = None,
+        scheduler: Optional[RequestScheduler] = None,
+    ) -> None:
         self.api_key: str = st.secrets["tmdb_apikey"]
         self.access_token: str = st.secrets["tmdb_accesstoken"]
-        self.base_url: str = "https://api.themoviedb.org/3/"
+        self.base_url: str = st.secrets.get(
+            "tmdb_base_url", "https://api.themoviedb.org/3/"
+        )
         if self.api_key is None or self.access_token is None:
             raise Exception(
                 "API_KEY or ACCESS_TOKEN is not set in the secrets.toml file"
             )
+        self.cache = cache if cache is not None else get_response_cache()
+        self.cache_ttls: Dict[str, float] = {**DEFAULT_CACHE_TTLS, **(cache_ttls or {})}
+        self.transport: TMDBTransport = transport or get_transport()
+        self.movie_index: MovieIndex = (
+            movie_index if movie_index is not None else get_movie_index()
+        )
+        self.flights: SingleFlight = (
+            flights if flights is not None else get_single_flight()
+        )
+        self.catalogue: Catalogue = (
+            catalogue if catalogue is not None else get_catalogue()
+        )
+        self.scheduler: RequestScheduler = scheduler or get_scheduler()
 
-    def discover_movies(self) -> MovieResponse:
-        url: str = f"{self.base_url}/discover/movie?api_key={self.api_key}"
-        response = req.get(url)
-        data: Dict[str, Any] = response.json()
-        return MovieResponse(
-            page=data["page"],
-            results=[Movie(**movie) for movie in data["results"]],
-            total_pages=data["total_pages"],
-            total_results=data["total_results"],
+    def cache_key(self, endpoint: str, params: Dict[str, Any]) -> str:
+        # The api key is left out so the key is stable and safe to store on disk
+        return f"{endpoint}?{urlencode(sorted(params.items()))}"
+
+    def get_json(
+        self, endpoint: str, params: Dict[str, Any], ttl_name: str
+    ) -> Dict[str, Any]:
+        key = self.cache_key(endpoint, params)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        # Concurrent misses on the same key wait for a single request to TMDB
+        return self.flights.do(
+            key, lambda: self._fetch_json(endpoint, params, ttl_name)
+        )
+
+    def _fetch_json(
+        self, endpoint: str, params: Dict[str, Any], ttl_name: str
+    ) -> Dict[str, Any]:
+        response = self.transport.get(
+            f"{self.base_url}{endpoint}",
+            params={**params, "api_key": self.api_key},
+            acquire=self.scheduler.acquire,
+        )
+        data = json_loads(response.content)
+        if response.ok:
+            data[FETCHED_AT] = time.time()
+            self.cache.set(
+                self.cache_key(endpoint, params), data, self.cache_ttls[ttl_name]
+            )
+            self._remember(data)
+        return data
+
+    async def get_json_async(
+        self, endpoint: str, params: Dict[str, Any], ttl_name: str
+    ) -> Dict[str, Any]:
+        key = self.cache_key(endpoint, params)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        return await self.flights.do_async(
+            key, lambda: self._fetch_json_async(endpoint, params, ttl_name)
+        )
+
+    async def _fetch_json_async(
+        self, endpoint: str, params: Dict[str, Any], ttl_name: str
+    ) -> Dict[str, Any]:
+        ok, data = await self.transport.get_async(
+            f"{self.base_url}{endpoint}",
+            params={**params, "api_key": self.api_key},
+            acquire=self.scheduler.acquire_async,
         )
+        if ok:
+            data[FETCHED_AT] = time.time()
+            self.cache.set(
+                self.cache_key(endpoint, params), data, self.cache_ttls[ttl_name]
+            )
+            self._remember(data)
+        return data
+
+    def _remember(self, data: Dict[str, Any]) -> None:
+        # Every movie and genre list TMDB sends is kept in the local index and catalogue
+        movies = data.get("results")
+        if movies and "title" in movies[0]:
+            self.movie_index.add(movies)
+            self.catalogue.add_movies(movies)
+        if "genres" in data and "id" not in data:
+            self.catalogue.set_genres(data["genres"])
+
+    def cache_stats(self) -> Dict[str, int]:
+        return {**self.cache.stats.as_dict(), "size": len(self.cache)}
+
+    def flight_stats(self) -> Dict[str, int]:
+        return self.flights.stats()
+
+    def scheduler_stats(self) -> Dict[str, Dict[str, float]]:
+        return self.scheduler.stats()
+
+    def discover_movies(self) -> MovieResponse:
+        # The warm-up refreshes this page in the background, a bad row must not fail it
+        return self.discover_movie_records({}).to_response()
 
     def get_movie_genres(self) -> GenresResponse:
-        url: str = f"{self.base_url}genre/movie/list?language=en&api_key={self.api_key}"
-        response = req.get(url)
-        data: Dict[str, Any] = response.json()
-        return GenresResponse(genres=[Genre(**genre) for genre in data["genres"]])
+        data: Dict[str, Any] = self.get_json(
+            "genre/movie/list", {"language": "en"}, "genres"
+        )
+        return GenresResponse(
+            genres=[Genre(**genre) for genre in data["genres"]],
+            fetched_at=data.get(FETCHED_AT),
+        )
+
+    def genre_names(self, genre_ids: List[int]) -> List[str]:
+        """
+        This method maps genre ids to their names from the catalogue, the genre list is only
+        fetched when the catalogue does not know one of them.
+        """
+        if any(genre_id not in self.catalogue.genres() for genre_id in genre_ids):
+            self.get_movie_genres()
+        return self.catalogue.genre_names(genre_ids)
+
+    def lookup_movies(self, movie_ids: List[Optional[int]]) -> Dict[int, Movie]:
+        """
+        This method looks many movies up in the catalogue at once, without calling TMDB. Movies that
+        are unknown, no longer fresh or invalid are left out; missing fields (e.g. the release date
+        of an unreleased title) get the defaults of MovieRecord.
+        """
+        records = {
+            movie_id: MovieRecord(movie)
+            for movie_id, movie in self.catalogue.get_many(movie_ids).items()
+        }
+        return {
+            movie_id: record.to_movie()
+            for movie_id, record in records.items()
+            if record.is_valid()
+        }
+
+    def resolve_tmdb_id(
+        self, title: str, poster_path: Optional[str] = None
+    ) -> Optional[int]:
+        """
+        This method returns the TMDB id of the movie with exactly this title. When several movies
+        share it, the one with this poster is picked; it returns None when no movie has the title
+        or it cannot tell them apart, as remakes and unrelated films share titles. The local index
+        is asked first.
+        """
+        movies = self.movie_index.lookup(title)
+        if movies is None:
+            data = self.get_json("search/movie", {"query": title}, "search")
+            movies = data.get("results", [])
+            self.movie_index.add([], query=title)
+        query = normalize_query(title)
+        matches = [
+            movie for movie in movies if normalize_query(movie["title"]) == query
+        ]
+        if len(matches) > 1 and poster_path:
+            matches = [
+                movie for movie in matches if movie.get("poster_path") == poster_path
+            ]
+        if len(matches) != 1:
+            return None
+        return matches[0]["id"]
+
+    def get_movie_details(self, movie_id: int) -> Optional[Dict[str, Any]]:
+        """
+        This method fetches a movie from TMDB, bypassing the response cache, and returns it in the
+        shape of the list endpoints' movie objects. It returns None when TMDB no longer has it.
+        """
+        data = self._fetch_json(f"movie/{movie_id}", {}, "details")
+        if "id" not in data:
+            # TMDB's "The resource you requested could not be found"
+            if data.get("status_code") == 34:
+                return None
+            raise RuntimeError(
+                f"TMDB movie details failed: {data.get('status_message')}"
+            )
+        movie = movie_from_details(data)
+        self.movie_index.add([movie])
+        return movie
+
+    def get_changed_movie_ids(self, start_date: str, end_date: str) -> List[int]:
+        """
+        This method reads every page of TMDB's movie changes feed between two dates (YYYY-MM-DD).
+        """
+        changed_ids, page, total_pages = [], 1, 1
+        while page <= total_pages:
+            data = self._fetch_json(
+                "movie/changes",
+                {"start_date": start_date, "end_date": end_date, "page": page},
+                "changes",
+            )
+            if "results" not in data:
+                raise RuntimeError(
+                    f"TMDB changes feed failed: {data.get('status_message')}"
+                )
+            changed_ids.extend(change["id"] for change in data["results"])
+            total_pages = data.get("total_pages") or 1
+            page += 1
+        return changed_ids
+
+    def sync_catalogue(self, max_refresh: int = 500) -> Tuple[int, int]:
+        """
+        This method refreshes the catalogue records TMDB's changes feed reports as changed, and
+        returns the numbers of refreshed and verified records (see `Catalogue.sync`).
+        """
+        return self.catalogue.sync(
+            self.get_changed_movie_ids, self.get_movie_details, max_refresh
+        )
 
     async def search_movies_by_keywords(self, keywords: List[str]) -> List[Movie]:
-        print("search_movies_by_keywords", keywords)
-        async with aiohttp.ClientSession() as session:
-            tasks = [self.search_movies(session, keyword) for keyword in keywords]
-            all_movies = await asyncio.gather(*tasks)
+        tasks = [self.search_movies(keyword) for keyword in keywords]
+        all_movies = await asyncio.gather(*tasks)
         return [movie for sublist in all_movies for movie in sublist]
 
-    async def search_movies(self, session, keyword: str) -> List[Movie]:
-        url: str = f"{self.base_url}search/movie?query={keyword}&api_key={self.api_key}"
-        async with session.get(url) as response:
-            data: Dict[str, Any] = await response.json()
+    async def search_movies(self, keyword: str) -> List[Movie]:
+        # Answer from the local index first, TMDB is only asked on a miss
+        movies = self.movie_index.lookup(keyword)
+        if movies is not None:
+            return [Movie(**movie) for movie in movies]
+        try:
+            data: Dict[str, Any] = await self.get_json_async(
+                "search/movie", {"query": keyword}, "search"
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, RequestShedError):
+            # Keep searching through TMDB outages and overload with whatever the index knows
+            return [Movie(**movie) for movie in self.movie_index.search(keyword)]
+        if "results" not in data:
+            return [Movie(**movie) for movie in self.movie_index.search(keyword)]
+        self.movie_index.add([], query=keyword)
         return [Movie(**movie) for movie in data["results"]]
 
-    def create_query(self, params: Dict[str, str]) -> str:
-        query = "&".join(
-            f"{key}={value.replace(' ', '+')}" for key, value in params.items()
+    def discover_movie_records(self, params: Dict[str, Any]) -> MoviePage:
+        """
+        This method fetches a discover page and decodes the results into MovieRecord, without
+        per-field pydantic validation; invalid rows are kept for the caller to skip.
+        """
+        return MoviePage.from_payload(
+            self.get_json("discover/movie", params, "discover")
         )
-        return query
 
     def discover_movies_with_params(self, params) -> MovieResponse:
-        query = self.create_query(params)
-        url = f"{self.base_url}discover/movie?api_key={self.api_key}&{query}"
-        print("url: ", url)
-        response = req.get(url)
-        data = response.json()
-        print("data: ", data["results"])
-        return MovieResponse(
-            page=data["page"],
-            results=[Movie(**movie) for movie in data["results"]],
-            total_pages=data["total_pages"],
-            total_results=data["total_results"],
+        return self.discover_movie_records(params).to_response()
+
+    async def discover_movies_pages(
+        self, params: Dict[str, Any], max_pages: int = 5, concurrency: int = 4
+    ) -> AsyncIterator[Movie]:
+        """
+        This method fetches up to `max_pages` discover pages concurrently (at most `concurrency`
+        requests at a time) and yields the movies, de-duplicated by id, as each page arrives.
+        """
+        params = {key: value for key, value in params.items() if key != "page"}
+        first_page = await self.get_json_async(
+            "discover/movie", {**params, "page": 1}, "discover"
         )
+        seen_ids = set()
+        for movie in first_page.get("results", []):
+            if movie["id"] not in seen_ids:
+                seen_ids.add(movie["id"])
+                yield Movie(**movie)
+
+        last_page = min(first_page.get("total_pages", 1), max_pages, TMDB_MAX_PAGE)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch_page(page: int) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.get_json_async(
+                    "discover/movie", {**params, "page": page}, "discover"
+                )
+
+        tasks = [
+            asyncio.ensure_future(fetch_page(page)) for page in range(2, last_page + 1)
+        ]
+        try:
+            for next_page in asyncio.as_completed(tasks):
+                data = await next_page
+                for movie in data.get("results", []):
+                    if movie["id"] not in seen_ids:
+                        seen_ids.add(movie["id"])
+                        yield Movie(**movie)
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, MutableMapping, Optional, Set, Tuple
+
+
+def query_hash(query: Dict[str, Any]) -> str:
+    """
+    This function returns a stable key for a query, independent of the order of its fields.
+    """
+    encoded = json.dumps(query, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()[:16]
+
+
+class ResultSet:
+    """
+    ResultSet is a fetched, ranked list of movies and the page of it the user is looking at.
+    Grids render only the current page, so the rest of the set costs nothing until it is shown.
+    """
+
+    def __init__(self, key: str, movies: List[Any], page_size: int = 10) -> None:
+        self.key: str = key
+        self.movies: List[Any] = movies
+        self.page_size: int = page_size
+        self.page: int = 0
+        self.created_at: float = time.time()
+
+    @property
+    def page_count(self) -> int:
+        return max(1, -(-len(self.movies) // self.page_size))
+
+    def visible(self) -> List[Any]:
+        start = self.page * self.page_size
+        return self.movies[start : start + self.page_size]
+
+    def go_to(self, page: int) -> None:
+        self.page = min(max(page, 0), self.page_count - 1)
+
+    def __len__(self) -> int:
+        return len(self.movies)
+
+
+class ResultStore:
+    """
+    ResultStore keeps the result sets of a session in its session state, keyed by the hash of the
+    query that produced them, so a rerun (e.g. a button click) reuses them instead of fetching
+    again. Each named grid remembers the key of the set it shows. Only the `max_sets` most recently
+    used sets are kept.
+    """
+
+    def __init__(self, session_state: MutableMapping[str, Any], max_sets: int = 5):
+        self.max_sets: int = max_sets
+        if "result_sets" not in session_state:
+            session_state["result_sets"] = OrderedDict()
+            session_state["active_result_sets"] = {}
+        self._sets: "OrderedDict[str, ResultSet]" = session_state["result_sets"]
+        self._active: Dict[str, str] = session_state["active_result_sets"]
+
+    def get(self, key: str) -> Optional[ResultSet]:
+        result_set = self._sets.get(key)
+        if result_set is not None:
+            self._sets.move_to_end(key)
+        return result_set
+
+    def put(self, key: str, movies: List[Any], page_size: int = 10) -> ResultSet:
+        result_set = ResultSet(key, movies, page_size)
+        self._sets[key] = result_set
+        self._sets.move_to_end(key)
+        while len(self._sets) > self.max_sets:
+            evicted, _ = self._sets.popitem(last=False)
+            for grid in [g for g, k in self._active.items() if k == evicted]:
+                del self._active[grid]
+        return result_set
+
+    def activate(self, grid: str, key: str) -> None:
+        self._active[grid] = key
+
+    def active(self, grid: str) -> Optional[ResultSet]:
+        key = self._active.get(grid)
+        return self.get(key) if key is not None else None
+
+
+class WatchlistState:
+    """
+    WatchlistState memoizes the logged-in user's watch-list in the session state: the set of its
+    TMDB ids, so movie cards know whether to offer the add button without querying the database,
+    and the keyset pages of it visited so far, by cursor. The add/remove handlers keep the ids up
+    to date and drop the pages, which are queried again on their next use.
+    """
+
+    def __init__(self, session_state: MutableMapping[str, Any]) -> None:
+        self._session_state = session_state
+
+    def _state(self, user_id: int, movie_operations: Any) -> Dict[str, Any]:
+        state = self._session_state.get("watchlist_state")
+        if state is None or state["user_id"] != user_id:
+            state = {
+                "user_id": user_id,
+                "tmdb_ids": set(movie_operations.get_tmdb_ids_for_user(user_id)),
+                "pages": {},
+            }
+            self._session_state["watchlist_state"] = state
+        return state
+
+    def load(self, user_id: int, movie_operations: Any) -> Set[int]:
+        return self._state(user_id, movie_operations)["tmdb_ids"]
+
+    def page(
+        self,
+        user_id: int,
+        movie_operations: Any,
+        limit: int = 20,
+        after_id: Optional[int] = None,
+    ) -> Tuple[List[Any], Optional[int]]:
+        """
+        This method returns one page of the watch-list and the cursor of the next page from
+        `MovieOperations.get_watchlist_page`, which is only queried the first time a page is shown.
+        """
+        pages = self._state(user_id, movie_operations)["pages"]
+        key = (after_id, limit)
+        if key not in pages:
+            movies, next_cursor = movie_operations.get_watchlist_page(
+                user_id, limit=limit, after_id=after_id
+            )
+            pages[key] = (tuple(movies), next_cursor)
+        movies, next_cursor = pages[key]
+        return list(movies), next_cursor
+
+    def contains(self, tmdb_id: int) -> bool:
+        state = self._session_state.get("watchlist_state")
+        return state is not None and tmdb_id in state["tmdb_ids"]
+
+    def add(self, tmdb_id: int) -> None:
+        state = self._session_state.get("watchlist_state")
+        if state is not None:
+            state["tmdb_ids"].add(tmdb_id)
+            state["pages"].clear()
+
+    def discard(self, tmdb_ids: Iterable[Optional[int]]) -> None:
+        state = self._session_state.get("watchlist_state")
+        if state is not None:
+            state["tmdb_ids"].difference_update(tmdb_ids)
+            state["pages"].clear()
+
+    def reset(self) -> None:
+        self._session_state.pop("watchlist_state", None)
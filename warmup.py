@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import streamlit as st
+
+from db import MovieOperations, create_database_connection
+from tmdb_api import BACKGROUND, MovieDB, request_priority
+
+logger = logging.getLogger(__name__)
+
+_warmup = None
+_warmup_lock = threading.Lock()
+
+
+def get_warmup() -> "WarmupScheduler":
+    """
+    This function returns the process-wide warm-up scheduler, started on first use so every
+    Streamlit session reads from the same snapshots.
+    """
+    global _warmup
+    with _warmup_lock:
+        if _warmup is None:
+            _warmup = WarmupScheduler(
+                interval=float(st.secrets.get("warmup_interval", 5 * 60)),
+                catalogue_sync_interval=float(
+                    st.secrets.get("catalogue_sync_interval", 24 * 60 * 60)
+                ),
+                movie_operations=MovieOperations(create_database_connection()),
+            )
+            _warmup.start()
+        return _warmup
+
+
+class Snapshot:
+    """
+    Snapshot class to hold a prefetched dataset and the time it was fetched at: the time TMDB sent
+    it when the dataset carries a `fetched_at` (it may have come from a cache), otherwise now.
+    """
+
+    __slots__ = ("value", "fetched_at")
+
+    def __init__(self, value: Any, fetched_at: Optional[float] = None) -> None:
+        self.value: Any = value
+        if fetched_at is None:
+            fetched_at = getattr(value, "fetched_at", None)
+        self.fetched_at: float = time.time() if fetched_at is None else fetched_at
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+
+class WarmupScheduler:
+    """
+    WarmupScheduler prefetches the data every home page render needs (the genres and the discover
+    page) on a background thread, and refreshes it every `interval` seconds. Page renders read the
+    latest snapshot instead of calling TMDB.
+
+    A refresh that fails keeps the previous snapshot. Until the first warm-up has finished, readers
+    wait for it rather than fetching the same data themselves.
+    """
+
+    def __init__(
+        self,
+        movie_database: Optional[MovieDB] = None,
+        interval: float = 5 * 60,
+        catalogue_sync_interval: float = 24 * 60 * 60,
+        movie_operations: Optional[MovieOperations] = None,
+    ) -> None:
+        self.interval: float = interval
+        self.catalogue_sync_interval: float = catalogue_sync_interval
+        self.refreshes: int = 0
+        self.failures: int = 0
+        self.movie_operations: Optional[MovieOperations] = movie_operations
+        # Set once the watch-list rows of older versions have been given their TMDB ids
+        self.backfilled: bool = movie_operations is None
+        self._movie_database: Optional[MovieDB] = movie_database
+        self._snapshots: Dict[str, Snapshot] = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def movie_database(self) -> MovieDB:
+        if self._movie_database is None:
+            self._movie_database = MovieDB()
+        return self._movie_database
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="warmup-scheduler", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        # The prefetches give way to the requests of the page renders
+        with request_priority(BACKGROUND):
+            while not self._stop.is_set():
+                self.refresh()
+                self.sync_catalogue()
+                self.backfill_tmdb_ids()
+                self._stop.wait(self.interval)
+
+    def refresh(self) -> None:
+        """
+        This method fetches every dataset once and replaces the snapshots that were fetched.
+        """
+        try:
+            self._fetch("genres", self.movie_database.get_movie_genres)
+            self._fetch("discover", self.movie_database.discover_movies)
+            self.refreshes += 1
+        finally:
+            # Readers fall back to fetching themselves if the first warm-up failed
+            self._ready.set()
+
+    def sync_catalogue(self) -> None:
+        """
+        This method syncs the catalogue when the last sync is older than the sync interval.
+        """
+        synced_at = self.movie_database.catalogue.synced_at
+        if synced_at is None or time.time() - synced_at >= self.catalogue_sync_interval:
+            self._fetch("catalogue", self.movie_database.sync_catalogue)
+
+    def backfill_tmdb_ids(self) -> None:
+        """
+        This method resolves the TMDB ids of the watch-list rows stored without one, until a run
+        succeeds. Without the id, adding such a movie again from a card would duplicate the row.
+        """
+        if self.backfilled:
+            return
+        snapshot = self._fetch(
+            "backfill",
+            lambda: self.movie_operations.backfill_tmdb_ids(
+                self.movie_database.resolve_tmdb_id
+            ),
+        )
+        self.backfilled = snapshot is not None
+
+    def _fetch(self, name: str, loader: Callable[[], Any]) -> Optional[Snapshot]:
+        try:
+            snapshot = Snapshot(loader())
+        except Exception:
+            self.failures += 1
+            logger.exception("Warm-up of %s failed", name)
+            return self._snapshots.get(name)
+        with self._lock:
+            self._snapshots[name] = snapshot
+        return snapshot
+
+    def snapshot(
+        self, name: str, loader: Callable[[], Any], timeout: Optional[float] = 30.0
+    ) -> Snapshot:
+        """
+        This method returns the snapshot of a dataset, waiting up to `timeout` seconds for the first
+        warm-up. When it has no snapshot of the dataset, it is fetched with `loader` and kept.
+        """
+        self._ready.wait(timeout)
+        snapshot = self._snapshots.get(name)
+        if snapshot is None:
+            snapshot = Snapshot(loader())
+            with self._lock:
+                self._snapshots.setdefault(name, snapshot)
+        return snapshot
+
+    def genres(self, timeout: Optional[float] = 30.0) -> Snapshot:
+        return self.snapshot("genres", self.movie_database.get_movie_genres, timeout)
+
+    def discover(self, timeout: Optional[float] = 30.0) -> Snapshot:
+        return self.snapshot("discover", self.movie_database.discover_movies, timeout)
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "ages": {name: s.age() for name, s in self._snapshots.items()},
+        }